@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+from __future__ import division
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+
+import numpy
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [root, os.path.join(root, 'bin')]
+
+# the model config is picked by WPYNMT_CONFIG when wargs is imported, see bench/run.py
+import wargs
+wargs.gpu_id = None     # benchmarks run on CPU, set before the other modules read it
+
+import torch as tc
+from tools.utils import wlog, BOS, EOS, NUM_RESERVED_TOKENS
+from tools.inputs import Input
+from tools.optimizer import Optim
+from tools.bleu import corpus_stats, bleu_from_stats
+from tools.inference import StepModel
+from models.model_builder import build_model
+import translate
+
+'''
+    time fn(setup()) for warmup + repeats calls, setup is not timed, scale converts the time of
+    one call into the reported unit (e.g. per step), return milliseconds over the repeats
+'''
+def measure(fn, warmup, repeats, setup=None, scale=1.):
+
+    times = []
+    for i in range(warmup + repeats):
+        arg = setup() if setup is not None else None
+        start = time.time()
+        fn(arg)
+        spend = time.time() - start
+        if i >= warmup: times.append(spend * 1000. * scale)
+
+    times = numpy.asarray(times)
+    p50, p90, p99 = numpy.percentile(times, [50, 90, 99])
+
+    return { 'warmup': warmup, 'repeats': repeats, 'mean_ms': times.mean(), 'std_ms': times.std(),
+             'min_ms': times.min(), 'max_ms': times.max(), 'p50_ms': p50, 'p90_ms': p90, 'p99_ms': p99 }
+
+def synthetic_sents(rng, n_sents, n_vocab, min_len, max_len):
+
+    lens = rng.randint(min_len, max_len + 1, size=n_sents)
+    return [rng.randint(NUM_RESERVED_TOKENS, n_vocab, size=l).tolist() for l in lens]
+
+def git_commit():
+
+    try: return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=root).strip()
+    except (OSError, subprocess.CalledProcessError): return None
+
+def bench_encoder(model, xs, xs_mask, args):
+
+    model.eval()
+    with tc.no_grad():
+        return measure(lambda _: model.encoder(xs, xs_mask), args.warmup, args.repeats)
+
+'''
+    greedy incremental decoding of dec_steps steps from the encoder output, per step
+'''
+def bench_decoder_step(model, xs, xs_mask, args):
+
+    model.eval()
+    decoder, classifier = model.decoder, model.decoder.classifier
+    B, n_steps = xs.size(0), args.dec_steps
+
+    def att_steps(_):
+        cache, ys = decoder.init_cache(enc_output), xs.new_full((B, 1), BOS)
+        for i in range(n_steps):
+            dec_output, _, _ = decoder(ys, xs, None, src_mask=xs_mask, step=i, cache=cache)
+            ys = classifier(dec_output[:, -1, :]).min(-1)[1][:, None]
+
+    def rnn_steps(_):
+        s_tm1, y_tm1 = s0, xs.new_full((B, ), BOS)
+        for i in range(n_steps):
+            _, y_emb = decoder.trg_word_emb(y_tm1)
+            context, s_tm1, y_emb, _ = decoder.step(s_tm1, enc_output, uh, y_emb, xs_mask)[:4]
+            y_tm1 = classifier(decoder.step_out(y_emb, context, s_tm1)).min(-1)[1]
+
+    with tc.no_grad():
+        if wargs.decoder_type == 'att':
+            enc_output, _ = model.encoder(xs, xs_mask)
+            return measure(att_steps, args.warmup, args.repeats, scale=1. / n_steps)
+        enc_output = model.encoder(xs, xs_mask)
+        s0, uh = decoder.init_state(enc_output, xs_mask)
+        return measure(rnn_steps, args.warmup, args.repeats, scale=1. / n_steps)
+
+'''
+    greedy decoding of dec_steps steps by tools/inference.StepModel (the encoder included),
+    eager or with the traced graphs, per step
+'''
+def bench_step_model(model, xs, xs_mask, jit, args):
+
+    model.eval()
+    step_model = StepModel(model, jit=jit)
+
+    def steps(_):
+        state, ys = step_model.encode(xs, xs_mask), xs.new_full((xs.size(0), ), BOS)
+        for i in range(args.dec_steps):
+            costs, _, state = step_model.decode_step(state, ys)
+            ys = costs.min(-1)[1]
+
+    with tc.no_grad():
+        return measure(steps, args.warmup, args.repeats, scale=1. / args.dec_steps)
+
+def train_forward(model, batch):
+
+    _, xs, y_for_files, bows, _, xs_mask, y_mask_for_files, bows_mask = batch
+    ys, ys_mask = y_for_files[0], y_mask_for_files[0]
+    if bows is not None: bows, bows_mask = bows[0], bows_mask[0]
+    model.zero_grad()
+    results = model(xs, ys[:, :-1], xs_mask, ys_mask[:, :-1])
+
+    return results['logit'], ys[:, 1:].contiguous(), ys_mask[:, 1:].contiguous(), bows, bows_mask, \
+            results['context']
+
+def snip_back_prop(model, outputs):
+
+    logits, gold, gold_mask, bows, bows_mask, contexts = outputs
+    return model.decoder.classifier.snip_back_prop(logits, gold, gold_mask, bows, bows_mask, 0,
+                                                   wargs.snip_size, contexts)
+
+def bench_snip_back_prop(model, batch, args):
+
+    model.train()
+    return measure(lambda outputs: snip_back_prop(model, outputs), args.warmup, args.repeats,
+                   setup=lambda: train_forward(model, batch))
+
+def bench_optim_step(model, batch, args):
+
+    model.train()
+    optim = Optim(wargs.opt_mode, wargs.learning_rate, wargs.max_grad_norm)
+    optim.init_optimizer(model.parameters())
+
+    return measure(lambda _: optim.step(), args.warmup, args.repeats,
+                   setup=lambda: snip_back_prop(model, train_forward(model, batch)))
+
+def bench_train_step(model, batch, args):
+
+    model.train()
+    optim = Optim(wargs.opt_mode, wargs.learning_rate, wargs.max_grad_norm)
+    optim.init_optimizer(model.parameters())
+
+    def step(_):
+        snip_back_prop(model, train_forward(model, batch))
+        optim.step()
+
+    return measure(step, args.warmup, args.repeats)
+
+def bench_input_getitem(train_data, rng, args):
+
+    return measure(lambda idx: train_data[idx], args.warmup, args.repeats,
+                   setup=lambda: rng.randint(len(train_data)))
+
+'''
+    beam search of one search mode over n_decode sentences, per sentence, one by one or
+    together in one batch
+'''
+def bench_search(model, srcs, i2w, mode, batch, args):
+
+    model.eval()
+    if mode == 2 and not hasattr(translate, 'Wcp'):     # imported by translate only if search_mode == 2
+        from searchs.cp import Wcp
+        translate.Wcp = Wcp
+    tor = translate.Translator(model, i2w, i2w, search_mode=mode, k=args.beam_size)
+    sents = srcs[:args.n_decode]
+
+    if batch is True:
+        assert tor.batch_search is True, 'search mode {} decodes one sentence at a time'.format(mode)
+        max_len = max(len(s) for s in sents)
+        xs = tc.tensor([s + [0] * (max_len - len(s)) for s in sents]).long()
+        return measure(lambda _: tor.trans_batch(xs, xs.ne(0).float()), args.warmup, args.repeats,
+                       scale=1. / len(sents))
+
+    xs = [tc.tensor(s).long().unsqueeze(0) for s in sents]
+    def trans(_):
+        for x in xs: tor.trans_onesent(x)
+
+    return measure(trans, args.warmup, args.repeats, scale=1. / len(sents))
+
+def bench_bleu(rng, args):
+
+    hypos = [' '.join(str(w) for w in s) for s in synthetic_sents(rng, args.n_bleu, 2000, 5, 40)]
+    refs = [[' '.join(str(w) for w in s) for s in synthetic_sents(rng, args.n_bleu, 2000, 5, 40)]]
+
+    def score(_):
+        stats, = corpus_stats(hypos, refs, 4, styles=('mteval', ), n_workers=1)
+        bleu_from_stats(stats.sum(0), 4)
+
+    return measure(score, args.warmup, args.repeats)
+
+if __name__ == '__main__':
+
+    A = argparse.ArgumentParser(prog='NMT benchmarks of one model config (WPYNMT_CONFIG) on CPU')
+    A.add_argument('-o', '--output', dest='output', default=None, help='json file, stdout by default')
+    A.add_argument('--warmup', dest='warmup', type=int, default=3, help='untimed calls')
+    A.add_argument('--repeats', dest='repeats', type=int, default=20, help='timed calls')
+    A.add_argument('--seed', dest='seed', type=int, default=1111, help='random seed')
+    A.add_argument('--threads', dest='threads', type=int, default=None, help='torch threads')
+    A.add_argument('--vocab-size', dest='vocab_size', type=int, default=8000, help='synthetic vocabulary')
+    A.add_argument('--n-sents', dest='n_sents', type=int, default=2000, help='synthetic corpus size')
+    A.add_argument('--min-len', dest='min_len', type=int, default=5, help='min sentence length')
+    A.add_argument('--max-len', dest='max_len', type=int, default=50, help='max sentence length')
+    A.add_argument('--batch-size', dest='batch_size', type=int, default=32, help='sentences per batch')
+    A.add_argument('--batch-tokens', dest='batch_tokens', type=int, default=2048,
+                   help='token budget of the batches of Input.__getitem__')
+    A.add_argument('--dec-steps', dest='dec_steps', type=int, default=20, help='decoder steps')
+    A.add_argument('--beam-size', dest='beam_size', type=int, default=4, help='beam size')
+    A.add_argument('--n-decode', dest='n_decode', type=int, default=8, help='sentences decoded')
+    A.add_argument('--search-modes', dest='search_modes', default='1,2', help='search modes')
+    A.add_argument('--n-bleu', dest='n_bleu', type=int, default=2000, help='sentences scored')
+    args = A.parse_args()
+
+    if args.threads is not None: tc.set_num_threads(args.threads)
+    numpy.random.seed(args.seed)
+    tc.manual_seed(args.seed)
+    rng = numpy.random.RandomState(args.seed)
+
+    srcs = synthetic_sents(rng, args.n_sents, args.vocab_size, args.min_len, args.max_len)
+    trgs = synthetic_sents(rng, args.n_sents, args.vocab_size, args.min_len, args.max_len)
+    x_list, y_list = [[s] for s in srcs], [[[BOS] + t + [EOS]] for t in trgs]
+    i2w = dict((i, 'w{}'.format(i)) for i in range(args.vocab_size))
+
+    model = build_model(args.vocab_size, args.vocab_size)
+    train_data = Input(x_list, y_list, args.batch_tokens, batch_type='token', bow=wargs.bow_loss)
+    batch = Input(x_list, y_list, args.batch_size, bow=wargs.bow_loss, batch_sort=True)[0]
+    xs, xs_mask = batch[1], batch[5]
+
+    cases = [
+        ('encoder', lambda: bench_encoder(model, xs, xs_mask, args)),
+        ('decoder_step', lambda: bench_decoder_step(model, xs, xs_mask, args)),
+        ('step_model', lambda: bench_step_model(model, xs, xs_mask, False, args)),
+        ('step_model_jit', lambda: bench_step_model(model, xs, xs_mask, True, args)),
+        ('snip_back_prop', lambda: bench_snip_back_prop(model, batch, args)),
+        ('optim_step', lambda: bench_optim_step(model, batch, args)),
+        ('train_step', lambda: bench_train_step(model, batch, args)),
+        ('input_getitem', lambda: bench_input_getitem(train_data, rng, args)),
+        ('bleu', lambda: bench_bleu(rng, args)),
+    ]
+    for mode in [int(m) for m in args.search_modes.split(',')]:
+        cases.append(('search_{}'.format(mode),
+                      lambda mode=mode: bench_search(model, srcs, i2w, mode, False, args)))
+        if mode == 1:
+            cases.append(('search_{}_batch'.format(mode),
+                          lambda mode=mode: bench_search(model, srcs, i2w, mode, True, args)))
+
+    results = {}
+    for name, case in cases:
+        wlog('Benchmark {} {} ... '.format(wargs.model_config, name), 0)
+        # a case the config does not support is recorded instead of stopping the suite
+        try: results[name] = case()
+        except Exception as e: results[name] = { 'error': '{}: {}'.format(type(e).__name__, e) }
+        wlog(results[name].get('p50_ms', results[name].get('error')))
+
+    report = { 'config': wargs.model_config, 'encoder_type': wargs.encoder_type,
+               'decoder_type': wargs.decoder_type, 'commit': git_commit(),
+               'python': platform.python_version(), 'torch': tc.__version__,
+               'threads': tc.get_num_threads(), 'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+               'settings': vars(args), 'results': results }
+    if args.output is None: print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        with open(args.output, 'w') as f: json.dump(report, f, indent=2, sort_keys=True)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+from __future__ import division
+
+import os
+import sys
+import argparse
+import itertools
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [root, os.path.join(root, 'bin')]
+
+import wargs
+wargs.gpu_id, wargs.proj_share_weight = None, False
+
+import torch as tc
+from tools.utils import wlog, PAD
+from models.losser import Classifier
+from models.nn_utils import chunked_xent
+
+'''
+    check the fused chunked cross entropy (wargs.chunk_xent) against the unfused path of the
+    classifier (MyLogSoftmax + smoothingXentLoss) in double precision on a small vocabulary:
+    the losses, |logZ|, correct counts and the gradients of the decoder outputs, the projection
+    weight and bias, then tc.autograd.gradcheck on chunked_xent, for each label smoothing and
+    self-normalization alpha, with chunks that do not divide the rows and the vocabulary
+        python bench/check_xent.py
+'''
+def run_classifier(classifier, feed_BLH, gold_BL, chunk):
+
+    wargs.chunk_xent = chunk
+    classifier.zero_grad()
+    feed_BLH = feed_BLH.detach().requires_grad_()
+    loss, ce_loss, _, _, ok_ytoks, abs_logZ = classifier(feed_BLH, gold_BL, gold_BL.ne(PAD).double())
+    loss.backward()
+    grads = [feed_BLH.grad, classifier.map_vocab.weight.grad, classifier.map_vocab.bias.grad]
+
+    return [loss, ce_loss, abs_logZ, ok_ytoks.double()], [g.clone() for g in grads]
+
+def check(ls, sna, args):
+
+    wargs.self_norm_alpha = sna
+    tc.manual_seed(args.seed)
+    classifier = Classifier(args.hidden, args.vocab_size, label_smoothing=ls).double()
+    feed_BLH = tc.randn(args.batch, args.length, args.hidden, dtype=tc.float64)
+    gold_BL = tc.randint(1, args.vocab_size, (args.batch, args.length), dtype=tc.long)
+    gold_BL[0, args.length // 2:] = PAD   # padded rows are ignored
+
+    ref_outs, ref_grads = run_classifier(classifier, feed_BLH, gold_BL, False)
+    outs, grads = run_classifier(classifier, feed_BLH, gold_BL, True)
+    names = ['loss', 'nll', '|logZ|', 'ok', 'grad h', 'grad weight', 'grad bias']
+    errs = [(a - b).abs().max().item() for a, b in zip(ref_outs + ref_grads, outs + grads)]
+    ok = all(err <= args.tol for err in errs)
+    for name, err in zip(names, errs):
+        if err > args.tol: wlog('ls={} sna={}: {} differs by {:.3e}'.format(ls, sna, name, err))
+
+    h = tc.randn(5, args.hidden, dtype=tc.float64, requires_grad=True)
+    w = classifier.map_vocab.weight.detach().clone().requires_grad_()
+    b = classifier.map_vocab.bias.detach().clone().requires_grad_()
+    gold = tc.tensor([3, PAD, 1, args.vocab_size - 1, 7], dtype=tc.long)
+    fn = lambda h, w, b: chunked_xent(h, w, b, gold, PAD, ls, sna, args.row_chunk, args.vocab_chunk)[0]
+    if not tc.autograd.gradcheck(fn, (h, w, b), raise_exception=False):
+        wlog('ls={} sna={}: gradcheck of chunked_xent fails'.format(ls, sna))
+        ok = False
+    wlog('ls={} sna={}: {}'.format(ls, sna, 'ok' if ok is True else 'FAILED'))
+
+    return ok
+
+if __name__ == '__main__':
+
+    A = argparse.ArgumentParser(prog='check the chunked cross entropy against the unfused loss')
+    A.add_argument('--seed', dest='seed', type=int, default=1111, help='random seed')
+    A.add_argument('--vocab-size', dest='vocab_size', type=int, default=37, help='vocabulary')
+    A.add_argument('--hidden', dest='hidden', type=int, default=8, help='decoder output size')
+    A.add_argument('--batch', dest='batch', type=int, default=3, help='sentences')
+    A.add_argument('--length', dest='length', type=int, default=6, help='target length')
+    A.add_argument('--row-chunk', dest='row_chunk', type=int, default=4, help='rows per chunk')
+    A.add_argument('--vocab-chunk', dest='vocab_chunk', type=int, default=10, help='words per chunk')
+    A.add_argument('--tol', dest='tol', type=float, default=1e-8, help='max absolute difference')
+    args = A.parse_args()
+
+    wargs.xent_row_chunk, wargs.xent_vocab_chunk = args.row_chunk, args.vocab_chunk
+    results = [check(ls, sna, args) for ls, sna in itertools.product([0., 0.1], [None, 0.1])]
+    sys.exit(0 if all(results) else 1)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+from __future__ import division
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+
+'''
+    run bench/bench_nmt.py for each model config in its own process (wargs is configured when
+    it is imported), write all the reports into one json file and compare the medians with a
+    report of another commit:
+        python bench/run.py -o bench.json
+        python bench/run.py -o new.json --compare bench.json
+'''
+def run_config(config, extra_args):
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_nmt.py')
+    fd, output = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    env = dict(os.environ, WPYNMT_CONFIG=config)
+    try:
+        subprocess.check_call([sys.executable, script, '-o', output] + extra_args, env=env)
+        with open(output) as f: return json.load(f)
+    finally:
+        os.remove(output)
+
+def print_reports(reports, baseline=None):
+
+    base = {}
+    if baseline is not None:
+        for report in baseline['reports']:
+            for name, rst in report['results'].items(): base[(report['config'], name)] = rst
+
+    print('{:12} {:18} {:>10} {:>10} {:>10} {:>9}'.format('config', 'case', 'p50 ms', 'p90 ms',
+                                                           'p99 ms', 'vs base'))
+    for report in reports:
+        for name, rst in sorted(report['results'].items()):
+            if 'error' in rst:
+                print('{:12} {:18} {}'.format(report['config'], name, rst['error']))
+                continue
+            old = base.get((report['config'], name), {})
+            ratio = '{:8.2f}x'.format(rst['p50_ms'] / old['p50_ms']) if 'p50_ms' in old else ''
+            print('{:12} {:18} {:10.3f} {:10.3f} {:10.3f} {:>9}'.format(report['config'], name,
+                rst['p50_ms'], rst['p90_ms'], rst['p99_ms'], ratio))
+
+if __name__ == '__main__':
+
+    A = argparse.ArgumentParser(prog='NMT benchmark suite',
+                                epilog='other arguments are passed to bench/bench_nmt.py')
+    A.add_argument('-o', '--output', dest='output', default='bench.json', help='json file')
+    A.add_argument('-c', '--configs', dest='configs', default='t2t_tiny,gru_tiny,tgru_tiny',
+                   help='model configs in wargs.py, separated by comma')
+    A.add_argument('--compare', dest='compare', default=None, help='json file of a previous run')
+    args, extra_args = A.parse_known_args()
+
+    reports = [run_config(config, extra_args) for config in args.configs.split(',')]
+    with open(args.output, 'w') as f:
+        json.dump({ 'reports': reports }, f, indent=2, sort_keys=True)
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f: baseline = json.load(f)
+    print_reports(reports, baseline)
@@ -0,0 +1,70 @@
+from __future__ import division
+
+import os
+import sys
+import json
+import time
+sys.path.append(os.getcwd())
+
+import wargs
+from tools.utils import load_model, wlog, dec_conf
+from tools.inputs_handler import *
+from tools.checkpoint import failed_marker
+from models.model_builder import build_model
+from translate import Translator, valid_bleu_history
+
+'''
+    evaluation worker started by the trainer: it reads jobs {model file, epoch, batch} from
+    stdin, decodes and scores the validation set (and the test sets when the BLEU beats the
+    history) with the weight snapshot in the model file, and writes results to stdout, with
+    'error' instead of 'bleu' if the model file could not be saved
+'''
+def main():
+
+    # the results channel is the original stdout, everything printed while decoding goes to stderr
+    results = os.fdopen(os.dup(sys.stdout.fileno()), 'w', 0)
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    wlog('Evaluation worker {} starts, loading vocabularies ... '.format(os.getpid()))
+    src_vocab = extract_vocab(None, wargs.src_vcb)
+    trg_vocab = extract_vocab(None, wargs.trg_vcb)
+    if wargs.binarize is True: wrap_data_fn, wrap_tst_data_fn = wrap_bin_data, wrap_bin_tst_data
+    else: wrap_data_fn, wrap_tst_data_fn = wrap_data, wrap_tst_data
+    valid_data, tests_data = prepare_valid_tests(src_vocab, trg_vocab, wrap_data_fn, wrap_tst_data_fn)
+
+    nmtModel = build_model(src_vocab.size(), trg_vocab.size())
+    nmtModel.eval()
+    tor = Translator(nmtModel, src_vocab.idx2key, trg_vocab.idx2key, print_att=wargs.print_att)
+    dec_conf()
+    best_bleu = max(valid_bleu_history())
+
+    for line in iter(sys.stdin.readline, ''):
+        job = json.loads(line)
+        # the trainer writes checkpoints in background, a file appears once it is complete, or
+        # a marker if saving it fails
+        marker, start = failed_marker(job['model_file']), time.time()
+        while not os.path.exists(job['model_file']) and not os.path.exists(marker):
+            if time.time() - start > wargs.async_eval_timeout: break
+            time.sleep(1)
+        if not os.path.exists(job['model_file']):
+            if os.path.exists(marker):
+                with open(marker, 'r') as f: job['error'] = f.read().strip()
+            else: job['error'] = 'not saved in {} seconds'.format(wargs.async_eval_timeout)
+            results.write(json.dumps(job) + '\n')
+            continue
+        model_dict = load_model(job['model_file'])[0]
+        nmtModel.load_state_dict(model_dict)
+        eid, bid = job['epoch'], job['batch']
+        bleu_score = tor.eval_valid(valid_data, eid, bid)
+        # same rule with the bookkeeping in trainer, decode the test sets only for a better model
+        if bleu_score > best_bleu:
+            best_bleu = bleu_score
+            if tests_data is not None: tor.trans_tests(tests_data, eid, bid)
+        job['bleu'] = bleu_score
+        results.write(json.dumps(job) + '\n')
+
+    wlog('Evaluation worker {} exits'.format(os.getpid()))
+
+if __name__ == '__main__':
+
+    main()
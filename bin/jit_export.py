@@ -0,0 +1,42 @@
+from __future__ import division
+
+import os
+import sys
+import argparse
+import torch as tc
+sys.path.append(os.getcwd())
+
+import wargs
+from tools.utils import load_model, wlog, init_dir, NUM_RESERVED_TOKENS
+from tools.inputs_handler import extract_vocab
+from tools.quantize import load_weights
+from tools.inference import StepModel
+from models.model_builder import build_model
+
+'''
+    trace the encoder and the one-step decoder of a model into encode.pt and decode_step.pt,
+    which are loaded by tc.jit.load (or torch::jit::load in C++) without the model code
+'''
+if __name__ == '__main__':
+
+    A = argparse.ArgumentParser(prog='Export the traced encoder and decoder step graphs')
+    A.add_argument('-m', '--model-file', dest='model_file', default=wargs.best_model, help='model file')
+    A.add_argument('--ema', dest='ema', action='store_true',
+                   help='export the moving average of weights saved in the model file')
+    A.add_argument('-o', '--output-dir', dest='output_dir', required=True, help='directory of the graphs')
+    A.add_argument('--example-len', dest='example_len', type=int, default=10,
+                   help='source length of the example batch to trace with')
+    args = A.parse_args()
+
+    src_vocab = extract_vocab(None, wargs.src_vcb)
+    trg_vocab = extract_vocab(None, wargs.trg_vcb)
+    model = build_model(src_vocab.size(), trg_vocab.size())
+    load_weights(model, load_model(args.model_file, ema=args.ema)[0])
+    model.eval()
+
+    src = tc.arange(NUM_RESERVED_TOKENS, NUM_RESERVED_TOKENS + args.example_len).long()[None, :]
+    src_mask = tc.ones(src.size())
+    if wargs.gpu_id is not None: src, src_mask = src.cuda(), src_mask.cuda()
+    init_dir(args.output_dir)
+    with tc.no_grad():
+        StepModel(model, jit=True).save(args.output_dir, src, src_mask)
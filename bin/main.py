@@ -2,6 +2,8 @@
 
 import os
 import sys
+import numpy
+import multiprocessing
 sys.path.append(os.getcwd())
 
 import torch as tc
@@ -11,10 +13,9 @@ import wargs
 from tools.inputs_handler import *
 from tools.inputs import Input
 from tools.optimizer import Optim
-from models.losser import Classifier
-from models.embedding import WordEmbedding
-from models.model_builder import build_NMT
+from models.model_builder import build_model
 from tools.utils import init_dir, wlog
+from tools.distributed import init_distributed, sync_params, GradAllReducer
 
 # Check if CUDA is available
 if cuda.is_available():
@@ -36,7 +37,19 @@ cudnn.enabled = True
 
 tc.manual_seed(1111)
 
-def main():
+def main(rank=0):
+
+    world_size = wargs.dist_world_size
+    if world_size > 1:
+        assert wargs.gpu_id is None, 'distributed data-parallel training runs on CPU, gpu_id = None'
+        wargs.dist_rank = rank
+        init_distributed(rank, world_size)
+        # share the cores among the ranks
+        tc.set_num_threads(max(1, multiprocessing.cpu_count() // world_size))
+        # rank 0 builds the vocabularies and the binarized data, the others load them
+        if rank > 0: tc.distributed.barrier()
+    # each rank has its own numpy random state, the data shuffling has a shared one (trainer)
+    numpy.random.seed(1111 + rank)
 
     #if wargs.ss_type is not None: assert wargs.model == 1, 'Only rnnsearch support schedule sample'
     init_dir(wargs.dir_model)
@@ -56,7 +69,10 @@ def main():
 
     wlog('\nPreparing training set from {} and {} ... '.format(src, trg))
     trains = {}
-    train_src_tlst, train_trg_tlst = wrap_data(wargs.dir_data, wargs.train_prefix,
+    # binarized corpus is memory-mapped, the sentences are read lazily
+    if wargs.binarize is True: wrap_data_fn, wrap_tst_data_fn = wrap_bin_data, wrap_bin_tst_data
+    else: wrap_data_fn, wrap_tst_data_fn = wrap_data, wrap_tst_data
+    train_src_tlst, train_trg_tlst = wrap_data_fn(wargs.dir_data, wargs.train_prefix,
                                                wargs.train_src_suffix, wargs.train_trg_suffix,
                                                src_vocab, trg_vocab, shuffle=True,
                                                sort_k_batches=wargs.sort_k_batches,
@@ -70,64 +86,19 @@ def main():
                         batch_type=wargs.batch_type, bow=wargs.trg_bow, batch_sort=False)
     wlog('Sentence-pairs count in training data: {}'.format(len(train_src_tlst)))
 
-    batch_valid = None
-    if wargs.val_prefix is not None:
-        val_src_file = os.path.join(wargs.val_tst_dir, '{}.{}'.format(wargs.val_prefix, wargs.val_src_suffix))
-        val_trg_file = os.path.join(wargs.val_tst_dir, '{}.{}'.format(wargs.val_prefix, wargs.val_ref_suffix))
-        wlog('\nPreparing validation set from {} and {} ... '.format(val_src_file, val_trg_file))
-        valid_src_tlst, valid_trg_tlst = wrap_data(wargs.val_tst_dir, wargs.val_prefix,
-                                                   wargs.val_src_suffix, wargs.val_ref_suffix,
-                                                   src_vocab, trg_vocab, shuffle=False,
-                                                   max_seq_len=wargs.dev_max_seq_len,
-                                                   char=wargs.src_char)
-        batch_valid = Input(valid_src_tlst, valid_trg_tlst, 1, batch_sort=False)
-
-    batch_tests = None
-    if wargs.tests_prefix is not None:
-        assert isinstance(wargs.tests_prefix, list), 'Test files should be list.'
-        init_dir(wargs.dir_tests)
-        batch_tests = {}
-        for prefix in wargs.tests_prefix:
-            init_dir(wargs.dir_tests + '/' + prefix)
-            test_file = '{}{}.{}'.format(wargs.val_tst_dir, prefix, wargs.val_src_suffix)
-            wlog('\nPreparing test set from {} ... '.format(test_file))
-            test_src_tlst, _ = wrap_tst_data(test_file, src_vocab, char=wargs.src_char)
-            batch_tests[prefix] = Input(test_src_tlst, None, 1, batch_sort=False)
+    batch_valid, batch_tests = prepare_valid_tests(src_vocab, trg_vocab, wrap_data_fn, wrap_tst_data_fn)
     wlog('\n## Finish to Prepare Dataset ! ##\n')
+    if world_size > 1 and rank == 0: tc.distributed.barrier()
 
-    src_emb = WordEmbedding(n_src_vcb, wargs.d_src_emb, wargs.input_dropout,
-                            wargs.position_encoding, prefix='Src')
-    trg_emb = WordEmbedding(n_trg_vcb, wargs.d_trg_emb, wargs.input_dropout,
-                            wargs.position_encoding, prefix='Trg')
-    # share the embedding matrix - preprocess with share_vocab required.
-    if wargs.embs_share_weight:
-        if n_src_vcb != n_trg_vcb:
-            raise AssertionError('The `-share_vocab` should be set during '
-                                 'preprocess if you use share_embeddings!')
-        src_emb.we.weight = trg_emb.we.weight
-
-    nmtModel = build_NMT(src_emb, trg_emb)
-
-    if not wargs.copy_attn:
-        classifier = Classifier(wargs.d_model if wargs.decoder_type == 'att' else wargs.d_dec_hid,
-                                n_trg_vcb, trg_emb, loss_norm=wargs.loss_norm,
-                                label_smoothing=wargs.label_smoothing,
-                                emb_loss=wargs.emb_loss, bow_loss=wargs.bow_loss)
-    nmtModel.decoder.classifier = classifier
-
-    if wargs.gpu_id is not None:
-        wlog('push model onto GPU {} ... '.format(wargs.gpu_id), 0)
-        #nmtModel = nn.DataParallel(nmtModel, device_ids=wargs.gpu_id)
-        nmtModel.to(tc.device('cuda'))
-    else:
-        wlog('push model onto CPU ... ', 0)
-        nmtModel.to(tc.device('cpu'))
-    wlog('done.')
+    nmtModel = build_model(n_src_vcb, n_trg_vcb)
 
+    ema_dict = None
     if wargs.pre_train is not None:
         assert os.path.exists(wargs.pre_train)
         from tools.utils import load_model
-        _dict = load_model(wargs.pre_train)
+        # the checkpoint is loaded once, with the moving average of weights if it is resumed
+        _dict = load_model(wargs.pre_train, with_ema=wargs.ema_decay is not None)
+        if wargs.ema_decay is not None: _dict, ema_dict = _dict[:-1], _dict[-1]
         # initializing parameters of interactive attention model
         class_dict = None
         if len(_dict) == 5:
@@ -152,6 +123,12 @@ def main():
             else: init_params(param, name, init_D=wargs.param_init_D, a=float(wargs.u_gain))
 
         wargs.start_epoch = eid + 1
+        # inference-only checkpoints carry no optimizer
+        if optim is None: optim = Optim(wargs.opt_mode, wargs.learning_rate, wargs.max_grad_norm)
+        # resume the moving average, the decay continues from the restored step counter
+        if wargs.ema_decay is not None and ema_dict is None:
+            wlog('No moving average of weights in {}, start it from the loaded weights'.format(
+                wargs.pre_train))
 
     else:
         optim = Optim(wargs.opt_mode, wargs.learning_rate, wargs.max_grad_norm)
@@ -171,6 +148,11 @@ def main():
         if p.requires_grad: wlog('{:60} : {}'.format(n, p.size()))
 
     optim.init_optimizer(nmtModel.parameters())
+    if world_size > 1:
+        sync_params(nmtModel)
+        optim.grad_reducer = GradAllReducer(optim.params, wargs.dist_bucket_mb)
+        tc.manual_seed(1111 + rank)     # different dropout masks on each rank
+    if wargs.ema_decay is not None: optim.init_ema(nmtModel, wargs.ema_decay, init=ema_dict)
 
     trainer = Trainer(nmtModel, batch_train, vocabs, optim, batch_valid, batch_tests)
 
@@ -179,7 +161,14 @@ def main():
 
 if __name__ == '__main__':
 
-    main()
+    if wargs.dist_world_size > 1:
+        # launch one training process per rank on this machine
+        ranks = [multiprocessing.Process(target=main, args=(rank,))
+                 for rank in range(wargs.dist_world_size)]
+        for p in ranks: p.start()
+        for p in ranks: p.join()
+    else:
+        main()
 
 
 
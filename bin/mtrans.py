@@ -0,0 +1,338 @@
+# coding=utf-8
+from __future__ import division
+
+import os
+import re
+import sys
+import time
+import json
+import Queue
+import shutil
+import argparse
+import multiprocessing
+import torch as tc
+sys.path.append(os.getcwd())
+
+import wargs
+wargs.gpu_id = None     # the workers decode on CPU, set before the other modules read it
+from tools.utils import load_model, wlog, dec_conf, PAD, UNK_WORD, NUM_RESERVED_TOKENS
+from tools.inputs_handler import extract_vocab
+from tools.bleu import zh_to_chars
+from tools.quantize import load_weights, is_quantized, quantize_model
+from tools.bundle import is_bundle, load_bundle_model
+from models.model_builder import build_model
+from translate import Translator
+
+def weights(model):
+
+    return list(model.parameters()) + list(model.buffers())
+
+'''
+    load the model once in the launcher, return the model, the vocabularies and the data
+    pointers of the weights mapped from a bundle file
+'''
+def load(model_file, ema=False, int8=False):
+
+    mapped = set()
+    if is_bundle(model_file):
+        model, src_vocab, trg_vocab, _ = load_bundle_model(model_file, build_model)
+        mapped = set(t.data_ptr() for t in weights(model))
+        if int8 is True and not is_quantized(model.state_dict()): quantize_model(model)
+    else:
+        src_vocab = extract_vocab(None, wargs.src_vcb)
+        trg_vocab = extract_vocab(None, wargs.trg_vcb)
+        model = load_weights(build_model(src_vocab.size(), trg_vocab.size()),
+                             load_model(model_file, ema=ema)[0], int8=int8)
+    model.eval()
+
+    return model, src_vocab, trg_vocab, mapped
+
+'''
+    move the weights into shared memory before forking, the workers read the same pages instead
+    of copying them on write. The pages of a mapped bundle are shared by the page cache already
+'''
+def share_weights(model, mapped=()):
+
+    n_shared, n_bytes = 0, 0
+    for t in weights(model):
+        if t.data_ptr() in mapped: continue
+        t.share_memory_()
+        n_shared, n_bytes = n_shared + 1, n_bytes + t.numel() * t.element_size()
+
+    return n_shared, n_bytes
+
+'''
+    memory written by this process only (kB in /proc/self/smaps_rollup, Linux >= 4.14), the
+    pages shared with the launcher are not counted
+'''
+def private_mb():
+
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            return sum(int(l.split()[1]) for l in f if l.startswith('Private_')) / 1024.
+    except IOError: return None
+
+def tokens2ids(src_vocab, sent):
+
+    sent = sent.strip()
+    if wargs.src_char is True: sent = ' '.join(zh_to_chars(sent))
+
+    return src_vocab.keys2idx(sent.split(), UNK_WORD)
+
+'''
+    translate a list of source id lists, sorted by length and decoded batch_size sentences
+    together by the batched beam search (one by one for the other searches), in input order
+'''
+def translate_ids(tor, sents, batch_size=None):
+
+    trans = [''] * len(sents)
+    todo = sorted([i for i in range(len(sents)) if len(sents[i]) > 0], key=lambda i: len(sents[i]))
+    if tor.batch_search is False: batch_size = 1
+    elif batch_size is None: batch_size = len(todo)
+    for start in range(0, len(todo), batch_size):
+        batch = todo[start : start + batch_size]
+        if len(batch) > 1:
+            max_len = len(sents[batch[-1]])
+            xs_BL = tc.tensor([sents[i] + [PAD] * (max_len - len(sents[i])) for i in batch]).long()
+            results = tor.trans_batch(xs_BL, xs_BL.ne(PAD).float())
+        else: results = [tor.trans_onesent(tc.tensor(sents[batch[0]]).long().unsqueeze(0))]
+        for i, (tran, _, _) in zip(batch, results): trans[i] = tran
+    if wargs.with_bpe is True: trans = [re.sub('(@@ )|(@@ ?$)', '', tran) for tran in trans]
+
+    return trans
+
+'''
+    decoding process: takes (task id, source lines) from tasks until None, puts (task id,
+    translations, error) into results
+'''
+def worker(wid, tor, src_vocab, threads, batch_size, tasks, results):
+
+    tc.set_num_threads(threads)
+    n_lines, start = 0, time.time()
+    for tid, lines in iter(tasks.get, None):
+        try:
+            trans = translate_ids(tor, [tokens2ids(src_vocab, line) for line in lines], batch_size)
+            results.put((tid, trans, None))
+        except Exception as e:
+            results.put((tid, None, '{}: {}'.format(type(e).__name__, e)))
+        n_lines += len(lines)
+    mem = private_mb()
+    wlog('Worker {}: {} lines in {:.1f}s, private memory {}'.format(wid, n_lines, time.time() - start,
+        'unknown' if mem is None else '{:.1f}MB'.format(mem)))
+
+'''
+    n_workers forked decoding processes with threads intra-op threads each, they share the
+    weights of the translator: set up the model (share_weights) before creating the pool
+'''
+class TransPool(object):
+
+    def __init__(self, tor, src_vocab, n_workers, threads, batch_size=None):
+
+        self.tasks, self.results = multiprocessing.Queue(), multiprocessing.Queue()
+        self.workers = [multiprocessing.Process(target=worker, args=(wid, tor, src_vocab, threads,
+                        batch_size, self.tasks, self.results)) for wid in range(n_workers)]
+        for w in self.workers:
+            w.daemon = True
+            w.start()
+        wlog('Start {} translation workers, {} threads each'.format(n_workers, threads))
+
+    def _get(self):
+
+        while True:
+            try: tid, trans, error = self.results.get(timeout=1.)
+            except Queue.Empty:
+                dead = [w.pid for w in self.workers if w.exitcode is not None]
+                if len(dead) > 0: raise RuntimeError('translation workers {} exited'.format(dead))
+                continue
+            if error is not None: raise RuntimeError('task {} failed: {}'.format(tid, error))
+            return tid, trans
+
+    '''
+        translate the chunks (lists of source lines) and yield (chunk index, translations) as
+        they are finished, at most 2 chunks per worker are queued
+    '''
+    def imap_unordered(self, chunks):
+
+        chunks, n_put, n_done, exhausted = iter(chunks), 0, 0, False
+        while True:
+            while exhausted is False and n_put - n_done < 2 * len(self.workers):
+                chunk = next(chunks, None)
+                if chunk is None: exhausted = True
+                else:
+                    self.tasks.put((n_put, chunk))
+                    n_put += 1
+            if n_done == n_put: break
+            yield self._get()
+            n_done += 1
+
+    '''
+        translations of the chunks in the order of the chunks
+    '''
+    def imap(self, chunks):
+
+        finished, next_tid = {}, 0
+        for tid, trans in self.imap_unordered(chunks):
+            finished[tid] = trans
+            while next_tid in finished:
+                yield finished.pop(next_tid)
+                next_tid += 1
+
+    def close(self):
+
+        for _ in self.workers: self.tasks.put(None)
+        for w in self.workers: w.join()
+
+def read_chunks(f, n):
+
+    chunk = []
+    for line in f:
+        chunk.append(line)
+        if len(chunk) == n:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0: yield chunk
+
+def write_lines(fname, lines):
+
+    with open('{}.tmp'.format(fname), 'w') as f: f.write(''.join('{}\n'.format(l) for l in lines))
+    os.rename('{}.tmp'.format(fname), fname)
+
+def read_lines(fname):
+
+    with open(fname, 'r') as f: return f.read().split('\n')[:-1]
+
+def shard_file(shard_dir, k):
+
+    return os.path.join(shard_dir, 'shard.{}'.format(k))
+
+'''
+    split the lines into shards of shard_size lines of similar lengths, return the lists of
+    line indices, the shortest shard first
+'''
+def length_shards(lines, shard_size):
+
+    order = sorted(range(len(lines)), key=lambda i: len(lines[i].split()))
+
+    return [order[start : start + shard_size] for start in range(0, len(order), shard_size)]
+
+'''
+    the translated shards of output_file are kept in output_file.shards/ until they are merged,
+    they are reused only if the input, the sharding, the model and the search are unchanged
+'''
+def open_shard_dir(input_file, output_file, model_file, shard_size):
+
+    shard_dir = '{}.shards'.format(output_file)
+    plan = { 'input': os.path.realpath(input_file), 'model': os.path.realpath(model_file),
+             'shard_size': shard_size, 'search_mode': wargs.search_mode, 'beam_size': wargs.beam_size,
+             'len_norm': wargs.len_norm, 'alpha_len_norm': wargs.alpha_len_norm }
+    for k, fname in (('input', input_file), ('model', model_file)):
+        plan['{}_size'.format(k)], plan['{}_mtime'.format(k)] = \
+                os.path.getsize(fname), int(os.path.getmtime(fname))
+    plan_file = os.path.join(shard_dir, 'plan.json')
+    if os.path.exists(shard_dir):
+        if os.path.exists(plan_file) and json.loads(open(plan_file).read()) == plan: return shard_dir
+        wlog('{} is of another input, model or search, translate again'.format(shard_dir))
+        shutil.rmtree(shard_dir)
+    os.makedirs(shard_dir)
+    write_lines(plan_file, [json.dumps(plan, sort_keys=True)])
+
+    return shard_dir
+
+'''
+    translate input_file by the pool shard by shard, the longest shards are queued first. Each
+    finished shard is saved, a killed job resumes from the saved shards. The shards are merged
+    into output_file in the order of the input lines
+'''
+def translate_file(pool, input_file, output_file, model_file, shard_size):
+
+    lines = [line.rstrip('\n') for line in open(input_file, 'r')]
+    shards = length_shards(lines, shard_size)
+    shard_dir = open_shard_dir(input_file, output_file, model_file, shard_size)
+    todo = [k for k in range(len(shards)) if not os.path.exists(shard_file(shard_dir, k))][::-1]
+    wlog('Translate {}: {} lines in {} shards, {} translated before'.format(
+        input_file, len(lines), len(shards), len(shards) - len(todo)))
+
+    n_done, n_lines, start = len(shards) - len(todo), 0, time.time()
+    for tid, trans in pool.imap_unordered([lines[i] for i in shards[k]] for k in todo):
+        write_lines(shard_file(shard_dir, todo[tid]), trans)
+        n_done, n_lines = n_done + 1, n_lines + len(trans)
+        wlog('Shard {} done ({} lines), {}/{} shards, {:.2f} lines/s'.format(todo[tid], len(trans),
+            n_done, len(shards), n_lines / (time.time() - start)))
+
+    trans = [None] * len(lines)
+    for k, idxs in enumerate(shards):
+        shard_trans = read_lines(shard_file(shard_dir, k))
+        assert len(shard_trans) == len(idxs), 'broken shard {}'.format(shard_file(shard_dir, k))
+        for i, tran in zip(idxs, shard_trans): trans[i] = tran
+    write_lines(output_file, trans)
+    shutil.rmtree(shard_dir)
+    wlog('Merge {} shards into {}'.format(len(shards), output_file))
+
+'''
+    stream: translate tokenized lines from a file or stdin in chunks, written in input order
+    translate-file: translate a file by length-sorted shards, resumable, see translate_file
+    both by several processes sharing the weights of one model
+'''
+if __name__ == '__main__':
+
+    A = argparse.ArgumentParser(prog='Multi-process NMT translator')
+    A.add_argument('mode', nargs='?', default='stream', choices=('stream', 'translate-file'),
+                   help='stream: lines in chunks, translate-file: a file by resumable shards')
+    A.add_argument('-m', '--model-file', dest='model_file', default=wargs.best_model,
+                   help='model file or model bundle (tools/bundle.py)')
+    A.add_argument('--ema', dest='ema', action='store_true',
+                   help='decode with the moving average of weights saved in the model file')
+    A.add_argument('--int8', dest='int8', action='store_true',
+                   help='quantize the linear layers into int8 for CPU inference')
+    A.add_argument('--jit', dest='jit', action='store_true',
+                   help='decode by the traced encoder and one-step decoder graphs (torch >= 1.0)')
+    A.add_argument('-i', '--input-file', dest='input_file', default=None, help='source lines, stdin if not set')
+    A.add_argument('-o', '--output-file', dest='output_file', default=None,
+                   help='stdout if not set, input file.trans for translate-file')
+    A.add_argument('-w', '--workers', dest='workers', type=int, default=wargs.mtrans_workers,
+                   help='number of decoding processes, 0: one per 4 cores')
+    A.add_argument('--threads', dest='threads', type=int, default=0,
+                   help='intra-op threads of each worker, 0: cores / workers')
+    A.add_argument('--chunk', dest='chunk', type=int, default=wargs.mtrans_chunk,
+                   help='lines of one task, decoded together by the batched beam search')
+    A.add_argument('--shard-size', dest='shard_size', type=int, default=wargs.mtrans_shard,
+                   help='translate-file: lines of one shard, decoded in batches of --chunk lines')
+    args = A.parse_args()
+    if args.mode == 'translate-file':
+        assert args.input_file is not None, 'translate-file needs the input file: -i'
+        if args.output_file is None: args.output_file = '{}.trans'.format(args.input_file)
+
+    if args.jit is True: wargs.jit_trace = True
+    n_cores = multiprocessing.cpu_count()
+    n_workers = args.workers if args.workers > 0 else max(1, n_cores // 4)
+    threads = args.threads if args.threads > 0 else max(1, n_cores // n_workers)
+    # the OpenMP threads of the launcher would not survive the fork, it decodes with one
+    tc.set_num_threads(1)
+
+    model, src_vocab, trg_vocab, mapped = load(args.model_file, ema=args.ema, int8=args.int8)
+    n_shared, n_bytes = share_weights(model, mapped)
+    wlog('Share {} weight tensors ({:.1f}MB) in memory, {} mapped from the bundle'.format(
+        n_shared, n_bytes / 2**20, len(mapped)))
+    tor = Translator(model, src_vocab.idx2key, trg_vocab.idx2key)
+    dec_conf()
+    # the lazily prepared weights (int8 layers, traced graphs) are made once before the fork
+    tor.trans_onesent(tc.arange(NUM_RESERVED_TOKENS, NUM_RESERVED_TOKENS + 5).long()[None, :])
+
+    pool = TransPool(tor, src_vocab, n_workers, threads, batch_size=args.chunk)
+    if args.mode == 'translate-file':
+        translate_file(pool, args.input_file, args.output_file, args.model_file, args.shard_size)
+        pool.close()
+        sys.exit(0)
+
+    fin = sys.stdin if args.input_file is None else open(args.input_file, 'r')
+    fout = sys.stdout if args.output_file is None else open(args.output_file, 'w')
+    n_lines, start = 0, time.time()
+    for trans in pool.imap(read_chunks(fin, args.chunk)):
+        fout.write(''.join('{}\n'.format(tran) for tran in trans))
+        n_lines += len(trans)
+    fout.flush()
+    pool.close()
+    if fin is not sys.stdin: fin.close()
+    if fout is not sys.stdout: fout.close()
+    wlog('Translate {} lines in {:.1f}s, {:.2f} lines/s'.format(
+        n_lines, time.time() - start, n_lines / max(time.time() - start, 1e-6)))
@@ -0,0 +1,68 @@
+from __future__ import division
+
+import os
+import sys
+import copy
+import time
+import argparse
+import torch as tc
+sys.path.append(os.getcwd())
+
+import wargs
+wargs.gpu_id = None     # the int8 GEMM runs on CPU, set before the other modules read it
+from tools.utils import load_model, wlog, dec_conf, init_dir
+from tools.inputs_handler import *
+from tools.quantize import quantize_model, load_weights
+from models.model_builder import build_model
+from translate import Translator
+
+'''
+    decode the validation set with the float model and its int8 quantization on CPU, report
+    the BLEU delta and the speedup, and save the int8 model if asked
+'''
+if __name__ == '__main__':
+
+    A = argparse.ArgumentParser(prog='Compare int8 quantized decoding with float decoding')
+    A.add_argument('-m', '--model-file', dest='model_file', default=wargs.best_model, help='model file')
+    A.add_argument('--ema', dest='ema', action='store_true',
+                   help='decode with the moving average of weights saved in the model file')
+    A.add_argument('-o', '--save-int8', dest='save_int8', default=None,
+                   help='save the int8 quantized model into this file')
+    A.add_argument('--threads', dest='threads', type=int, default=None, help='torch threads')
+    args = A.parse_args()
+
+    if args.threads is not None: tc.set_num_threads(args.threads)
+    src_vocab = extract_vocab(None, wargs.src_vcb)
+    trg_vocab = extract_vocab(None, wargs.trg_vcb)
+    if wargs.binarize is True: wrap_data_fn, wrap_tst_data_fn = wrap_bin_data, wrap_bin_tst_data
+    else: wrap_data_fn, wrap_tst_data_fn = wrap_data, wrap_tst_data
+    valid_data, _ = prepare_valid_tests(src_vocab, trg_vocab, wrap_data_fn, wrap_tst_data_fn)
+    assert valid_data is not None, 'need the validation set: wargs.val_prefix'
+
+    _dict = load_model(args.model_file, ema=args.ema)
+    model_dict, eid, bid = _dict[0], _dict[-3], _dict[-2]
+    model = load_weights(build_model(src_vocab.size(), trg_vocab.size()), model_dict)
+    model.eval()
+    models = [('fp32', model), ('int8', quantize_model(copy.deepcopy(model)))]
+    dec_conf()
+
+    init_dir(wargs.dir_valid)
+    results = []
+    for name, nmtModel in models:
+        tor = Translator(nmtModel, src_vocab.idx2key, trg_vocab.idx2key)
+        start = time.time()
+        trans, alns = tor.single_trans_file(valid_data)
+        spend = time.time() - start
+        out_fname = '{}/trans_{}_e{}_upd{}'.format(wargs.dir_valid, name, eid, bid)
+        results.append((name, tor.write_file_eval(out_fname, trans, wargs.val_prefix, alns), spend))
+
+    (_, fp32_bleu, fp32_spend), (_, int8_bleu, int8_spend) = results
+    for name, bleu, spend in results:
+        wlog('{}: BLEU {:.2f}, decoding {:.2f}s'.format(name, bleu, spend))
+    wlog('int8 - fp32: BLEU {:+.2f}, speedup {:.2f}x'.format(int8_bleu - fp32_bleu, fp32_spend / int8_spend))
+
+    if args.save_int8 is not None:
+        tc.save({ 'model': models[1][1].state_dict(), 'epoch': eid, 'batch': bid, 'optim': None },
+                args.save_int8)
+        wlog('Save int8 model into {} ({:.1f}MB, float {:.1f}MB)'.format(args.save_int8,
+            os.path.getsize(args.save_int8) / 2**20, os.path.getsize(args.model_file) / 2**20))
@@ -0,0 +1,258 @@
+# coding=utf-8
+from __future__ import division
+
+import os
+import re
+import sys
+import json
+import time
+import Queue
+import numpy
+import argparse
+import threading
+import collections
+import SocketServer
+import BaseHTTPServer
+import torch as tc
+sys.path.append(os.getcwd())
+
+import wargs
+from tools.utils import load_model, wlog, dec_conf, PAD, UNK_WORD
+from tools.inputs_handler import extract_vocab
+from tools.bleu import zh_to_chars
+from models.model_builder import build_model
+from translate import Translator
+from tools.trans_cache import TransCache
+from tools.quantize import load_weights
+from tools.bundle import is_bundle, load_bundle_model
+
+'''
+    load the vocabularies and the model once, return the translator and the source vocabulary
+'''
+def load_translator(model_file, ema=False, int8=False):
+
+    if is_bundle(model_file):
+        nmtModel, src_vocab, trg_vocab, _ = load_bundle_model(model_file, build_model, int8=int8)
+    else:
+        wlog('Starting load vocabularies ... ')
+        assert os.path.exists(wargs.src_vcb) and os.path.exists(wargs.trg_vcb), 'need vocabulary ...'
+        src_vocab = extract_vocab(None, wargs.src_vcb)
+        trg_vocab = extract_vocab(None, wargs.trg_vcb)
+        wlog('Vocabulary size: |source|={}, |target|={}'.format(src_vocab.size(), trg_vocab.size()))
+
+        model_dict = load_model(model_file, ema=ema)[0]
+        nmtModel = build_model(src_vocab.size(), trg_vocab.size())
+        load_weights(nmtModel, model_dict, int8=int8)
+    nmtModel.eval()
+    wlog('\nFinish to load model.')
+    dec_conf()
+
+    tor = Translator(nmtModel, src_vocab.idx2key, trg_vocab.idx2key)
+    if wargs.trans_cache_size > 0: tor.set_cache(TransCache(wargs.trans_cache_size, wargs.trans_cache_db))
+
+    return tor, src_vocab
+
+class TransRequest(object):
+
+    def __init__(self, ids):
+
+        self.ids, self.arrival = ids, time.time()
+        self.trans, self.error = None, None
+        self.done = threading.Event()
+
+'''
+    translation service: sentences are queued, a decoding thread takes the first waiting one,
+    waits at most max_wait_ms for max_batch sentences, sorts them by length and decodes them
+    together with the batched beam search (one by one for the other searches)
+'''
+class TransServer(object):
+
+    def __init__(self, tor, src_vocab, max_batch=None, max_wait_ms=None, report_every=100):
+
+        self.tor, self.src_vocab = tor, src_vocab
+        self.max_batch = max_batch if max_batch else wargs.server_max_batch
+        if tor.batch_search is False: self.max_batch = 1
+        self.max_wait = (max_wait_ms if max_wait_ms is not None else wargs.server_max_wait_ms) / 1000.
+        self.report_every = report_every
+
+        self.requests = Queue.Queue()
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=10000)    # seconds of the recent sentences
+        self.n_sents, self.n_batches, self.decode_spend = 0, 0, 0.
+        self.start = time.time()
+
+        decoder = threading.Thread(target=self._serve)
+        decoder.daemon = True
+        decoder.start()
+        wlog('Translation server: max batch {}, max wait {}ms'.format(
+            self.max_batch, self.max_wait * 1000))
+
+    def _collect(self):
+
+        batch = [self.requests.get()]
+        deadline = batch[0].arrival + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.time()
+            try:
+                # the budget of the first sentence may be spent while the last batch was decoded,
+                # then only the sentences already waiting are taken
+                if timeout > 0: batch.append(self.requests.get(timeout=timeout))
+                else: batch.append(self.requests.get_nowait())
+            except Queue.Empty: break
+
+        return sorted(batch, key=lambda r: len(r.ids))
+
+    def _decode(self, batch):
+
+        if len(batch) > 1:
+            max_len = len(batch[-1].ids)
+            xs_BL = tc.tensor([r.ids + [PAD] * (max_len - len(r.ids)) for r in batch]).long()
+            results = self.tor.trans_batch(xs_BL, xs_BL.ne(PAD).float())
+        else:
+            results = [self.tor.trans_onesent(tc.tensor(batch[0].ids).long().unsqueeze(0))]
+
+        for r, (trans, ids, _) in zip(batch, results):
+            if wargs.with_bpe is True: trans = re.sub('(@@ )|(@@ ?$)', '', trans)
+            r.trans = trans
+
+    def _serve(self):
+
+        while True:
+            batch = self._collect()
+            decode_start = time.time()
+            try: self._decode(batch)
+            except Exception as e:
+                wlog('Failed to translate a batch of {} sentences: {}'.format(len(batch), e))
+                for r in batch: r.error = e
+            finish = time.time()
+            with self.lock:
+                self.n_sents += len(batch)
+                self.n_batches += 1
+                self.decode_spend += finish - decode_start
+                self.latencies.extend(finish - r.arrival for r in batch)
+            for r in batch: r.done.set()
+            if self.n_batches % self.report_every == 0: self.log_stats()
+
+    def submit(self, ids):
+
+        req = TransRequest(ids)
+        if len(ids) == 0:
+            req.trans = ''
+            req.done.set()
+        else: self.requests.put(req)
+
+        return req
+
+    def tokens2ids(self, sent):
+
+        sent = sent.strip()
+        if wargs.src_char is True: sent = ' '.join(zh_to_chars(sent))
+
+        return self.src_vocab.keys2idx(sent.split(), UNK_WORD)
+
+    '''
+        in-process client: translate a list of tokenized sentences, all of them are queued
+        before waiting, so they can be decoded in the same batches
+    '''
+    def translate_sents(self, sents):
+
+        reqs = [self.submit(self.tokens2ids(sent)) for sent in sents]
+        for r in reqs:
+            r.done.wait()
+            if r.error is not None: raise r.error
+
+        return [r.trans for r in reqs]
+
+    def translate(self, sent):
+
+        return self.translate_sents([sent])[0]
+
+    def stats(self):
+
+        with self.lock:
+            lats = numpy.asarray(self.latencies)
+            n_sents, n_batches, decode_spend = self.n_sents, self.n_batches, self.decode_spend
+        p50, p99 = numpy.percentile(lats, [50, 99]) * 1000 if len(lats) > 0 else (0., 0.)
+
+        return { 'sents': n_sents, 'batches': n_batches,
+                 'avg_batch': n_sents / n_batches if n_batches > 0 else 0.,
+                 'sents_per_sec': n_sents / (time.time() - self.start),
+                 'decode_sents_per_sec': n_sents / decode_spend if decode_spend > 0 else 0.,
+                 'p50_ms': p50, 'p99_ms': p99 }
+
+    def log_stats(self):
+
+        s = self.stats()
+        if self.tor.cache is not None: wlog('Translation cache: {}'.format(self.tor.cache))
+        wlog('Served {} sentences in {} batches (avg. {:.1f}), {:.2f} sents/s ({:.2f} decoding), '
+             'latency p50 {:.1f}ms p99 {:.1f}ms'.format(s['sents'], s['batches'], s['avg_batch'],
+                s['sents_per_sec'], s['decode_sents_per_sec'], s['p50_ms'], s['p99_ms']))
+
+'''
+    POST /translate {"src": sentence or [sentences]} -> {"trans": ...}, GET /stats
+'''
+class TransHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def _reply(self, code, obj):
+
+        body = json.dumps(obj)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+
+        if self.path != '/stats': return self.send_error(404)
+        self._reply(200, self.server.trans_server.stats())
+
+    def do_POST(self):
+
+        if self.path != '/translate': return self.send_error(404)
+        try:
+            src = json.loads(self.rfile.read(int(self.headers.getheader('Content-Length', 0))))['src']
+        except (ValueError, KeyError, TypeError):
+            return self._reply(400, {'error': 'expect json {"src": sentence or [sentences]}'})
+        try:
+            if isinstance(src, list): trans = self.server.trans_server.translate_sents(src)
+            else: trans = self.server.trans_server.translate(src)
+        except Exception as e:
+            return self._reply(500, {'error': str(e)})
+        self._reply(200, {'trans': trans})
+
+    def log_message(self, format, *args):
+        pass
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+if __name__ == '__main__':
+
+    A = argparse.ArgumentParser(prog='NMT translation server ... ')
+    A.add_argument('-m', '--model-file', dest='model_file', default=wargs.best_model, help='model file')
+    A.add_argument('--ema', dest='ema', action='store_true',
+                   help='decode with the moving average of weights saved in the model file')
+    A.add_argument('--int8', dest='int8', action='store_true',
+                   help='quantize the linear layers into int8 for CPU inference')
+    A.add_argument('--jit', dest='jit', action='store_true',
+                   help='decode by the traced encoder and one-step decoder graphs (torch >= 1.0)')
+    A.add_argument('--host', dest='host', default='127.0.0.1', help='address to listen on')
+    A.add_argument('-p', '--port', dest='port', type=int, default=wargs.server_port, help='port')
+    A.add_argument('--max-batch', dest='max_batch', type=int, default=wargs.server_max_batch,
+                   help='max number of sentences decoded together')
+    A.add_argument('--max-wait-ms', dest='max_wait_ms', type=float, default=wargs.server_max_wait_ms,
+                   help='max time a sentence waits for its batch to fill up')
+    args = A.parse_args()
+
+    if args.jit is True: wargs.jit_trace = True
+    tor, src_vocab = load_translator(args.model_file, ema=args.ema, int8=args.int8)
+    trans_server = TransServer(tor, src_vocab, args.max_batch, args.max_wait_ms)
+    httpd = ThreadingHTTPServer((args.host, args.port), TransHandler)
+    httpd.trans_server = trans_server
+    wlog('Serving on http://{}:{}/translate'.format(args.host, args.port))
+    try: httpd.serve_forever()
+    except KeyboardInterrupt: pass
+    trans_server.log_stats()
+    if tor.cache is not None: tor.cache.close()
@@ -3,8 +3,11 @@ from __future__ import division
 import os
 import sys
 import math
+import json
 import time
+import Queue
 import random
+import threading
 import subprocess
 
 import numpy as np
@@ -12,8 +15,58 @@ import torch as tc
 
 import wargs
 from tools.utils import *
+from tools.inputs import Prefetcher
+from tools.distributed import any_rank
+from tools.checkpoint import CheckpointWriter, failed_marker
+from tools.metrics import PhaseTimer, MetricsLogger, peak_rss_mb
 from searchs.nbs import Nbs
-from translate import Translator
+from translate import Translator, record_valid_bleu
+
+'''
+    evaluation in a background process (bin/evaluator.py): the trainer hands over the weight
+    snapshot saved for each validation and collects the BLEU scores when they arrive
+'''
+class EvalWorker(object):
+
+    def __init__(self):
+
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'evaluator.py')
+        self.proc = subprocess.Popen([sys.executable, script], stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE)
+        self.results, self.n_pending = Queue.Queue(), 0
+        reader = threading.Thread(target=self._read)
+        reader.daemon = True
+        reader.start()
+        wlog('Start evaluation worker {}'.format(self.proc.pid))
+
+    def _read(self):
+
+        for line in iter(self.proc.stdout.readline, ''): self.results.put(json.loads(line))
+        self.results.put(None)  # the worker exits
+
+    def submit(self, model_file, eid, bid):
+
+        self.proc.stdin.write(json.dumps({'model_file': model_file, 'epoch': eid, 'batch': bid}) + '\n')
+        self.proc.stdin.flush()
+        self.n_pending += 1
+
+    '''
+        generate the results arrived, wait for all the pending ones if block
+    '''
+    def poll(self, block=False):
+
+        while self.n_pending > 0:
+            try: result = self.results.get(block=block)
+            except Queue.Empty: return
+            if result is None:
+                raise RuntimeError('evaluation worker exits with code {}'.format(self.proc.wait()))
+            self.n_pending -= 1
+            yield result
+
+    def close(self):
+
+        self.proc.stdin.close()
+        self.proc.wait()
 
 class Trainer(object):
 
@@ -29,6 +82,7 @@ class Trainer(object):
         self.n_look = wargs.n_look
         assert self.n_look <= wargs.batch_size, 'eyeball count > batch size'
         self.n_batches = len(train_data)    # [low, high)
+        self.loader = Prefetcher(train_data, wargs.n_prefetch)
 
         self.look_xs, self.look_ys = None, None
         if wargs.fix_looking is True:
@@ -39,12 +93,25 @@ class Trainer(object):
         self.look_tor = Translator(self.model, self.sv, self.tv)
         self.n_eval = 1
         self.tor = Translator(self.model, self.sv, self.tv, print_att=wargs.print_att)
+        self.evaluator, self.stop_request, self.stop_training = None, False, False
+        # in distributed training, rank 0 looks at samples, evaluates and saves models
+        self.rank, self.world_size = wargs.dist_rank, wargs.dist_world_size
+        if wargs.async_eval is True and valid_data is not None and self.rank == 0:
+            self.evaluator = EvalWorker()
+        self.ckpt_writer = CheckpointWriter()
+        # wall time of each phase of the training steps, reported at display steps
+        self.timer, self.metrics = PhaseTimer(sync=wargs.metrics_sync), None
+        if wargs.metrics_jsonl is not None:
+            if self.rank == 0: self.metrics = MetricsLogger(wargs.metrics_jsonl, wargs.metrics_prom)
+            else: self.metrics = MetricsLogger('{}.rank{}'.format(wargs.metrics_jsonl, self.rank))
 
         self.snip_size, self.trunc_size = wargs.snip_size, wargs.trunc_size
         self.grad_accum_count = wargs.grad_accum_count
 
         self.epoch_shuffle_train = wargs.epoch_shuffle_train
         self.epoch_shuffle_batch = wargs.epoch_shuffle_batch
+        # the shuffling is the same on all ranks, each rank then reads its own shard
+        self.shuffle_rng = np.random.RandomState(1111)
         self.ss_cur_prob = wargs.ss_prob_begin
         if wargs.ss_type is not None:
             wlog('word-level optimizing bias between training and decoding ...')
@@ -75,7 +142,9 @@ class Trainer(object):
         if self.grad_accum_count > 1:
             self.model.zero_grad()
 
-        for batch in real_batches:
+        # the gradients are all-reduced while the last backward of the update is running
+        reducer = getattr(self.optim, 'grad_reducer', None)
+        for b_i, batch in enumerate(real_batches):
 
             # (batch_size, max_slen_batch)
             _, xs, y_for_files, bows, x_lens, xs_mask, y_mask_for_files, bows_mask = batch
@@ -89,6 +158,9 @@ class Trainer(object):
             _xtoks = xs.data.ne(PAD).sum().item()
             assert _xtoks == x_lens.data.sum().item()
             _ytoks = ys[1:].data.ne(PAD).sum().item()
+            self.look_slots += xs.numel() + ys.numel()
+            # on device as the other look metrics, read only when they are reported
+            self.look_toks = self.look_toks + ys.data.ne(PAD).sum() + _xtoks
 
             ys_len = ys.size(1)
             # Truncated BPTT
@@ -101,23 +173,27 @@ class Trainer(object):
                 # 2. F-prop all but generator.
                 if self.grad_accum_count == 1: self.model.zero_grad()
                 # exclude last target word from inputs
-                results = self.model(xs, part_ys[:, :-1], xs_mask, part_ys_mask[:, :-1], self.ss_cur_prob)
+                with self.timer.phase('forward'):
+                    results = self.model(xs, part_ys[:, :-1], xs_mask, part_ys_mask[:, :-1], self.ss_cur_prob)
                 logits, alphas, contexts = results['logit'], results['attend'], results['context']
                 # (batch_size, y_Lm1, out_size)
 
                 gold, gold_mask = part_ys[:, 1:].contiguous(), part_ys_mask[:, 1:].contiguous()
                 # 3. Compute loss in shards for memory efficiency.
-                _nll, _ok_ytoks, _logZ = self.classifier.snip_back_prop(
-                    logits, gold, gold_mask, bows, bows_mask, epo, self.snip_size, contexts)
+                last = b_i == len(real_batches) - 1 and j + trunc_size >= ys_len - 1
+                with self.timer.phase('loss_backward'):
+                    _nll, _ok_ytoks, _logZ = self.classifier.snip_back_prop(
+                        logits, gold, gold_mask, bows, bows_mask, epo, self.snip_size, contexts,
+                        reducer.prepare if reducer is not None and last else None)
 
             self.accum_matrics(_batch_size, _xtoks, _ytoks, _nll, _ok_ytoks, _logZ)
         # 3. Update the parameters and statistics.
-        self.optim.step()
+        with self.timer.phase('optim'): self.optim.step()
         #tc.cuda.empty_cache()
 
     def look_samples(self, bidx):
 
-        if bidx % wargs.look_freq == 0:
+        if bidx % wargs.look_freq == 0 and self.rank == 0:
 
             look_start = time.time()
             self.model.eval()   # affect the dropout !!!
@@ -136,7 +212,7 @@ class Trainer(object):
     def try_valid(self, epo, e_bidx, n_steps):
 
         if wargs.epoch_eval is not True and n_steps > wargs.eval_valid_from and \
-           n_steps % wargs.eval_valid_freq == 0:
+           n_steps % wargs.eval_valid_freq == 0 and self.rank == 0:
             eval_start = time.time()
             wlog('\nAmong epoch, batch [{}], {}-th validation ...'.format(e_bidx, self.n_eval))
             self.mt_eval(epo, e_bidx)
@@ -144,18 +220,65 @@ class Trainer(object):
 
     def mt_eval(self, eid, bid):
 
-        state_dict = { 'model': self.model.state_dict(), 'epoch': eid, 'batch': bid, 'optim': self.optim }
-
-        if wargs.save_one_model: model_file = '{}.pt'.format(wargs.model_prefix)
+        # the snapshot of an asynchronous evaluation is kept until its result arrives
+        if wargs.save_one_model and self.evaluator is None: model_file = '{}.pt'.format(wargs.model_prefix)
         else: model_file = '{}_e{}_upd{}.pt'.format(wargs.model_prefix, eid, bid)
-        tc.save(state_dict, model_file)
+        self.ckpt_writer.save(self.model, self.optim, eid, bid, model_file)
         wlog('Saving temporary model in {}'.format(model_file))
 
+        if self.evaluator is not None:
+            self.evaluator.submit(model_file, eid, bid)
+            wlog('Hand {} over to the evaluation worker'.format(model_file))
+            self.n_eval += 1
+            return
+
+        self.ckpt_writer.wait()
         self.model.eval()
-        self.tor.trans_eval(self.valid_data, eid, bid, model_file, self.tests_data)
+        # only rank 0 evaluates, the ranks stop together through stop_request
+        self.tor.trans_eval(self.valid_data, eid, bid, model_file, self.tests_data, exit_worse=False)
+        if wargs.worse_counter >= 8.: self.stop_request = True
         self.model.train()
         self.n_eval += 1
 
+    '''
+        best-model bookkeeping for the evaluation results which have arrived
+    '''
+    def collect_evals(self, block=False):
+
+        for result in self.evaluator.poll(block):
+            model_file, eid, bid = result['model_file'], result['epoch'], result['batch']
+            if 'error' in result:
+                wlog('\nSkip the validation of epoch [{}], batch [{}], failed to save {}: {}'.format(
+                    eid, bid, model_file, result['error']))
+                if os.path.exists(failed_marker(model_file)): os.remove(failed_marker(model_file))
+                continue
+            wlog('\nValidation of epoch [{}], batch [{}] from the evaluation worker: {}'.format(
+                eid, bid, result['bleu']))
+            record_valid_bleu(result['bleu'], eid, bid, model_file)
+            if wargs.worse_counter >= 8.:
+                wlog('{} consecutive worses, finish training.'.format(wargs.worse_counter))
+                self.stop_request = True
+            if wargs.save_one_model and os.path.exists(model_file) is True:
+                os.remove(model_file)
+                wlog('Saving one model, so delete {}\n'.format(model_file))
+
+    '''
+        per-phase time, tokens, padding and memory of the steps since the last display
+    '''
+    def report_metrics(self, epo, n_steps, ud, n_batches, look_nll):
+
+        wlog('Phases: {}'.format(self.timer))
+        phases = self.timer.reset()
+        if self.metrics is None: return
+        look_toks = float(self.look_toks)
+        self.metrics.write({
+            'time': time.time(), 'rank': self.rank, 'epoch': epo, 'step': n_steps,
+            'lr': self.optim.learning_rate, 'nll': look_nll / self.look_ytoks,
+            'ppl': math.exp(look_nll / self.look_ytoks), 'update_s': ud, 'phases_s': phases,
+            'batches': n_batches, 'sents': self.look_sents, 'xtoks': self.look_xtoks,
+            'ytoks': self.look_ytoks, 'tokens_per_batch': look_toks / max(n_batches, 1),
+            'pad_ratio': 1. - look_toks / max(self.look_slots, 1), 'peak_rss_mb': peak_rss_mb() })
+
     def train(self):
 
         wlog('start training ... ')
@@ -168,22 +291,30 @@ class Trainer(object):
 
             wlog('\n{} Epoch [{}/{}] {}'.format('$'*30, epo, self.max_epochs, '$'*30))
             # shuffle the training data for each epoch
-            if self.epoch_shuffle_train: self.train_data.shuffle()
+            if self.epoch_shuffle_train: self.train_data.shuffle(self.shuffle_rng)
             self.e_nll, self.e_ytoks, self.e_ok_ytoks, self.e_batch_logZ, self.e_sents \
                     = 0, 0, 0, 0, 0
             self.look_nll, self.look_ytoks, self.look_ok_ytoks, self.look_batch_logZ, \
                     self.look_sents = 0, 0, 0, 0, 0
             self.look_xtoks, self.look_spend, b_counter, eval_spend = 0, 0, 0, 0
+            self.look_slots, self.look_toks, look_batches = 0, 0, 0
             epo_start = show_start = time.time()
-            if self.epoch_shuffle_batch: shuffled_bidx = tc.randperm(self.n_batches)
+            if self.epoch_shuffle_batch: shuffled_bidx = self.shuffle_rng.permutation(self.n_batches)
 
-            #for bidx in range(self.n_batches):
-            bidx = 0
             cond = True if wargs.lr_update_way != 'invsqrt' else self.optim.learning_rate > wargs.min_lr
-            while cond:
-                if self.train_data.eos() is True: break
+            if cond is False: continue
+            # the number of batches is known before the epoch (token batches are precomputed)
+            order = shuffled_bidx.tolist() if self.epoch_shuffle_batch else range(self.n_batches)
+            if self.world_size > 1:
+                # each rank reads a disjoint shard, all ranks run the same number of updates
+                n_shard = len(order) // self.world_size
+                order = order[self.rank::self.world_size][:n_shard]
+            # batches are built in background and pushed into GPU asynchronously
+            fetch_start = time.time()
+            for e_bidx, batch in self.loader.epoch(order):
+                self.timer.add('fetch', time.time() - fetch_start)
                 b_counter += 1
-                e_bidx = shuffled_bidx[bidx] if self.epoch_shuffle_batch else bidx
+                look_batches += 1
                 if wargs.ss_type is not None and self.ss_cur_prob < 1. and wargs.bleu_sampling:
                     batch_beam_trgs = self.sampler.beam_search_trans(xs, xs_mask, ys_mask)
                     batch_beam_trgs = [list(zip(*b)[0]) for b in batch_beam_trgs]
@@ -193,7 +324,6 @@ class Trainer(object):
                     batch_oracles = batch_oracles[:-1].cuda()
                     batch_oracles = self.model.decoder.trg_lookup_table(batch_oracles)
 
-                batch = self.train_data[e_bidx]
                 real_batches.append(batch)
                 accum_batches += 1
                 if accum_batches == self.grad_accum_count:
@@ -204,6 +334,9 @@ class Trainer(object):
                     grad_checker(self.model, _checks)
                     if current_steps % wargs.display_freq == 0:
                         #print self.look_ok_ytoks, self.look_nll, self.look_ytoks, self.look_nll/self.look_ytoks
+                        # the metrics are accumulated on device, synchronize only for display
+                        look_nll, look_ok_ytoks, look_logZ = float(self.look_nll), \
+                                float(self.look_ok_ytoks), float(self.look_batch_logZ)
                         ud = time.time() - show_start - self.look_spend - eval_spend
                         wlog(
                             'Epo:{:>2}/{:>2} |[{:^5}/{} {:^5}] |acc:{:5.2f}% |nll:{:4.2f}'
@@ -211,26 +344,39 @@ class Trainer(object):
                             ' |x(y)/s:{:>4}({:>4})/{}={}({}) |x(y)/sec:{}({}) |lr:{:7.6f}'
                             ' |{:4.2f}s/{:4.2f}m'.format(
                                 epo, self.max_epochs, b_counter, len(self.train_data), current_steps,
-                                (self.look_ok_ytoks / self.look_ytoks) * 100,
-                                self.look_nll / self.look_ytoks,
-                                math.exp(self.look_nll / self.look_ytoks),
-                                self.look_batch_logZ / self.look_ytoks,
-                                self.look_batch_logZ / self.look_sents, self.look_xtoks,
+                                (look_ok_ytoks / self.look_ytoks) * 100,
+                                look_nll / self.look_ytoks,
+                                math.exp(look_nll / self.look_ytoks),
+                                look_logZ / self.look_ytoks,
+                                look_logZ / self.look_sents, self.look_xtoks,
                                 self.look_ytoks, self.look_sents,
                                 int(round(self.look_xtoks / self.look_sents)),
                                 int(round(self.look_ytoks / self.look_sents)),
                                 int(round(self.look_xtoks / ud)), int(round(self.look_ytoks / ud)),
                                 self.optim.learning_rate, ud, (time.time() - train_start) / 60.)
                         )
+                        self.report_metrics(epo, current_steps, ud, look_batches, look_nll)
                         self.look_nll, self.look_xtoks, self.look_ytoks, self.look_ok_ytoks, \
                                 self.look_batch_logZ, self.look_sents = 0, 0, 0, 0, 0, 0
+                        self.look_slots, self.look_toks, look_batches = 0, 0, 0
                         self.look_spend, eval_spend = 0, 0
                         show_start = time.time()
 
-                    self.look_samples(current_steps)
-                    self.try_valid(epo, e_bidx, current_steps)
-                bidx += 1
-
+                    with self.timer.phase('look'): self.look_samples(current_steps)
+                    with self.timer.phase('valid'):
+                        self.try_valid(epo, e_bidx, current_steps)
+                        if self.evaluator is not None: self.collect_evals()
+                    # ranks agree on stopping at display steps
+                    if self.world_size == 1: self.stop_training = self.stop_request
+                    elif current_steps % wargs.display_freq == 0:
+                        self.stop_training = any_rank(self.stop_request)
+                    if self.stop_training is True: break
+                fetch_start = time.time()
+
+            if self.stop_training is True: break
+
+            self.e_nll, self.e_ok_ytoks = float(self.e_nll), float(self.e_ok_ytoks)
+            self.e_batch_logZ = float(self.e_batch_logZ)
             avg_epo_acc, avg_epo_nll = self.e_ok_ytoks/self.e_ytoks, self.e_nll/self.e_ytoks
             wlog('\nEnd epoch [{}]'.format(epo))
             wlog('avg. w-acc: {:4.2f}%, w-nll: {:4.2f}, w-ppl: {:4.2f}'.format(
@@ -238,14 +384,22 @@ class Trainer(object):
             wlog('avg. |w-logZ|: {:.2f}/{}={:.2f} |s-logZ|: {:.2f}/{}={:.2f}'.format(
                 self.e_batch_logZ, self.e_ytoks, self.e_batch_logZ / self.e_ytoks,
                 self.e_batch_logZ, self.e_sents, self.e_batch_logZ / self.e_sents))
-            if wargs.epoch_eval is True:
+            if wargs.epoch_eval is True and self.rank == 0:
                 wlog('\nEnd epoch, batch [{}], {}-th validation ...'.format(e_bidx, self.n_eval))
                 self.mt_eval(epo, e_bidx)
+            if self.world_size == 1: self.stop_training = self.stop_request
+            else: self.stop_training = any_rank(self.stop_request)
+            if self.stop_training is True: break
             # decay the probability value epslion of scheduled sampling per batch
             if wargs.ss_type is not None: self.ss_cur_prob = ss_prob_decay(epo)   # start from 1.
             epo_time_consume = time.time() - epo_start
             wlog('Consuming: {:4.2f}s'.format(epo_time_consume))
 
+        if self.evaluator is not None:
+            self.collect_evals(block=True)
+            self.evaluator.close()
+        self.ckpt_writer.close()
+        if self.metrics is not None: self.metrics.close()
         wlog('Finish training, comsuming {:6.2f} hours'.format((time.time() - train_start) / 3600))
         wlog('Congratulations!')
 
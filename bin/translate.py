@@ -10,14 +10,15 @@ import collections
 from shutil import copyfile
 
 import wargs
-if wargs.decoder_type in ('rnn', 'gru', 'tgru'): from searchs.nbs import *
-elif wargs.decoder_type == 'att': from searchs.nbs_t2t import *
+import searchs.nbs, searchs.nbs_t2t
 
 if wargs.search_mode == 2: from searchs.cp import *
 
 from tools.utils import *
-from tools.bleu import bleu_file
+from tools.bleu import bleu_file, file_stats
 from tools.multibleu import print_multi_bleu
+from tools.checkpoint import link_file
+from tools.trans_cache import TransCache, model_fingerprint
 import uniout
 
 numpy.set_printoptions(threshold=numpy.nan)
@@ -40,13 +41,47 @@ class Translator(object):
         self.search_mode = search_mode if search_mode else wargs.search_mode
 
         if self.search_mode == 0: self.greedy = Greedy(self.tvcb_i2w)
-        elif self.search_mode == 1: self.nbs = Nbs(model, self.tvcb_i2w, k=self.k,
-                                                   noise=self.noise, print_att=print_att)
+        elif self.search_mode == 1:
+            # picked here, the decoder type may be set by a model bundle after the import
+            Nbs = searchs.nbs_t2t.Nbs if wargs.decoder_type == 'att' else searchs.nbs.Nbs
+            self.nbs = Nbs(model, self.tvcb_i2w, k=self.k, noise=self.noise, print_att=print_att)
         elif self.search_mode == 2: self.wcp = Wcp(model, self.tvcb_i2w, k=self.k,
                                                    print_att=print_att)
+        # several sentences are decoded together only by the Transformer beam search
+        self.batch_search = self.search_mode == 1 and wargs.with_batch and not wargs.ori_search \
+                and wargs.decoder_type == 'att'
+        self.cache, self.cache_prefix = None, None
+
+    '''
+        cache the translations of the current weights and search settings, call it again after
+        the weights change
+    '''
+    def set_cache(self, cache):
+
+        self.cache = cache
+        if cache is not None:
+            self.cache_prefix = (model_fingerprint(self.model), self.search_mode, self.k, wargs.len_norm,
+                                 wargs.alpha_len_norm, wargs.beta_cover_penalty, wargs.vocab_norm)
+
+    def cache_key(self, s):
+
+        if isinstance(s, tc.Tensor): s = s.view(-1).tolist()
+        return self.cache_prefix + tuple(s)
 
     def trans_onesent(self, s):
 
+        if self.cache is not None and not isinstance(s, tuple):
+            key = self.cache_key(s)
+            rst = self.cache.get(key)
+            if rst is None:
+                rst = self._trans_onesent(s)
+                self.cache.put(key, rst)
+            return rst
+
+        return self._trans_onesent(s)
+
+    def _trans_onesent(self, s):
+
         trans_start = time.time()
 
         with tc.no_grad():
@@ -65,6 +100,39 @@ class Translator(object):
         # attent_matrix: (trgL, srcL) numpy
         return trans, ids, attent_matrix
 
+    def trans_batch(self, xs_BL, xs_mask):
+
+        if self.cache is None: return self._trans_batch(xs_BL, xs_mask)
+
+        keys = [self.cache_key(xs_BL[i][:int(xs_mask[i].sum().item())]) for i in range(xs_BL.size(0))]
+        cached = [self.cache.get(key) for key in keys]
+        # decode the first occurrence of each missed sentence only
+        todo = collections.OrderedDict()
+        for i, key in enumerate(keys):
+            if cached[i] is None and key not in todo: todo[key] = i
+        if len(todo) == 0: return cached
+
+        rows = xs_BL.new_tensor(todo.values())
+        xs_BL, xs_mask = xs_BL[rows], xs_mask[rows]
+        max_len = int(xs_mask.sum(1).max().item())
+        new = dict(zip(todo.keys(), self._trans_batch(xs_BL[:, :max_len], xs_mask[:, :max_len])))
+        for key, rst in new.items(): self.cache.put(key, rst)
+
+        return [new[key] if rst is None else rst for key, rst in zip(keys, cached)]
+
+    def _trans_batch(self, xs_BL, xs_mask):
+
+        # decode all sentences in one batch together, return the best candidate of each
+        with tc.no_grad():
+            batch_tran_cands = self.nbs.beam_search_trans(xs_BL, xs_mask)
+
+        batch_trans = []
+        for tran_cands in batch_tran_cands:
+            trans, loss, attent_matrix = tran_cands[0]  # best cand
+            batch_trans.append(filter_reidx(trans, self.tvcb_i2w, attent_matrix))
+
+        return batch_trans
+
     def trans_samples(self, xs_nL, ys_nL):
 
         # xs_nL: (sample_size, max_sLen)
@@ -145,11 +213,19 @@ class Translator(object):
             fd_attent_matrixs, trgs = self.force_decoding(batch_tst_data)
             wlog('Finish force decoding ...')
 
+        batch_search = self.batch_search and src_labels_fname is None and fd_attent_matrixs is None
+        # the weights do not change while translating a file, duplicated sentences are decoded once
+        file_cache = self.cache is None
+        if file_cache is True: self.cache, self.cache_prefix = TransCache(), ()
+
         trans_start = time.time()
         for bidx in range(n_batches):
-            # (idxs, tsrcs, lengths, src_mask)
-            xs_nL = xs_inputs[bidx][1]
-            # idxs, tsrcs, ttrgs_for_files, lengths, src_mask, trg_mask_for_files
+            # (idxs, tsrcs, lengths, src_mask) or
+            # (idxs, tsrcs, ttrgs_for_files, ttrg_bows_for_files, lengths, src_mask, ...)
+            batch = xs_inputs[bidx]
+            xs_nL, xs_mask = batch[1], batch[3] if len(batch) == 4 else batch[5]
+            if batch_search is True:
+                batch_trans = self.trans_batch(xs_nL, xs_mask)
             for no in range(xs_nL.size(0)): # batch size, 1 for valid
                 x_filter = sent_filter(xs_nL[no].tolist())
                 if src_labels_fname is not None:
@@ -165,15 +241,18 @@ class Translator(object):
                     trans = ' '.join(trans)
                 else:
                     if fd_attent_matrixs is None:   # need translate
-                        trans, ids, attent_matrix = self.trans_onesent(xs_nL[no].unsqueeze(0))
+                        if batch_search is True: trans, ids, attent_matrix = batch_trans[no]
+                        else:   # remove the padding of the batch
+                            trans, ids, attent_matrix = self.trans_onesent(
+                                xs_nL[no][:int(xs_mask[no].sum().item())].unsqueeze(0))
                         trg_toks = [] if trans == '' else trans.split(' ')
                         if trans == '': wlog('What ? null translation ... !')
                         words_cnt += len(ids)
                     else:
                         # attention: feed previous word -> get the alignment of next word !!!
-                        attent_matrix = fd_attent_matrixs[bidx] # do not remove <b>
+                        attent_matrix = fd_attent_matrixs[sent_no] # do not remove <b>
                         #print attent_matrix
-                        trg_toks = sent_filter(trgs[bidx]) # remove <b> and <e>
+                        trg_toks = sent_filter(trgs[sent_no]) # remove <b> and <e>
                         trg_toks = [self.tvcb_i2w[wid] for wid in trg_toks]
                         trans = ' '.join(trg_toks)
                         words_cnt += len(trg_toks)
@@ -222,6 +301,9 @@ class Translator(object):
                 format_time(spend), words_cnt, format_time(spend / words_cnt),
                 words_cnt, spend, words_cnt/spend))
 
+        wlog('Translation cache: {}'.format(self.cache))
+        if file_cache is True: self.cache, self.cache_prefix = None, None
+
         wlog('Done ...')
         if total_aligns is not None: total_aligns = '\n'.join(total_aligns) + '\n'
         return '\n'.join(total_trans) + '\n', total_aligns
@@ -288,8 +370,13 @@ class Translator(object):
             mteval_bleu_opost = bleu_file(opost_name, ref_fpaths, cased=wargs.cased)
             os.rename(opost_name, "{}_{}.txt".format(opost_name, mteval_bleu_opost))
 
-        mteval_bleu = bleu_file(out_fname, ref_fpaths, cased=wargs.cased, char=wargs.char_bleu)
-        multi_bleu = print_multi_bleu(out_fname, ref_fpaths, cased=wargs.cased, char=wargs.char_bleu)
+        # n-gram statistics of both BLEU styles are extracted in one pass
+        mteval_stats, multi_stats = file_stats(out_fname, ref_fpaths, cased=wargs.cased,
+                                               char=wargs.char_bleu, styles=('mteval', 'multi'))
+        mteval_bleu = bleu_file(out_fname, ref_fpaths, cased=wargs.cased, char=wargs.char_bleu,
+                                stats=mteval_stats)
+        multi_bleu = print_multi_bleu(out_fname, ref_fpaths, cased=wargs.cased, char=wargs.char_bleu,
+                                      stats=multi_stats)
         #mteval_bleu = bleu_file(out_fname + '.seg.plain', ref_fpaths)
         os.rename(out_fname, '{}{}_{}_{}.txt'.format(
             out_fname, '_char' if wargs.char_bleu is True else '', mteval_bleu, multi_bleu))
@@ -313,7 +400,10 @@ class Translator(object):
 
             _ = self.write_file_eval(test_out, trans, test_prefix, alns)
 
-    def trans_eval(self, valid_data, eid, bid, model_file, tests_data):
+    '''
+        decode and score the validation set with the current weights, return the BLEU score
+    '''
+    def eval_valid(self, valid_data, eid, bid):
 
         wlog('\nTranslating validation dataset {}{}.{}'.format(wargs.val_tst_dir, wargs.val_prefix, wargs.val_src_suffix))
         label_fname = '{}{}/{}.label'.format(wargs.val_tst_dir, wargs.seg_val_tst_dir,
@@ -326,41 +416,69 @@ class Translator(object):
 
         bleu_score = self.write_file_eval(valid_out, trans, wargs.val_prefix, alns)
 
-        bleu_scores_fname = '{}/train_bleu.log'.format(wargs.dir_valid)
-        bleu_scores = [0.]
-        if os.path.exists(bleu_scores_fname):
-            with open(bleu_scores_fname) as f:
-                for line in f:
-                    s_bleu = line.split(':')[-1].strip()
-                    bleu_scores.append(float(s_bleu))
-
-        wlog('\nCurrent [{}] - Best History [{}]'.format(bleu_score, max(bleu_scores)))
-        if bleu_score > max(bleu_scores):   # better than history
-            wargs.worse_counter = 0
-            copyfile(model_file, wargs.best_model)
-            wlog('Better, cp {} {}'.format(model_file, wargs.best_model))
-            bleu_content = 'epoch [{}], batch[{}], BLEU score*: {}'.format(eid, bid, bleu_score)
-            if tests_data is not None: self.trans_tests(tests_data, eid, bid)
-        else:
-            wlog('Worse')
-            wargs.worse_counter = wargs.worse_counter + 1
-            if wargs.worse_counter >= 8.:
-                wlog('{} consecutive worses, finish training.'.format(wargs.worse_counter))
-                sys.exit(0)
-            bleu_content = 'epoch [{}], batch[{}], BLEU score : {}'.format(eid, bid, bleu_score)
-
-        append_file(bleu_scores_fname, bleu_content)
-
         sfig = '{}.{}'.format(outprefix, 'sfig')
         sfig_content = ('{} {} {} {} {}').format(eid, bid, self.search_mode, self.k, bleu_score)
         append_file(sfig, sfig_content)
 
+        return bleu_score
+
+    '''
+        exit_worse: exit after too many consecutive worse validations, otherwise the caller
+        checks wargs.worse_counter and stops itself
+    '''
+    def trans_eval(self, valid_data, eid, bid, model_file, tests_data, exit_worse=True):
+
+        bleu_score = self.eval_valid(valid_data, eid, bid)
+        better = record_valid_bleu(bleu_score, eid, bid, model_file)
+        if better is True and tests_data is not None: self.trans_tests(tests_data, eid, bid)
+        if wargs.worse_counter >= 8.:
+            wlog('{} consecutive worses, finish training.'.format(wargs.worse_counter))
+            if exit_worse is True: sys.exit(0)
+
         if wargs.save_one_model and os.path.exists(model_file) is True:
             os.remove(model_file)
             wlog('Saving one model, so delete {}\n'.format(model_file))
 
         return bleu_score
 
+def valid_bleu_history():
+
+    bleu_scores_fname = '{}/train_bleu.log'.format(wargs.dir_valid)
+    bleu_scores = [0.]
+    if os.path.exists(bleu_scores_fname):
+        with open(bleu_scores_fname) as f:
+            for line in f:
+                s_bleu = line.split(':')[-1].strip()
+                bleu_scores.append(float(s_bleu))
+
+    return bleu_scores
+
+'''
+    best-model bookkeeping of one validation: best.model.pt, train_bleu.log and the
+    counter of consecutive worse validations, return whether it beats the history
+'''
+def record_valid_bleu(bleu_score, eid, bid, model_file):
+
+    bleu_scores_fname = '{}/train_bleu.log'.format(wargs.dir_valid)
+    bleu_scores = valid_bleu_history()
+
+    wlog('\nCurrent [{}] - Best History [{}]'.format(bleu_score, max(bleu_scores)))
+    better = bleu_score > max(bleu_scores)
+    if better:   # better than history
+        wargs.worse_counter = 0
+        # the single temporary model is deleted after validation, move it instead of linking
+        link_file(model_file, wargs.best_model, keep_src=not wargs.save_one_model)
+        wlog('Better, ln {} {}'.format(model_file, wargs.best_model))
+        bleu_content = 'epoch [{}], batch[{}], BLEU score*: {}'.format(eid, bid, bleu_score)
+    else:
+        wlog('Worse')
+        wargs.worse_counter = wargs.worse_counter + 1
+        bleu_content = 'epoch [{}], batch[{}], BLEU score : {}'.format(eid, bid, bleu_score)
+
+    append_file(bleu_scores_fname, bleu_content)
+
+    return better
+
 if __name__ == "__main__":
     import sys
     res = valid_bleu(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4])
@@ -18,6 +18,9 @@ from translate import Translator
 from tools.utils import load_model, wlog, dec_conf, init_dir, append_file
 from tools.inputs_handler import extract_vocab, wrap_tst_data
 from models.losser import Classifier
+from tools.trans_cache import TransCache
+from tools.quantize import load_weights
+from tools.bundle import is_bundle, load_bundle_model
 
 if __name__ == '__main__':
 
@@ -25,6 +28,14 @@ if __name__ == '__main__':
     A.add_argument('-m', '--model-file', required=True, dest='model_file', help='model file')
     A.add_argument('-i', '--input-file', dest='input_file', default=None,
                    help='name of file to be translated')
+    A.add_argument('--ema', dest='ema', action='store_true',
+                   help='decode with the moving average of weights saved in the model file')
+    A.add_argument('--int8', dest='int8', action='store_true',
+                   help='quantize the linear layers into int8 for CPU inference')
+    A.add_argument('--jit', dest='jit', action='store_true',
+                   help='decode by the traced encoder and one-step decoder graphs (torch >= 1.0)')
+    A.add_argument('--save-int8', dest='save_int8', default=None,
+                   help='save the int8 quantized model into this file and exit')
 
     '''
     A.add_argument('--search-mode', dest='search_mode', default=2,
@@ -59,6 +70,7 @@ if __name__ == '__main__':
 
     args = A.parse_args()
     model_file = args.model_file
+    if args.jit is True: wargs.jit_trace = True
     '''
     search_mode = args.search_mode
     beam_size = args.beam_size
@@ -73,39 +85,52 @@ if __name__ == '__main__':
     switchs = [useBatch, vocabNorm, lenNorm, useMv, mergeWay, avgAtt]
     '''
 
-    wlog('Starting load vocabularies ... ')
-    assert os.path.exists(wargs.src_vcb) and os.path.exists(wargs.trg_vcb), 'need vocabulary ...'
-    src_vocab = extract_vocab(None, wargs.src_vcb)
-    trg_vocab = extract_vocab(None, wargs.trg_vcb)
-    n_src_vcb, n_trg_vcb = src_vocab.size(), trg_vocab.size()
-    wlog('Vocabulary size: |source|={}, |target|={}'.format(n_src_vcb, n_trg_vcb))
-
-    _dict = load_model(model_file)
-    if len(_dict) == 4: model_dict, eid, bid, optim = _dict
-    elif len(_dict) == 5: model_dict, class_dict, eid, bid, optim = _dict
-    from models.embedding import WordEmbedding
-    src_emb = WordEmbedding(n_src_vcb, wargs.d_src_emb, wargs.position_encoding, prefix='Src')
-    trg_emb = WordEmbedding(n_trg_vcb, wargs.d_trg_emb, wargs.position_encoding, prefix='Trg')
-    from models.model_builder import build_NMT
-    nmtModel = build_NMT(src_emb, trg_emb)
-    classifier = Classifier(wargs.d_dec_hid, n_trg_vcb, trg_emb, loss_norm=wargs.loss_norm,
-                            label_smoothing=wargs.label_smoothing, emb_loss=wargs.emb_loss, bow_loss=wargs.bow_loss)
-    nmtModel.classifier = classifier
-
-    if wargs.gpu_id is not None:
-        wlog('push model onto GPU {} ... '.format(wargs.gpu_id), 0)
-        nmtModel.to(tc.device('cuda'))
+    if is_bundle(model_file):
+        # the bundle holds the architecture settings and the vocabularies
+        from models.model_builder import build_model
+        nmtModel, src_vocab, trg_vocab, header = load_bundle_model(
+            model_file, build_model, int8=args.int8 or args.save_int8 is not None)
+        eid, bid = header['epoch'], header['batch']
     else:
-        wlog('push model onto CPU ... ', 0)
-        nmtModel.to(tc.device('cpu'))
-    wlog('done.')
-    nmtModel.load_state_dict(model_dict)
+        wlog('Starting load vocabularies ... ')
+        assert os.path.exists(wargs.src_vcb) and os.path.exists(wargs.trg_vcb), 'need vocabulary ...'
+        src_vocab = extract_vocab(None, wargs.src_vcb)
+        trg_vocab = extract_vocab(None, wargs.trg_vcb)
+        n_src_vcb, n_trg_vcb = src_vocab.size(), trg_vocab.size()
+        wlog('Vocabulary size: |source|={}, |target|={}'.format(n_src_vcb, n_trg_vcb))
+
+        _dict = load_model(model_file, ema=args.ema)
+        if len(_dict) == 4: model_dict, eid, bid, optim = _dict
+        elif len(_dict) == 5: model_dict, class_dict, eid, bid, optim = _dict
+        from models.embedding import WordEmbedding
+        src_emb = WordEmbedding(n_src_vcb, wargs.d_src_emb, wargs.position_encoding, prefix='Src')
+        trg_emb = WordEmbedding(n_trg_vcb, wargs.d_trg_emb, wargs.position_encoding, prefix='Trg')
+        from models.model_builder import build_NMT
+        nmtModel = build_NMT(src_emb, trg_emb)
+        classifier = Classifier(wargs.d_dec_hid, n_trg_vcb, trg_emb, loss_norm=wargs.loss_norm,
+                                label_smoothing=wargs.label_smoothing, emb_loss=wargs.emb_loss, bow_loss=wargs.bow_loss)
+        nmtModel.classifier = classifier
+
+        if wargs.gpu_id is not None:
+            wlog('push model onto GPU {} ... '.format(wargs.gpu_id), 0)
+            nmtModel.to(tc.device('cuda'))
+        else:
+            wlog('push model onto CPU ... ', 0)
+            nmtModel.to(tc.device('cpu'))
+        wlog('done.')
+        load_weights(nmtModel, model_dict, int8=args.int8 or args.save_int8 is not None)
     wlog('\nFinish to load model.')
+    if args.save_int8 is not None:
+        tc.save({ 'model': nmtModel.state_dict(), 'epoch': eid, 'batch': bid, 'optim': None },
+                args.save_int8)
+        wlog('Save int8 model into {}'.format(args.save_int8))
+        sys.exit(0)
 
     dec_conf()
 
     nmtModel.eval()
     tor = Translator(nmtModel, src_vocab.idx2key, trg_vocab.idx2key, print_att=wargs.print_att)
+    if wargs.trans_cache_size > 0: tor.set_cache(TransCache(wargs.trans_cache_size, wargs.trans_cache_db))
 
     if not args.input_file:
         wlog('Translating one sentence ... ')
@@ -151,7 +176,7 @@ if __name__ == '__main__':
     wlog('Translating test file {} ... '.format(input_abspath))
     ref_file = '{}{}.{}'.format(wargs.val_tst_dir, args.input_file, wargs.val_ref_suffix)
     test_src_tlst, _ = wrap_tst_data(input_abspath, src_vocab, char=wargs.src_char)
-    test_input_data = Input(test_src_tlst, None, 1, batch_sort=False)
+    test_input_data = Input(test_src_tlst, None, wargs.test_batch_size, batch_sort=False)
 
     batch_tst_data = None
     if os.path.exists(ref_file):
@@ -164,6 +189,7 @@ if __name__ == '__main__':
         batch_tst_data = Input(tst_src_tlst, tst_trg_tlst, 1, batch_sort=False)
 
     trans, alns = tor.single_trans_file(test_input_data, batch_tst_data=batch_tst_data)
+    if tor.cache is not None: tor.cache.close()
 
     if wargs.search_mode == 0: p1 = 'greedy'
     elif wargs.search_mode == 1: p1 = 'nbs'
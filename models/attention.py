@@ -117,6 +117,7 @@ class MultiHeadAttention(nn.Module):
         #self.final_proj = nn.Linear(d_model, d_model)
         self.final_proj_weight = nn.Parameter(tc.Tensor(d_model, d_model))
         self.final_proj_bias = nn.Parameter(tc.Tensor(d_model))
+        self.kqv_proj_q, self.final_proj_q = None, None     # int8 projections, see quantize
 
         nn.init.xavier_uniform_(self.kqv_proj_weight)
         nn.init.xavier_uniform_(self.final_proj_weight)
@@ -131,15 +132,18 @@ class MultiHeadAttention(nn.Module):
            q (FloatTensor): query vectors  [batch_size, query_len, d_model]
            attn_mask: binary mask indicating
                     which keys have non-zero attention [batch_size, query_len, key_len]
+           layer_cache (dict): keys/values cached for incremental decoding, None for training
+           attn_type (str): 'self' appends the new keys/values into the cache,
+                    'context' reuses the encoder-side keys/values in the cache
         Returns:
            (FloatTensor, FloatTensor, FloatTensor) :
            * context vectors [batch_size, query_len, d_model]
            * all attention vectors [batch_size, n_head, query_len, key_len]
            * one of the attention vectors [batch_size, query_len, key_len]
     '''
-    def forward(self, k, v, q, attn_mask=None):
+    def forward(self, k, v, q, attn_mask=None, layer_cache=None, attn_type=None):
 
-        batch_size, n_head = k.size(0), self.n_head
+        batch_size, n_head = q.size(0), self.n_head
 
         def split_heads(x):
             return x.view(batch_size, -1, n_head, self.dim_per_head).transpose(1, 2)
@@ -151,15 +155,20 @@ class MultiHeadAttention(nn.Module):
         #k = split_heads(self.linear_keys(k)) # [batch_size, n_head, key_len, dim_per_head]
         #v = split_heads(self.linear_values(v)) # [batch_size, n_head, key_len, dim_per_head]
         #q = split_heads(self.linear_query(q))  # [batch_size, n_head, query_len, dim_per_head]
-        k = F.linear(k, self.kqv_proj_weight[0 : self.d_model, :],
-                     self.kqv_proj_bias[0 : self.d_model])
-        q = F.linear(q, self.kqv_proj_weight[self.d_model : 2 * self.d_model, :],
-                     self.kqv_proj_bias[self.d_model : 2 * self.d_model])
-        v = F.linear(v, self.kqv_proj_weight[2 * self.d_model :, :],
-                     self.kqv_proj_bias[2 * self.d_model :])
-        k = split_heads(k)
-        q = split_heads(q)
-        v = split_heads(v)
+        q = split_heads(self.proj(q, 1))
+        if layer_cache is not None and attn_type == 'context':
+            # encoder-side keys and values are projected only once before decoding
+            if layer_cache['memory_keys'] is None:
+                layer_cache['memory_keys'], layer_cache['memory_values'] = self.proj_keys_values(k, v)
+            k, v = layer_cache['memory_keys'], layer_cache['memory_values']
+        else:
+            k, v = self.proj_keys_values(k, v)
+            if layer_cache is not None and attn_type == 'self':
+                # incremental decoding: only the newest target position is projected
+                if layer_cache['self_keys'] is not None:
+                    k = tc.cat([layer_cache['self_keys'], k], dim=2)
+                    v = tc.cat([layer_cache['self_values'], v], dim=2)
+                layer_cache['self_keys'], layer_cache['self_values'] = k, v
 
         # 2. calculate and scale scores: Attention(Q,K,V) = softmax(QK/sqrt(d_k))*V
         q = q * self.scaling # [batch_size, n_head, query_len, dim_per_head]
@@ -182,11 +191,50 @@ class MultiHeadAttention(nn.Module):
         context = combine_heads(context)             # [batch_size, query_len, n_head * dim_per_head]
 
         #context = self.final_proj(context)   # [batch_size, query_len, d_model]
-        context = F.linear(context, self.final_proj_weight, self.final_proj_bias)   # [batch_size, query_len, d_model]
+        if self.final_proj_q is not None: context = self.final_proj_q(context)
+        else: context = F.linear(context, self.final_proj_weight, self.final_proj_bias)   # [batch_size, query_len, d_model]
 
         attn = attn.sum(dim=1) / self.n_head    # average attention weights over heads
 
         return context, attn
 
+    '''
+        Project the keys and values, then split them into heads
+        Args:
+           k (FloatTensor): key vectors [batch_size, key_len, d_model]
+           v (FloatTensor): value vectors [batch_size, key_len, d_model]
+        Returns:
+           (FloatTensor, FloatTensor) : [batch_size, n_head, key_len, dim_per_head]
+    '''
+    def proj_keys_values(self, k, v):
+
+        batch_size, n_head = k.size(0), self.n_head
+        k, v = self.proj(k, 0), self.proj(v, 2)
+        k = k.view(batch_size, -1, n_head, self.dim_per_head).transpose(1, 2)
+        v = v.view(batch_size, -1, n_head, self.dim_per_head).transpose(1, 2)
+
+        return k, v
+
+    '''
+        Project x by the keys (i=0), queries (i=1) or values (i=2) rows of kqv_proj
+    '''
+    def proj(self, x, i):
+
+        if self.kqv_proj_q is not None: return self.kqv_proj_q[i](x)
+        d = self.d_model
+        return F.linear(x, self.kqv_proj_weight[i * d : (i + 1) * d, :], self.kqv_proj_bias[i * d : (i + 1) * d])
 
+    '''
+        int8 inference (tools/quantize.py): replace the projection weights by int8 linear layers
+    '''
+    def quantize(self):
+
+        if self.kqv_proj_q is not None: return     # quantized already
+        from tools.quantize import QuantLinear
+        d = self.d_model
+        self.kqv_proj_q = nn.ModuleList([QuantLinear(self.kqv_proj_weight[i * d : (i + 1) * d, :],
+                                                     self.kqv_proj_bias[i * d : (i + 1) * d])
+                                         for i in range(3)])
+        self.final_proj_q = QuantLinear(self.final_proj_weight, self.final_proj_bias)
+        del self.kqv_proj_weight, self.kqv_proj_bias, self.final_proj_weight, self.final_proj_bias
 
@@ -11,13 +11,10 @@ def make_positions(tensor, padding_idx):
     Position numbers begin at padding_idx+1.
     """
     max_pos = padding_idx + 1 + tensor.size(1)
-    if not hasattr(make_positions, 'range_buf'):
-        make_positions.range_buf = tensor.new()
-    make_positions.range_buf = make_positions.range_buf.type_as(tensor)
-    if make_positions.range_buf.numel() < max_pos:
-        tc.arange(padding_idx + 1, max_pos, out=make_positions.range_buf)
+    # no cached range buffer, it would be a constant of the graph traced by tools/inference.py
+    positions = tc.arange(padding_idx + 1, max_pos, dtype=tensor.dtype,
+                          device=tensor.device).expand_as(tensor)
     mask = tensor.ne(padding_idx)
-    positions = make_positions.range_buf[:tensor.size(1)].expand_as(tensor)
     return tensor.clone().masked_scatter_(mask, positions[mask])
 
 class SinusoidalPositionalEmbedding(nn.Module):
@@ -58,7 +55,7 @@ class SinusoidalPositionalEmbedding(nn.Module):
         """Input is expected to be of size [bsz x seqlen]."""
         #bsz, seq_len = tc.onnx.operators.shape_as_tensor(input)
         bsz, seq_len = input.size(0), input.size(1)
-        max_pos = self.padding_idx + 1 + seq_len
+        max_pos = self.padding_idx + 1 + (seq_len if timestep is None else timestep + 1)
         if self.weights is None or max_pos > self.weights.size(0):
             # recompute/expand embeddings if needed
             self.weights = SinusoidalPositionalEmbedding.get_embedding(
@@ -68,6 +65,10 @@ class SinusoidalPositionalEmbedding(nn.Module):
             )
         self.weights = self.weights.type_as(self._float_tensor)
 
+        if timestep is not None:
+            # incremental decoding, all sequences share the position of the current step
+            return self.weights[max_pos - 1, :].expand(bsz, 1, -1).detach()
+
         positions = make_positions(input, self.padding_idx)
         return self.weights.index_select(0, positions.view(-1)).view(bsz, seq_len, -1).detach()
 
@@ -159,13 +160,14 @@ class WordEmbedding(nn.Module):
 
         return x_emb + signal * (float(channels) ** -0.5)
 
-    def forward(self, x):
+    def forward(self, x, step=None):
 
+        # step: the index of x in the target sequence for incremental decoding, x: [batch_size, 1]
         x_w_emb = self.we(x)
         if self.position_encoding is True:
             #x_wp_emb = self.add_timing_signal(x_w_emb)
             scale = math.sqrt(self.n_embed)
-            x_wp_emb = scale * x_w_emb + self.spe(x)
+            x_wp_emb = scale * x_w_emb + self.spe(x, timestep=step)
         else:
             x_wp_emb = x_w_emb
 
@@ -7,7 +7,7 @@ import torch.nn.functional as F
 
 import wargs
 from tools.utils import wlog, PAD, schedule_bow_lambda
-from models.nn_utils import MaskSoftmax, MyLogSoftmax, Linear
+from models.nn_utils import MaskSoftmax, MyLogSoftmax, Linear, chunked_xent
 
 epsilon = 1e-20
 class Classifier(nn.Module):
@@ -142,6 +142,9 @@ class Classifier(nn.Module):
     def forward(self, feed_BLO, gold_BL=None, gold_mask_BL=None, noise=None, bow_BN=None,
                 bow_mask_BN=None, context_BLH=None):
 
+        if gold_BL is not None and wargs.chunk_xent is True and self.emb_loss is False and noise is None:
+            return self.chunked_forward(feed_BLO, gold_BL, bow_BN, bow_mask_BN, context_BLH)
+
         pred_BLV = self.pred_map(feed_BLO, noise)   # (batch_size, y_Lm1, out_size)
         # decoding, if gold is None and gold_mask is None:
         if gold_BL is None and gold_mask_BL is None:
@@ -172,96 +175,75 @@ class Classifier(nn.Module):
         # final loss, xentropy
         return loss, ce_loss, emb_loss, bow_loss, ok_ytoks, abs_logZ
 
+    '''
+        same losses with forward, but the [B, L, V] logits, probabilities and log-probabilities
+        are never built: the projection and the cross entropy are fused and computed in chunks
+    '''
+    def chunked_forward(self, feed_BLO, gold_BL, bow_BN=None, bow_mask_BN=None, context_BLH=None):
+
+        feed_nO = feed_BLO.contiguous().view(-1, feed_BLO.size(-1))
+        loss, ce_loss, abs_logZ, ok_ytoks = chunked_xent(
+            feed_nO, self.map_vocab.weight, self.map_vocab.bias, gold_BL.contiguous().view(-1),
+            PAD, self.label_smoothing, wargs.self_norm_alpha, wargs.xent_row_chunk, wargs.xent_vocab_chunk)
+        bow_loss = None
+        if self.bow_loss is True:
+            pred_bow = self.ctx_map_vocab(context_BLH)  # (batch_size, y_Lm1, V)
+            bow_loss = self.bowLoss_based_pred(pred_bow, gold_BL.ne(PAD).type_as(pred_bow),
+                                               bow_BN, bow_mask_BN)
+
+        return loss, ce_loss, None, bow_loss, ok_ytoks, abs_logZ
+
     '''
     Compute the loss in shards for efficiency
         outputs: the predict outputs from the model
         gold: correct target sentences in current batch
+    the classifier runs on detached views of outputs shard by shard, the gradients of the
+    shards are gathered into one preallocated buffer and back-propagated through the model
+    once, no activation is copied and no graph is retained across shards
+    before_backward is called with the tensors of the model graph before that backward
+    the metrics are accumulated on device, return tensors (nll, ok_ytoks, abs_logZ)
     '''
     def snip_back_prop(self, outputs, gold, gold_mask, bow, bow_mask, epo_idx, shard_size=100,
-                       contexts=None):
+                       contexts=None, before_backward=None):
 
         # (batch_size, y_Lm1, out_size)
         batch_nll, batch_ok_ytoks, batch_abs_logZ = 0, 0, 0
-        word_norm = gold_mask.sum().item() if self.loss_norm == 'tokens' else gold.size(0)
-        bow_norm = bow_mask.sum().item() if self.loss_norm == 'tokens' else bow.size(0)
-        word_norm, bow_norm = float(word_norm), float(bow_norm)
+        # keep the normalizers on device, no synchronization per batch
+        word_norm = gold_mask.sum() if self.loss_norm == 'tokens' else float(gold.size(0))
+        bow_norm = None
+        if bow is not None:
+            bow_norm = bow_mask.sum() if self.loss_norm == 'tokens' else float(bow.size(0))
         lambd = schedule_bow_lambda(epo_idx)
-        if contexts is not None and self.bow_loss is False: contexts = contexts.detach()
-        shard_state = { 'feed_BLO': outputs, 'gold_BL': gold, 'gold_mask_BL': gold_mask,
-                       'bow_BN': bow, 'bow_mask_BN':bow_mask, 'context_BLH': contexts }
-
-        for shard in shards(shard_state, shard_size):
+        if self.bow_loss is False: contexts = None
+
+        # (tensor of the model graph, its detached view, gradient buffer)
+        tracked = [(outputs, outputs.detach(), tc.zeros_like(outputs))]
+        if contexts is not None: tracked.append((contexts, contexts.detach(), tc.zeros_like(contexts)))
+
+        for start in range(0, gold.size(0), shard_size):
+            end = min(start + shard_size, gold.size(0))
+            leaves = [v[start : end].requires_grad_() for _, v, _ in tracked]
+            shard = { 'feed_BLO': leaves[0], 'gold_BL': gold[start : end],
+                     'gold_mask_BL': gold_mask[start : end],
+                     'bow_BN': None if bow is None else bow[start : end],
+                     'bow_mask_BN': None if bow_mask is None else bow_mask[start : end],
+                     'context_BLH': leaves[1] if len(leaves) > 1 else None }
             loss, ce_loss, emb_loss, bow_loss, ok_ytoks, abs_logZ = self(**shard)
-            batch_nll += ce_loss.item()
-            batch_ok_ytoks += ok_ytoks.item()
-            batch_abs_logZ += abs_logZ.item()
+            batch_nll = batch_nll + ce_loss.detach()
+            batch_ok_ytoks = batch_ok_ytoks + ok_ytoks.detach()
+            batch_abs_logZ = batch_abs_logZ + abs_logZ.detach()
 
             loss = loss.div(word_norm)
             if self.emb_loss is True:
                 loss = loss + emb_loss.div(word_norm)
             elif self.bow_loss is True:
                 loss = loss + lambd * bow_loss.div(bow_norm)
-            loss.backward(retain_graph=True)
-
-        return batch_nll, batch_ok_ytoks, batch_abs_logZ
-
-def filter_shard_state(state, shard_size=None):
-    for k, v in state.items():
-        if shard_size is None:
-            yield k, v
-
-        if v is not None:
-            v_split = []
-            if isinstance(v, tc.Tensor):
-                for v_chunk in tc.split(v, shard_size):
-                    v_chunk = v_chunk.data.clone()
-                    v_chunk.requires_grad = v.requires_grad
-                    v_split.append(v_chunk)
-            yield k, (v, v_split)
+            # the graph of this shard is freed, the classifier gradients are accumulated
+            loss.backward()
+            for leaf, (_, _, grad_buf) in zip(leaves, tracked):
+                grad_buf[start : end].copy_(leaf.grad)
 
+        if before_backward is not None: before_backward([v for v, _, _ in tracked])
+        tc.autograd.backward([v for v, _, _ in tracked], [g for _, _, g in tracked])
 
-def shards(state, shard_size, eval_only=False):
-    '''
-    Args:
-        state: A dictionary which corresponds to the output
-               values for those keys are Tensor-like or None.
-        shard_size: The maximum size of the shards yielded by the model.
-        eval_only: if True, only yield the state, nothing else.
-              otherwise, yield shards.
-    Yields:
-        each yielded shard is a dict.
-    side effect:
-        after the last shard, this function does back-propagation.
-    '''
-    if eval_only:
-        yield filter_shard_state(state)
-    else:
-        # non_none: the subdict of the state dictionary where the values are not None
-        non_none = dict(filter_shard_state(state, shard_size))
-
-        # Now, the iteration:
-        # state is a dictionary of sequences of tensor-like but we
-        # want a sequence of dictionaries of tensors.
-        # First, unzip the dictionary into a sequence of keys and a
-        # sequence of tensor-like sequences.
-        keys, values = zip(*((k, [v_chunk for v_chunk in v_split])
-                             for k, (_, v_split) in non_none.items()))
-
-        # Now, yield a dictionary for each shard. The keys are always
-        # the same. values is a sequence of length #keys where each
-        # element is a sequence of length #shards. We want to iterate
-        # over the shards, not over the keys: therefore, the values need
-        # to be re-zipped by shard and then each shard can be paired
-        # with the keys.
-        for shard_tensors in zip(*values):
-            yield dict(zip(keys, shard_tensors))
-
-        # Assumed backprop'd
-        variables = []
-        for k, (v, v_split) in non_none.items():
-            if isinstance(v, tc.Tensor) and state[k].requires_grad:
-                variables.extend(zip(tc.split(state[k], shard_size),
-                                     [v_chunk.grad for v_chunk in v_split]))
-        inputs, grads = zip(*variables)
-        tc.autograd.backward(inputs, grads)
-
+        return batch_nll, batch_ok_ytoks, batch_abs_logZ
@@ -1,6 +1,9 @@
 import wargs
+import torch as tc
 import torch.nn as nn
 
+from tools.utils import wlog
+
 
 ''' NMT model with encoder and decoder '''
 class NMTModel(nn.Module):
@@ -126,4 +129,42 @@ def build_NMT(src_emb, trg_emb):
 
     return nmt
 
-
+'''
+    the embeddings, the encoder-decoder and the classifier by the wargs settings, on the device
+    of wargs.gpu_id
+'''
+def build_model(n_src_vcb, n_trg_vcb):
+
+    from models.losser import Classifier
+    from models.embedding import WordEmbedding
+
+    src_emb = WordEmbedding(n_src_vcb, wargs.d_src_emb, wargs.input_dropout,
+                            wargs.position_encoding, prefix='Src')
+    trg_emb = WordEmbedding(n_trg_vcb, wargs.d_trg_emb, wargs.input_dropout,
+                            wargs.position_encoding, prefix='Trg')
+    # share the embedding matrix - preprocess with share_vocab required.
+    if wargs.embs_share_weight:
+        if n_src_vcb != n_trg_vcb:
+            raise AssertionError('The `-share_vocab` should be set during '
+                                 'preprocess if you use share_embeddings!')
+        src_emb.we.weight = trg_emb.we.weight
+
+    nmtModel = build_NMT(src_emb, trg_emb)
+
+    if not wargs.copy_attn:
+        classifier = Classifier(wargs.d_model if wargs.decoder_type == 'att' else wargs.d_dec_hid,
+                                n_trg_vcb, trg_emb, loss_norm=wargs.loss_norm,
+                                label_smoothing=wargs.label_smoothing,
+                                emb_loss=wargs.emb_loss, bow_loss=wargs.bow_loss)
+    nmtModel.decoder.classifier = classifier
+
+    if wargs.gpu_id is not None:
+        wlog('push model onto GPU {} ... '.format(wargs.gpu_id), 0)
+        #nmtModel = nn.DataParallel(nmtModel, device_ids=wargs.gpu_id)
+        nmtModel.to(tc.device('cuda'))
+    else:
+        wlog('push model onto CPU ... ', 0)
+        nmtModel.to(tc.device('cpu'))
+    wlog('done.')
+
+    return nmtModel
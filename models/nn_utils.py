@@ -44,6 +44,96 @@ class MyLogSoftmax(nn.Module):
 
         return log_norm, prob, x
 
+'''
+    Fused cross entropy of the vocabulary projection, computed in chunks of rows and of the
+    vocabulary, neither the [n, V] logits nor the probabilities are kept, backward recomputes
+    the logits chunk by chunk from the saved log-normalizers, so the peak memory is
+    row_chunk * vocab_chunk instead of n * V
+        h (FloatTensor):        [n, H] decoder outputs
+        weight, bias:           [V, H], [V] of the vocabulary projection
+        gold (LongTensor):      [n], rows of padding are ignored
+        pad:                    index of padding
+        ls:                     label smoothing value
+        sna:                    alpha of self-normalization, None or 0 to disable
+    Returns: (loss, nll, sum of |logZ|, count of correct argmax) summed over non-padding rows,
+             only the loss is differentiable
+'''
+class ChunkedXent(tc.autograd.Function):
+
+    @staticmethod
+    def forward(ctx, h, weight, bias, gold, pad=0, ls=0., sna=None, row_chunk=1024, vocab_chunk=8192):
+
+        n, V = h.size(0), weight.size(0)
+        logZ, sum_z, pred = h.new_empty(n), h.new_empty(n), gold.new_zeros(n)
+        for r0 in range(0, n, row_chunk):
+            h_c = h[r0 : r0 + row_chunk]
+            m = h_c.new_full((h_c.size(0), ), -float('inf'))
+            s, S = h_c.new_zeros(h_c.size(0)), h_c.new_zeros(h_c.size(0))
+            best, best_idx = m.clone(), gold.new_zeros(h_c.size(0))
+            for v0 in range(0, V, vocab_chunk):
+                z = tc.addmm(bias[v0 : v0 + vocab_chunk], h_c, weight[v0 : v0 + vocab_chunk].t())
+                S += z.sum(1)
+                z_max, z_idx = z.max(1)
+                better = z_max > best
+                best = tc.where(better, z_max, best)
+                best_idx = tc.where(better, z_idx + v0, best_idx)
+                # online logsumexp
+                new_m = tc.max(m, z_max)
+                s = s * tc.exp(m - new_m) + tc.exp(z - new_m[:, None]).sum(1)
+                m = new_m
+            logZ[r0 : r0 + row_chunk] = m + tc.log(s)
+            sum_z[r0 : r0 + row_chunk] = S
+            pred[r0 : r0 + row_chunk] = best_idx
+        mask = gold.ne(pad)
+        mask_f = mask.type_as(h)
+        ok = pred.eq(gold).masked_select(mask).sum()
+
+        z_gold = (h * weight.index_select(0, gold)).sum(1) + bias.index_select(0, gold)
+        norm = logZ + sna * logZ * logZ if sna else logZ
+        nll = ((norm - z_gold) * mask_f).sum()
+        smooth = ((V * norm - sum_z) * mask_f).sum()
+        loss = (1. - ls) * nll + (ls / V) * smooth
+        abs_logZ = (logZ.abs() * mask_f).sum()
+
+        ctx.save_for_backward(h, weight, bias, gold, logZ)
+        ctx.pad, ctx.ls, ctx.sna, ctx.row_chunk, ctx.vocab_chunk = pad, ls, sna, row_chunk, vocab_chunk
+        ctx.mark_non_differentiable(nll, abs_logZ, ok)
+
+        return loss, nll, abs_logZ, ok
+
+    @staticmethod
+    def backward(ctx, grad_loss, grad_nll=None, grad_logZ=None, grad_ok=None):
+
+        h, weight, bias, gold, logZ = ctx.saved_tensors
+        ls, row_chunk, vocab_chunk = ctx.ls, ctx.row_chunk, ctx.vocab_chunk
+        n, V = h.size(0), weight.size(0)
+        # d loss / d z_v = c * p_v - (1 - ls) * [v == gold] - ls / V, c = 1 + 2 * sna * logZ
+        c = 1. + 2. * ctx.sna * logZ if ctx.sna else tc.ones_like(logZ)
+        scale = gold.ne(ctx.pad).type_as(h) * grad_loss
+        grad_h = h.new_zeros(h.size()) if ctx.needs_input_grad[0] else None
+        grad_w = weight.new_zeros(weight.size()) if ctx.needs_input_grad[1] else None
+        grad_b = bias.new_zeros(bias.size()) if ctx.needs_input_grad[2] else None
+        for r0 in range(0, n, row_chunk):
+            h_c, gold_c = h[r0 : r0 + row_chunk], gold[r0 : r0 + row_chunk]
+            logZ_c, c_c, scale_c = logZ[r0 : r0 + row_chunk], c[r0 : r0 + row_chunk], scale[r0 : r0 + row_chunk]
+            rows = tc.arange(h_c.size(0), dtype=tc.long, device=h.device)
+            for v0 in range(0, V, vocab_chunk):
+                w_c = weight[v0 : v0 + vocab_chunk]
+                z = tc.addmm(bias[v0 : v0 + vocab_chunk], h_c, w_c.t())
+                g = tc.exp(z - logZ_c[:, None]) * c_c[:, None] - ls / V
+                in_c = (gold_c >= v0) & (gold_c < v0 + z.size(1))
+                if in_c.any():
+                    g[rows[in_c], gold_c[in_c] - v0] -= (1. - ls)
+                g = g * scale_c[:, None]
+                if grad_h is not None: grad_h[r0 : r0 + row_chunk] += g.mm(w_c)
+                if grad_w is not None: grad_w[v0 : v0 + vocab_chunk] += g.t().mm(h_c)
+                if grad_b is not None: grad_b[v0 : v0 + vocab_chunk] += g.sum(0)
+
+        return grad_h, grad_w, grad_b, None, None, None, None, None, None
+
+def chunked_xent(h, weight, bias, gold, pad=0, ls=0., sna=None, row_chunk=1024, vocab_chunk=8192):
+    return ChunkedXent.apply(h, weight, bias, gold, pad, ls, sna, row_chunk, vocab_chunk)
+
 '''Layer normalize the tensor x, averaging over the last dimension.'''
 class LayerNorm(nn.Module):
 
@@ -60,13 +60,15 @@ class SelfAttDecoderLayer(nn.Module):
         self.layer_norm_2 = nn.LayerNorm(d_model, elementwise_affine=True)
         self.pos_ffn = PositionwiseFeedForward(d_model, d_ff_filter, d_model, dropout_prob=relu_dropout)
 
-    def forward(self, x, enc_output, trg_self_attn_mask=None, trg_src_attn_mask=None):
+    def forward(self, x, enc_output, trg_self_attn_mask=None, trg_src_attn_mask=None,
+                layer_cache=None):
         '''
         Args:
             x (FloatTensor):                [batch_size, trg_len, d_model]
             enc_output (FloatTensor):       [batch_size, src_len, d_model]
             trg_self_attn_mask (LongTensor):[batch_size, trg_len, trg_len]
             trg_src_attn_mask  (LongTensor):[batch_size, trg_len, src_len]
+            layer_cache (dict):             keys/values of this layer for incremental decoding
         Returns: (FloatTensor, FloatTensor, FloatTensor, FloatTensor):
             dec_output:         [batch_size, trg_len, d_model]
             trg_self_attns:     [batch_size, n_head, trg_len, trg_len]
@@ -80,7 +82,8 @@ class SelfAttDecoderLayer(nn.Module):
 
         # trg_self_attn_mask: (batch_size, trg_len, trg_len)
         if self.self_attn_type == 'scaled-dot':
-            x, trg_self_attns = self.self_attn(x, x, x, attn_mask=trg_self_attn_mask)
+            x, trg_self_attns = self.self_attn(x, x, x, attn_mask=trg_self_attn_mask,
+                                               layer_cache=layer_cache, attn_type='self')
             # query:                [batch_size, trg_len, d_model]
             # trg_self_attns:       [batch_size, n_head, trg_len, trg_len]
             # one_dec_self_attn:    [batch_size, trg_len, trg_len]
@@ -99,7 +102,8 @@ class SelfAttDecoderLayer(nn.Module):
             x = self.layer_norm_1(x)   # before 'n' for preprocess
 
         # trg_src_attn_mask: (batch_size, trg_len, src_len)
-        x, trg_src_attns = self.trg_src_attn(enc_output, enc_output, x, attn_mask=trg_src_attn_mask)
+        x, trg_src_attns = self.trg_src_attn(enc_output, enc_output, x, attn_mask=trg_src_attn_mask,
+                                             layer_cache=layer_cache, attn_type='context')
         # x:                    [batch_size, trg_len, d_model]
         # trg_src_attns:        [batch_size, trg_len, src_len]
 
@@ -166,7 +170,40 @@ class SelfAttDecoder(nn.Module):
             self.layer_norm = nn.LayerNorm(d_model, elementwise_affine=True)
         self.decoder_normalize_before = decoder_normalize_before
 
-    def forward(self, trg_seq, src_seq, enc_output, trg_mask=None, src_mask=None):
+    '''
+    Precompute the encoder-side keys/values of each layer before incremental decoding
+        enc_output (FloatTensor):   [batch_size, src_len, d_model]
+    Returns: list of dict for each layer, the target-side keys/values grow one position each step
+    '''
+    def init_cache(self, enc_output):
+
+        cache = []
+        for dec_layer in self.layer_stack:
+            memory_keys, memory_values = dec_layer.trg_src_attn.proj_keys_values(enc_output, enc_output)
+            cache.append({ 'self_keys': None, 'self_values': None,
+                           'memory_keys': memory_keys, 'memory_values': memory_values })
+
+        return cache
+
+    '''
+    Select the rows of cache by the back pointers of the beam
+        idx (LongTensor): [new_batch_size], index of rows in the previous batch
+    '''
+    def reorder_cache(self, cache, idx):
+
+        for layer_cache in cache:
+            for k, v in layer_cache.items():
+                if v is not None: layer_cache[k] = v.index_select(0, idx)
+
+        return cache
+
+    '''
+        trg_seq (LongTensor):   [batch_size, trg_len], [batch_size, 1] for incremental decoding
+        step (int):             index of trg_seq in the target sentence for incremental decoding
+        cache (list):           keys/values of all layers from init_cache, None for training
+    '''
+    def forward(self, trg_seq, src_seq, enc_output, trg_mask=None, src_mask=None, step=None,
+                cache=None):
 
         src_B, src_L = src_seq.size()
         trg_B, trg_L = trg_seq.size()
@@ -186,14 +223,15 @@ class SelfAttDecoder(nn.Module):
                 future_mask = tc.tril(tc.ones(trg_L, trg_L), diagonal=0, out=None).cuda()
                 trg_self_attn_mask = tc.gt(trg_self_attn_mask + future_mask[None, :, :], 1)
 
-        _, dec_output = self.trg_word_emb(trg_seq)
+        _, dec_output = self.trg_word_emb(trg_seq, step=step)
 
         #nlayer_outputs, nlayer_self_attns, nlayer_attns = [], [], []
-        for dec_layer in self.layer_stack:
+        for layer_idx, dec_layer in enumerate(self.layer_stack):
             dec_output, trg_self_attns, trg_src_attns = dec_layer(
                 dec_output, enc_output,
                 trg_self_attn_mask=trg_self_attn_mask,
-                trg_src_attn_mask=trg_src_attn_mask)
+                trg_src_attn_mask=trg_src_attn_mask,
+                layer_cache=cache[layer_idx] if cache is not None else None)
             #nlayer_outputs += [dec_output]
             #nlayer_self_attns += [trg_self_attns]
             #nlayer_attns += [trg_src_attns]
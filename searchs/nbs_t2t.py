@@ -8,6 +8,7 @@ import torch as tc
 
 import wargs
 from tools.utils import *
+from tools.inference import StepModel
 
 class Nbs(object):
 
@@ -21,6 +22,7 @@ class Nbs(object):
         self.print_att = print_att
         self.C = [0] * 4
         self.encoder, self.decoder, self.classifier = model.encoder, model.decoder, model.decoder.classifier
+        self.step_model = StepModel(model, jit=wargs.jit_trace)
         '''
         prob_projection = nn.LogSoftmax()
         self.model.prob_projection = prob_projection.cuda()
@@ -29,32 +31,36 @@ class Nbs(object):
 
     def beam_search_trans(self, x_BL, x_mask=None):
 
-        self.beam, self.hyps, self.B = [], [], 1
+        self.beam, self.B = [], 1
         if isinstance(x_BL, list): x_BL = tc.tensor(x_BL).long().unsqueeze(0)
         elif isinstance(x_BL, tuple):
-            # x_BL: (idxs, tsrcs, tspos, lengths, src_mask)
-            if len(x_BL) == 4: _, x_BL, lens, src_mask = x_BL
+            # x_BL: (idxs, tsrcs, lengths, src_mask) or
+            #       (idxs, tsrcs, ttrgs_for_files, ttrg_bows_for_files, lengths, src_mask, ...)
+            if len(x_BL) == 4: _, x_BL, lens, x_mask = x_BL
             elif len(x_BL) == 2: x_BL, src_pos_BL = x_BL
-            elif len(x_BL) == 8:
-                _, x_BL, src_pos, _, _, _, _, _ = x_BL
-                x_BL, src_pos_BL = x_BL.t(), src_pos.t()
-        assert x_BL.size(0) == 1, 'Unsupported for batch decoding ... '
+            elif len(x_BL) == 8: _, x_BL, _, _, _, x_mask, _, _ = x_BL
         if wargs.gpu_id is not None and not x_BL.is_cuda: x_BL = x_BL.cuda()
         #self.maxL = wargs.max_seq_len
         self.B, self.x_len = x_BL.size(0), x_BL.size(1)
-        self.maxL, self.x_BL = 2 * self.x_len, x_BL
         if x_mask is None:
-            x_mask = tc.ones((1, self.x_len), requires_grad=False)
-            if wargs.gpu_id is not None: x_mask = x_mask.cuda()
-
+            x_mask = tc.ones((self.B, self.x_len), requires_grad=False)
+        if wargs.gpu_id is not None and not x_mask.is_cuda: x_mask = x_mask.cuda()
+        self.x_BL, self.x_mask = x_BL, x_mask
+        # each sentence stops at twice of its own source length
+        self.sents_maxL = [2 * int(l) for l in x_mask.sum(-1).tolist()]
+        self.maxL = max(self.sents_maxL)
+        assert self.B == 1 or (wargs.with_batch and not wargs.ori_search), \
+                'Batch decoding requires with_batch and not ori_search ... '
+
+        self.hyps = [[] for _ in range(self.B)]
         #self.attent_probs = [] if self.print_att is True else None
         self.attent_probs = [[] for _ in range(self.B)] if self.print_att is True else None
         self.batch_tran_cands = [[] for _ in range(self.B)]
 
         debug('x_BL: {}\n{}'.format(x_BL.size(), x_BL))
-        self.enc_src0, _ = self.encoder(x_BL)
-        debug('enc_src0: {}\n{}'.format(self.enc_src0.size(), self.enc_src0))
-        init_beam(self.beam, cnt=self.maxL, cp=True)
+        # the encoder output is kept as its keys/values of all decoder layers in the state
+        self.state = self.step_model.encode(x_BL, x_mask)
+        init_beam(self.beam, cnt=self.maxL, cp=True, n_sents=self.B)
 
         if not wargs.with_batch: best_trans, best_loss = self.search()
         elif wargs.ori_search:   best_trans, best_loss = self.ori_batch_search()
@@ -67,7 +73,7 @@ class Nbs(object):
             debug([ (a[0], a[1]) for a in self.batch_tran_cands[bidx] ])
             best_trans, best_loss = self.batch_tran_cands[bidx][0][0], self.batch_tran_cands[bidx][0][1]
             debug('Src[{}], maskL[{}], hyp (w/o EOS)[{}], maxL[{}], loss[{}]'.format(
-                x_mask[:, bidx].sum().item(), self.x_len, len(best_trans), self.maxL, best_loss))
+                x_mask[bidx].sum().item(), self.x_len, len(best_trans), self.sents_maxL[bidx], best_loss))
         debug('Average Merging Rate [{}/{}={:6.4f}]'.format(self.C[1], self.C[0], self.C[1] / self.C[0]))
         debug('Average location of bp [{}/{}={:6.4f}]'.format(self.C[3], self.C[2], self.C[3] / self.C[2]))
         #debug('Step[{}] stepout[{}]'.format(*self.C[4:]))
@@ -135,145 +141,9 @@ class Nbs(object):
     #@exeTime
     def batch_search(self):
 
-        #encoded_src0 = self.enc_src0
-        encoded_src0 = self.enc_src0[-1]
-        # s0: (1, trg_nhids), encoded_src0: (x_len, 1, src_nhids*2)
-        enc_size, L = encoded_src0.size(-1), self.x_len
-        hyp_scores = np.zeros(1).astype('float32')
-        delete_idx, prevb_id = None, None
-        #batch_adj_list = [range(self.x_len) for _ in range(self.k)]
-
-        debug('\nBeam-{} {}'.format(0, '-'*20))
-        for b in self.beam[0][0]:    # do not output state
-            debug(b[0:1] + b[-2:])
-
-        def track_ys(cur_bidx):
-            y_part_seqs = []
-            for b in self.beam[cur_bidx - 1][0]:
-                seq, bp = [b[-2]], b[-1]
-                for i in reversed(xrange(0, cur_bidx - 1)):
-                    _, _, _, _, w, backptr = self.beam[i][0][bp]
-                    seq.append(w)
-                    bp = backptr
-                y_part_seqs.append(seq[::-1])
-            return y_part_seqs
-
-        debug('Last layer output of encoder: {}'.format(encoded_src0.size()))
-        for i in range(1, self.maxL + 1):
-
-            debug('\n{} Step-{} {}'.format('#'*20, i, '#'*20))
-            prevb = self.beam[i - 1][0]
-            preb_sz = len(prevb)
-            cnt_bp = (i >= 2)
-            if cnt_bp: self.C[0] += preb_sz
-
-            # -- Preparing decoded data seq -- #
-            y_part_seqs = track_ys(i) # (preb_sz, trg_part_L)
-            y_part_seqs = tc.tensor(y_part_seqs, requires_grad=False).view(-1, i)
-            if wargs.gpu_id is not None: y_part_seqs = y_part_seqs.cuda()
-            # encoded_src0: (len_q, d_model)
-            x_BL = self.x_BL.contiguous().view(-1, L).expand(preb_sz, L)
-            # (1, x_len, src_nhids) -> (preb_sz, x_len, src_nhids)
-            enc_srcs = encoded_src0.expand(preb_sz, L, enc_size)
-            debug('enc_srcs -> {}'.format(enc_srcs.size()))
-
-            # -- Decoding -- #
-            debug('Whole x seq: {}'.format(x_BL.size()))
-            debug('Part y seq: {}'.format(y_part_seqs.size()))
-            #dec_output, _, nlayer_attns = self.decoder(y_part_seqs, x_BL, enc_srcs)
-            dec_output, _, alpha_ij = self.decoder(y_part_seqs, x_BL, enc_srcs)
-            #alpha_ij = nlayer_attns[-1]
-            debug('History decoder output: {}'.format(dec_output.size()))
-            # (preb_sz, part_Len, d_model) -> (preb_sz, d_model)
-            dec_output = dec_output[:, -1, :] # (preb_sz, d_model) previous decoder hidden state
-            debug('Previous decoder output: {}'.format(dec_output.size()))
-            alpha_ij = alpha_ij[:, -1, :].permute(1, 0)    # (B, trgL, x_len) -> (x_len, B)
-            if self.attent_probs is not None:
-                self.attent_probs[0].append(alpha_ij)
-            self.C[2] += 1
-            self.C[3] += 1
-            debug('For beam[{}], pre-beam ids: {}'.format(i - 1, prevb_id))
-            next_ces = self.classifier(dec_output)
-            next_ces = next_ces.cpu().data.numpy()
-            cand_scores = hyp_scores[:, None] + next_ces
-            if i == 1 or i == 2:
-                '''here we make the score of <s> so large to avoid null translation'''
-                cand_scores[:, BOS] = float('+inf')
-            cand_scores_flat = cand_scores.flatten()
-            ranks_flat = part_sort(cand_scores_flat, self.k - len(self.hyps))
-            voc_size = next_ces.shape[1]
-            prevb_id = ranks_flat // voc_size
-            word_indices = ranks_flat % voc_size
-            costs = cand_scores_flat[ranks_flat]
-
-            debug('For beam[{}], pre-beam ids: {}'.format(i, prevb_id))
-
-            tp_bid = tc.from_numpy(prevb_id).cuda() if wargs.gpu_id else tc.from_numpy(prevb_id)
-            delete_idx, next_beam_cur_sent = [], []
-            for _j, b in enumerate(zip(costs, word_indices, prevb_id)):
-                bp = b[-1]
-                if wargs.len_norm == 0: score = (b[0], None)
-                elif wargs.len_norm == 1: score = (b[0] / i, b[0])
-                elif wargs.len_norm == 2:   # alpha length normal
-                    lp, cp = lp_cp(bp, i, 0, self.beam)
-                    score = (b[0] / lp + cp, b[0])
-                if cnt_bp: self.C[1] += (bp + 1)
-                if b[-2] == EOS:
-                    delete_idx.append(b[-1])
-                    debug(score)
-                    self.hyps.append(score + (None, ) + b[-2:] + (i, ))
-                    debug('Gen hypo {}'.format(self.hyps[-1]))
-                    # because i starts from 1, so the length of the first beam is 1, no <bos>
-                    if len(self.hyps) == self.k:
-                        # output sentence, early stop, best one in k
-                        debug('Early stop! see {} hyps ending with EOS.'.format(self.k))
-                        sorted_hyps = sorted(self.hyps, key=lambda tup: tup[0])
-                        for hyp in sorted_hyps: debug('{}'.format(hyp))
-                        best_hyp = sorted_hyps[0]
-                        debug('Best hyp length (w/ EOS)[{}]'.format(best_hyp[-1])) # w/ eos w/o bos
-                        self.batch_tran_cands[0] = [back_tracking(self.beam, 0, hyp, \
-                                                self.attent_probs[0] if self.attent_probs is not None \
-                                                                  else None) for hyp in sorted_hyps]
-                        return
-                # should calculate when generate item in current beam
-                else:
-                    if wargs.len_norm == 2: next_beam_cur_sent.append((b[0], alpha_ij[:, bp], None, 0) + b[1:])
-                    else: next_beam_cur_sent.append((b[0], None, None, 0) + b[1:])
-
-            self.beam[i] = [ next_beam_cur_sent ]
-
-            debug('\n{} Beam-{} {}'.format('-'*20, i, '-'*20))
-            for b in self.beam[i][0]:    # do not output state
-                debug(b[0:1] + b[-2:])
-            hyp_scores = np.array([b[0] for b in self.beam[i][0]])
-            del y_part_seqs, x_BL, enc_srcs     # free the tensor
-
-        # no early stop, back tracking
-        #return back_tracking(self.beam, 0, self.no_early_best(), self.attent_probs)
-        self.no_early_best()
-
-    def no_early_best(self):
-
-        # no early stop, back tracking
-        debug('==Start== No early stop ...')
-        if len(self.hyps) == 0:
-            debug('No early stop, no hyp with EOS, select k hyps length {} '.format(self.maxL))
-            best_hyp = self.beam[self.maxL][0][0]
-            if wargs.len_norm == 0: score = (best_hyp[0], None)
-            elif wargs.len_norm == 1: score = (best_hyp[0] / self.maxL, best_hyp[0])
-            elif wargs.len_norm == 2:   # alpha length normal
-                lp, cp = lp_cp(best_hyp[-1], self.maxL, 0, self.beam)
-                score = (best_hyp[0] / lp + cp, best_hyp[0])
-            self.hyps.append(score + best_hyp[-3:] + (self.maxL, ))
-        else:
-            debug('No early stop, no enough {} hyps with EOS, select the best '
-                      'one from {} hyps.'.format(self.k, len(self.hyps)))
-        sorted_hyps = sorted(self.hyps, key=lambda tup: tup[0])
-        for hyp in sorted_hyps: debug('{}'.format(hyp))
-        debug('Best hyp length (w/ EOS)[{}]'.format(sorted_hyps[0][-1]))
-        self.batch_tran_cands[0] = [back_tracking(self.beam, 0, hyp, \
-                    self.attent_probs[0] if self.attent_probs is not None \
-                                            else None) for hyp in sorted_hyps]
+        # <b> can not be generated at the first two steps to avoid null translation
+        self.batch_tran_cands = batch_beam_search(self.step_model, self.state, self.k, self.sents_maxL,
+            src_len=self.x_len, print_att=self.print_att, nobos_steps=(1, 2), C=self.C)
 
     def ori_batch_search(self):
 
@@ -0,0 +1,58 @@
+from __future__ import division
+
+import os
+import sys
+import torch as tc
+
+sys.path.append(os.getcwd())
+from utils import wlog
+
+FLOAT_TYPES = (tc.float16, tc.float32, tc.float64)
+
+'''
+    average the weights of checkpoints, the files are loaded one by one and summed in place,
+    so the memory does not grow with the number of checkpoints
+        key: 'model' for the weights, 'ema' for their moving averages
+    return: the averaged state dict and the last checkpoint
+'''
+def average_checkpoints(model_files, key='model'):
+
+    avg, state = None, None
+    for model_file in model_files:
+        wlog('Accumulating {} of {}'.format(key, model_file))
+        state = tc.load(model_file, map_location=lambda storage, loc: storage)
+        assert state.get(key) is not None, 'no {} in {}'.format(key, model_file)
+        params = state[key]
+        if avg is None:
+            # sum in double precision, integer buffers are taken from the first checkpoint
+            avg = { k: v.double() if v.dtype in FLOAT_TYPES else v.clone() for k, v in params.items() }
+            dtypes = { k: v.dtype for k, v in params.items() }
+        else:
+            assert set(params.keys()) == set(avg.keys()), \
+                    '{} has different parameters from {}'.format(model_file, model_files[0])
+            for k, v in params.items():
+                if v.dtype in FLOAT_TYPES: avg[k].add_(v.double())
+        del params
+        state[key] = None
+
+    for k in avg.keys():
+        if dtypes[k] in FLOAT_TYPES: avg[k] = avg[k].div_(len(model_files)).to(dtypes[k])
+
+    return avg, state
+
+# usage: avg_checkpoints.py -m <model_0 model_1 ...> -o <output model>
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='average the weights of checkpoints.')
+    parser.add_argument('-m', '--models', dest='m', required=True, nargs='+', help='checkpoint files')
+    parser.add_argument('-o', '--output', dest='o', required=True, help='averaged model file')
+    parser.add_argument('--ema', action='store_true', help='average the moving averages of weights')
+    args = parser.parse_args()
+
+    avg, last = average_checkpoints(args.m, 'ema' if args.ema else 'model')
+    # for decoding: the optimizer state of one checkpoint does not match the averaged weights
+    state_dict = { 'model': avg, 'epoch': last['epoch'], 'batch': last['batch'], 'optim': None }
+    tc.save(state_dict, args.o)
+    wlog('Save the average of {} checkpoints into {}'.format(len(args.m), args.o))
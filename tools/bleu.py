@@ -6,6 +6,8 @@ import re
 import sys
 import numpy
 import string
+import multiprocessing
+from collections import Counter
 from zhon import hanzi
 
 def wlog(obj, newline=1):
@@ -165,39 +167,128 @@ def token(s, cased=False):
 
     return s
 
-def merge_dict(d1, d2):
-    '''
-        Merge two dicts. The count of each item is the maximum count in two dicts.
-    '''
-    result = d1
-    for key in d2:
-        value = d2[key]
-        if result.has_key(key):
-            result[key] = max(result[key], value)
-        else:
-            result[key] = value
-    return result
+'''
+    sufficient statistics of one sentence, a vector of
+        [match_1, ..., match_n, count_1, ..., count_n, hypothesis length, reference length]
+    mteval-v11b takes the shortest reference length, multi-bleu the closest one
+'''
+def sent_stats(hypo, refs, n=4, closest=False):
 
-def sentence2dict(sentence, n):
-    '''
-        Count the number of n-grams in a sentence.
+    stats = numpy.zeros(2 * n + 2, dtype=numpy.int64)
+    for k in range(1, n + 1):
+        hypo_cnt = Counter(zip(*[hypo[i:] for i in range(k)]))
+        if not hypo_cnt: break
+        refs_cnt = Counter()
+        for ref in refs: refs_cnt |= Counter(zip(*[ref[i:] for i in range(k)]))
+        stats[k - 1] = sum((hypo_cnt & refs_cnt).itervalues())
+        stats[n + k - 1] = sum(hypo_cnt.itervalues())
+
+    h_length, ref_lengths = len(hypo), [len(ref) for ref in refs]
+    stats[2 * n] = h_length
+    if closest is True: stats[2 * n + 1] = min((abs(r - h_length), r) for r in ref_lengths)[1]
+    else: stats[2 * n + 1] = min(ref_lengths)
+
+    return stats
+
+def split_words(sent, style='mteval', cased=False, char=False):
+
+    if style == 'mteval':
+        # same with mteval-v11b.pl, an empty sentence still counts one word
+        if char is True: return ' '.join(zh_to_chars(sent.decode('utf-8'))).split(' ')
+        return token(sent, cased).split(' ')
+
+    sent = sent.strip()
+    if cased is False: sent = sent.lower()
+    if char is True: return zh_to_chars(sent.decode('utf-8'))
+    return sent.split()
+
+def chunk_stats(args):
+
+    hypos, refs, n, cased, char, styles = args
+    stats = [numpy.zeros((len(hypos), 2 * n + 2), dtype=numpy.int64) for _ in styles]
+    for num, (hypo, sent_refs) in enumerate(zip(hypos, refs)):
+        for style, style_stats in zip(styles, stats):
+            style_stats[num] = sent_stats(split_words(hypo, style, cased, char),
+                                          [split_words(ref, style, cased, char) for ref in sent_refs],
+                                          n, closest=(style == 'multi'))
+    return stats
 
-        :type sentence: string
-        :param sentence: sentence text
+'''
+    per-sentence statistics of a corpus for each style in styles ('mteval' or 'multi'),
+    the sentences are tokenized and counted once in a process pool over sentence chunks
+        hypos: list of hypothesis lines
+        refs: list of references, each one is a list of lines
+    return: list of int64 arrays [n_sents, 2 * n + 2]
+'''
+def corpus_stats(hypos, refs, n=4, cased=False, char=False, styles=('mteval',),
+                 n_workers=None, chunk_size=512):
+
+    refs = zip(*refs)
+    assert len(hypos) == len(refs), 'Length mismatch ... '
+    chunks = [(hypos[i : i + chunk_size], refs[i : i + chunk_size], n, cased, char, styles)
+              for i in range(0, len(hypos), chunk_size)]
+    if n_workers is None: n_workers = multiprocessing.cpu_count()
+    if n_workers <= 1 or len(chunks) <= 1:
+        rst = map(chunk_stats, chunks)
+    else:
+        pool = multiprocessing.Pool(min(n_workers, len(chunks)))
+        rst = pool.map(chunk_stats, chunks)
+        pool.close()
+        pool.join()
+    if len(rst) == 0: return [numpy.zeros((0, 2 * n + 2), dtype=numpy.int64) for _ in styles]
 
-        :type n: int
-        :param n: maximum length of counted n-grams
-    '''
-    words = sentence.split(' ')
-    result = {}
-    for k in range(1, n + 1):
-        for pos in range(len(words) - k + 1):
-            gram = ' '.join(words[pos : pos + k])
-            if result.has_key(gram):
-                result[gram] += 1
-            else:
-                result[gram] = 1
-    return result
+    return [numpy.concatenate(style_stats, axis=0) for style_stats in zip(*rst)]
+
+'''
+    one sentence per line, empty lines (empty translations) are kept in place
+'''
+def read_lines(fname):
+
+    with open(fname, 'r') as f: return [line.rstrip('\n') for line in f]
+
+def file_stats(hypo, refs, n=4, cased=False, char=False, styles=('mteval',), n_workers=None):
+
+    hypos = read_lines(hypo)
+    refs = [read_lines(ref_fpath) for ref_fpath in refs]
+
+    return corpus_stats(hypos, refs, n, cased, char, styles, n_workers)
+
+'''
+    BLEU scores of summed statistics, vectorized over all leading dimensions of stats,
+    the score is 0 once any n-gram precision is 0
+'''
+def bleu_from_stats(stats, n=4):
+
+    stats = numpy.asarray(stats, dtype=numpy.float64)
+    match, count = stats[..., :n], stats[..., n : 2 * n]
+    hypo_length, ref_length = stats[..., 2 * n], stats[..., 2 * n + 1]
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        log_prec = numpy.log(match / count).sum(-1) / n
+        bp = numpy.where(hypo_length < ref_length, numpy.exp(1. - ref_length / hypo_length), 1.)
+        score = bp * numpy.exp(log_prec)
+
+    return numpy.where((match > 0).all(-1), score, 0.)
+
+def bleu_stats_log(stats, n=4, logfun=wlog):
+
+    stats = numpy.asarray(stats)
+    if stats.ndim == 2: stats = stats.sum(0)
+    match, count = stats[:n], stats[n : 2 * n]
+    hypo_length, ref_length = int(stats[2 * n]), int(stats[2 * n + 1])
+    logfun('Total words count, ref {}, hyp {}'.format(ref_length, hypo_length))
+    for i in range(n):
+        logfun('{}-gram | ref {:8d} | match {:8d}'.format(i+1, int(count[i]), int(match[i])), 0)
+        if match[i] == 0:
+            logfun('')
+            return 0.
+        logfun(' |\tPrecision: {}'.format(match[i] / count[i]))
+
+    BLEU = float(bleu_from_stats(stats, n))
+    # there are no brevity penalty in mteval-v11b.pl, so with bp BLEU is a little lower
+    bp = math.exp(1 - ref_length / hypo_length) if hypo_length < ref_length else 1.
+    logfun('BP={}, ratio={}, BLEU={}'.format(bp, hypo_length / ref_length, BLEU))
+
+    return BLEU
 
 def bleu(hypo_c, refs_c, n=4, logfun=wlog, cased=False, char=False):
     '''
@@ -213,95 +304,13 @@ def bleu(hypo_c, refs_c, n=4, logfun=wlog, cased=False, char=False):
         :param n: maximum length of counted n-grams
     '''
     #hypo_c="today weather very good", refs_c=["today weather good", "would rain"],n=4
-    correctgram_count = [0] * n
-    ngram_count = [0] * n
     hypo_sen = hypo_c.split('\n')
     refs_sen = [refs_c[i].split('\n') for i in range(len(refs_c))]
-    hypo_length = 0
-    ref_length = 0
-    #print hypo_sen
-    #print len(hypo_sen)
-    for num in range(len(hypo_sen)):
-
-        hypo = hypo_sen[num]
-        if char is True: hypo = ' '.join(zh_to_chars(hypo.decode('utf-8')))
-        else: hypo = token(hypo, cased)
-
-        h_length = len(hypo.split(' '))
-
-        if char is True: refs = [' '.join(zh_to_chars(refs_sen[i][num].decode('utf-8'))) for i in range(len(refs_c))]
-        else: refs = [token(refs_sen[i][num], cased) for i in range(len(refs_c))]
-
-        # this is same with mteval-v11b.pl, using the length of the shortest reference
-        ref_lengths = sorted([len(refs[i].split(' ')) for i in range(len(refs))])
-        ref_length += ref_lengths[0]
-        hypo_length += h_length
-
-        # why this ? more strict
-        #hypo_length += (h_length if h_length < ref_lengths[0] else ref_lengths[0])
-
-        #print ref_lengths[0], ref_length, h_length, hypo_length
-
-        # another choice is use the minimal length difference of hypothesis and four references !!
-        #ref_distances = [abs(r - h_length) for r in ref_lengths]
-        #ref_length += ref_lengths[numpy.argmin(ref_distances)]
-        '''
-        if num == 0:
-            print h_length
-            print ref_lengths[0]
-            for i in range(len(refs_c)):
-                print token(refs_sen[i][num]), len(token(refs_sen[i][num]).split(' '))
-            print ref_lengths[numpy.argmin(ref_distances)]
-        '''
-        refs_dict = {}
-        for i in range(len(refs)):  # four refs for one sentence
-            ref = refs[i]
-            ref_dict = sentence2dict(ref, n)
-            refs_dict = merge_dict(refs_dict, ref_dict)
-
-        #if num == 0:
-        #    for key in refs_dict.keys():
-        #        print key, refs_dict[key]
-        hypo_dict = sentence2dict(hypo, n)
-
-        for key in hypo_dict:
-            value = hypo_dict[key]
-            length = len(key.split(' '))
-            ngram_count[length - 1] += value
-            #if num == 0:
-            #    print key, value, length
-            #    print min(value, refs_dict[key])
-            if refs_dict.has_key(key):
-                correctgram_count[length - 1] += min(value, refs_dict[key])
-
-    result = 0.
-    bleu_n = [0.] * n
-    #if correctgram_count[0] == 0: return 0.
-    logfun('Total words count, ref {}, hyp {}'.format(ref_length, hypo_length))
-    for i in range(n):
-        logfun('{}-gram | ref {:8d} | match {:8d}'.format(i+1, ngram_count[i], correctgram_count[i]), 0)
-        if correctgram_count[i] == 0:
-            #correctgram_count[i] += 1
-            #ngram_count[i] += 1
-            logfun('')
-            return 0.
-        bleu_n[i] = correctgram_count[i] / ngram_count[i]
-        logfun(' |\tPrecision: {}'.format(bleu_n[i]))
-        result += math.log(bleu_n[i]) / n
-
-    bp = 1.
-    #bleu = geometric_mean(precisions) * bp     # same with mean function ?
+    stats, = corpus_stats(hypo_sen, refs_sen, n, cased, char, styles=('mteval',))
 
-    # there are no brevity penalty in mteval-v11b.pl, so with bp BLEU is a little lower
-    if hypo_length < ref_length:
-        bp = math.exp(1 - ref_length / hypo_length) if hypo_length != 0 else 0
-
-    BLEU = bp * math.exp(result)
-    logfun('BP={}, ratio={}, BLEU={}'.format(bp, hypo_length / ref_length, BLEU))
+    return bleu_stats_log(stats, n, logfun)
 
-    return BLEU
-
-def bleu_file(hypo, refs, ngram=4, cased=False, char=False):
+def bleu_file(hypo, refs, ngram=4, cased=False, char=False, stats=None):
 
     '''
         Calculate the BLEU score given translation files and reference files.
@@ -319,16 +328,9 @@ def bleu_file(hypo, refs, ngram=4, cased=False, char=False):
     wlog('\treferences file:')
     for ref in refs: wlog('\t\t{}'.format(ref))
 
-    #hypo = open(hypo, 'r').read().strip('\n')
-    #refs = [open(ref_fpath, 'r').read().strip('\n') for ref_fpath in refs]
-    hypo = open(hypo, 'r').read().strip()
-    refs = [open(ref_fpath, 'r').read().strip() for ref_fpath in refs]
-
-    #print type(hypo)
-    #print hypo.endswith('\n')
-    #print type(refs)
-    #print type(refs[0])
-    result = bleu(hypo, refs, ngram, cased=cased, char=char)
+    # stats: per-sentence statistics already extracted by file_stats
+    if stats is None: stats, = file_stats(hypo, refs, ngram, cased, char, styles=('mteval',))
+    result = bleu_stats_log(stats, ngram)
     result = float('%.2f' % (result * 100))
 
     return result
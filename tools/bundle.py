@@ -0,0 +1,203 @@
+from __future__ import division
+
+import os
+import sys
+import json
+import struct
+import numpy
+from contextlib import contextmanager
+import torch as tc
+import torch.nn as nn
+
+sys.path.append(os.getcwd())
+import wargs
+from utils import wlog
+from vocab import Vocab
+from quantize import is_quantized, quantize_model
+
+'''
+    single-file model bundle for deployment:
+        MAGIC, header size (uint64), json header, then 64-byte aligned blobs
+    the header holds the wargs settings of the architecture, the epoch/batch and the offsets of
+    the blobs: the vocabularies (words ordered by index, joined by '\n') and the raw weights.
+    The file is memory-mapped when loaded, no weight is read before it is used, and the pages
+    are shared by all the processes mapping the same bundle
+'''
+MAGIC, ALIGN = 'WPYNMTB1', 64
+# wargs settings which decide the architecture of the model and the preprocessing of inputs,
+# the dropouts are needed by the constructors only
+CONFIG_KEYS = ('model_config', 'encoder_type', 'decoder_type', 'd_src_emb', 'd_trg_emb', 'd_model',
+               'd_ff_filter', 'n_head', 'n_enc_layers', 'n_dec_layers', 'd_enc_hid', 'd_dec_hid',
+               'attention_type', 'position_encoding', 'embs_share_weight', 'proj_share_weight',
+               'encoder_normalize_before', 'decoder_normalize_before', 'self_norm_alpha',
+               'copy_attn', 'd_mlp', 'fltr_windows', 'd_fltr_feats', 'max_seq_len', 'src_char',
+               'with_bpe', 'input_dropout', 'rnn_dropout', 'output_dropout', 'att_dropout',
+               'relu_dropout', 'residual_dropout')
+# training-only parts: bag-of-words head, the target embedding of the embedding loss (shared),
+# the label smoothing distribution
+SKIP_PREFIXES = ('decoder.classifier.ctx_map_vocab.', 'decoder.classifier.trg_word_emb.',
+                 'decoder.classifier.one_hot')
+
+def align(n):
+
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+def is_bundle(filename):
+
+    with open(filename, 'rb') as f: return f.read(len(MAGIC)) == MAGIC
+
+'''
+    write model_dict (checkpoint['model'] or ['ema']) without the training-only parts, the
+    vocabularies and the current wargs architecture settings into bundle_file, tied weights
+    are written once
+'''
+def save_bundle(bundle_file, model_dict, src_vocab, trg_vocab, eid=None, bid=None):
+
+    blobs, offset = [], 0
+    def add(data):
+        blobs.append((align(offset), data))
+        return align(offset), len(data)
+
+    config = dict((k, getattr(wargs, k)) for k in CONFIG_KEYS if hasattr(wargs, k))
+    config['emb_loss'], config['bow_loss'] = False, False    # their heads are not bundled
+    vocabs = {}
+    for name, vocab in (('src', src_vocab), ('trg', trg_vocab)):
+        vocabs[name] = add('\n'.join(str(vocab.idx2key[idx]) for idx in range(vocab.size())))
+        offset = blobs[-1][0] + len(blobs[-1][1])
+
+    tensors, seen = {}, {}
+    for k, v in sorted(model_dict.items()):
+        if k.startswith(SKIP_PREFIXES): continue
+        key = (v.data_ptr(), tuple(v.size()), v.stride())
+        if key in seen:
+            tensors[k] = { 'alias': seen[key] }
+            continue
+        seen[key] = k
+        a = v.detach().cpu().contiguous().numpy()
+        tensors[k] = { 'dtype': a.dtype.name, 'shape': list(a.shape), 'offset': add(a.tobytes())[0] }
+        offset = blobs[-1][0] + len(blobs[-1][1])
+
+    header = json.dumps({ 'config': config, 'vocabs': vocabs, 'tensors': tensors,
+                          'epoch': eid, 'batch': bid }, sort_keys=True)
+    start = align(len(MAGIC) + 8 + len(header))
+    tmp = '{}.tmp'.format(bundle_file)
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC + struct.pack('<Q', len(header)) + header)
+        for off, data in blobs:
+            f.write('\0' * (start + off - f.tell()))
+            f.write(data)
+    os.rename(tmp, bundle_file)
+    wlog('Save {} tensors and the vocabularies into bundle {} ({:.1f}MB)'.format(
+        len(seen), bundle_file, os.path.getsize(bundle_file) / 2**20))
+
+def words_vocab(words):
+
+    vocab = Vocab()
+    vocab.idx2key = dict(enumerate(words))
+    vocab.key2idx = { w: idx for idx, w in enumerate(words) }
+
+    return vocab
+
+'''
+    map bundle_file into memory, return the architecture settings, the source and target
+    vocabularies, the weights (CPU tensors over the mapped pages, copy-on-write) and the header
+'''
+def load_bundle(bundle_file):
+
+    with open(bundle_file, 'rb') as f:
+        assert f.read(len(MAGIC)) == MAGIC, '{} is not a model bundle'.format(bundle_file)
+        n_header, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(n_header))
+    buf = numpy.memmap(bundle_file, dtype=numpy.uint8, mode='c')
+    start = align(len(MAGIC) + 8 + n_header)
+
+    src_vocab, trg_vocab = [words_vocab(buf[start + off : start + off + n].tobytes().split('\n'))
+                            for off, n in (header['vocabs']['src'], header['vocabs']['trg'])]
+    tensors = {}
+    for k, e in header['tensors'].items():
+        if 'alias' in e: continue
+        dtype = numpy.dtype(str(e['dtype']))
+        n = int(numpy.prod(e['shape'])) * dtype.itemsize
+        a = buf[start + e['offset'] : start + e['offset'] + n].view(dtype).reshape(e['shape'])
+        tensors[str(k)] = tc.from_numpy(a)
+    for k, e in header['tensors'].items():
+        if 'alias' in e: tensors[str(k)] = tensors[str(e['alias'])]
+
+    return header['config'], src_vocab, trg_vocab, tensors, header
+
+def apply_config(config):
+
+    for k, v in config.items():
+        setattr(wargs, str(k), str(v) if isinstance(v, unicode) else v)
+
+'''
+    the weights are replaced by the bundle, skip their random initialization while building
+'''
+@contextmanager
+def skip_init():
+
+    saved = []
+    for name in dir(nn.init):
+        if name.endswith('_') and not name.startswith('_'):
+            saved.append((nn.init, name, getattr(nn.init, name)))
+            setattr(nn.init, name, lambda tensor, *args, **kwargs: tensor)
+    for cls in (nn.Linear, nn.Embedding, nn.LayerNorm, nn.GRU, nn.GRUCell, nn.LSTM, nn.LSTMCell):
+        owner = next((c for c in cls.__mro__ if 'reset_parameters' in c.__dict__), None)
+        if owner is not None and all(o is not owner for o, _, _ in saved):
+            saved.append((owner, 'reset_parameters', owner.__dict__['reset_parameters']))
+            setattr(owner, 'reset_parameters', lambda self: None)
+    try: yield
+    finally:
+        for owner, name, fn in saved: setattr(owner, name, fn)
+
+'''
+    point the parameters and buffers of model at the tensors, without copy on CPU
+'''
+def bind_weights(model, tensors):
+
+    own = model.state_dict(keep_vars=True)
+    missing = [k for k in own if k not in tensors and not k.startswith(SKIP_PREFIXES)]
+    unexpected = [k for k in tensors if k not in own]
+    assert len(missing) == 0 and len(unexpected) == 0, \
+            'bundle mismatches the model, missing: {}, unexpected: {}'.format(missing, unexpected)
+    for k, t in tensors.items():
+        p = own[k]
+        # copied only onto GPU or into another dtype
+        if t.dtype != p.dtype or t.device != p.device: t = t.to(device=p.device, dtype=p.dtype)
+        p.data = t
+
+    return model
+
+'''
+    build the model of bundle_file by build_model(n_src_vcb, n_trg_vcb) (bin/main.py) after
+    setting wargs by the bundle, return the model, the vocabularies and the header, a float
+    model is quantized after binding its weights if int8
+'''
+def load_bundle_model(bundle_file, build_model, int8=False):
+
+    wlog('Loading model bundle ... from {}'.format(bundle_file))
+    config, src_vocab, trg_vocab, tensors, header = load_bundle(bundle_file)
+    apply_config(config)
+    with skip_init(): model = build_model(src_vocab.size(), trg_vocab.size())
+    if is_quantized(tensors): quantize_model(model)
+    bind_weights(model, tensors)
+    if int8 is True and not is_quantized(tensors): quantize_model(model)
+    wlog('at epoch {} and batch {}, |source|={}, |target|={}'.format(
+        header['epoch'], header['batch'], src_vocab.size(), trg_vocab.size()))
+
+    return model, src_vocab, trg_vocab, header
+
+if __name__ == "__main__":
+
+    import argparse
+    from utils import load_model
+
+    parser = argparse.ArgumentParser(description='pack a checkpoint, the vocabularies and the '
+                                     'architecture settings of wargs.py into a model bundle.')
+    parser.add_argument('-m', '--model', dest='m', required=True, help='checkpoint file')
+    parser.add_argument('-o', '--output', dest='o', required=True, help='bundle file')
+    parser.add_argument('--ema', action='store_true', help='bundle the moving average of weights')
+    args = parser.parse_args()
+
+    _dict = load_model(args.m, ema=args.ema)
+    save_bundle(args.o, _dict[0], Vocab(wargs.src_vcb), Vocab(wargs.trg_vcb), _dict[-3], _dict[-2])
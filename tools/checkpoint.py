@@ -0,0 +1,112 @@
+from __future__ import division
+
+import os
+import copy
+import Queue
+import shutil
+import threading
+import torch as tc
+
+import wargs
+from utils import wlog
+
+'''
+    dtype of the weights in inference-only checkpoints, bfloat16 falls back to float16 on the
+    torch versions without it
+'''
+def ckpt_dtype(name):
+
+    if name is None: return None
+    if name == 'bf16' and hasattr(tc, 'bfloat16'): return tc.bfloat16
+    return tc.float16
+
+'''
+    copy of the state dict on CPU, training can go on updating the weights in place
+'''
+def cpu_snapshot(state_dict, dtype=None):
+
+    snapshot = state_dict.__class__()
+    for k, v in state_dict.items():
+        v = v.cpu() if v.is_cuda else v.clone()
+        if dtype is not None and v.dtype in (tc.float32, tc.float64): v = v.to(dtype)
+        snapshot[k] = v
+
+    return snapshot
+
+'''
+    best model: hard link (or rename when the source is not kept) instead of copying the file
+'''
+def link_file(src, dst, keep_src=True):
+
+    tmp = '{}.tmp{}'.format(dst, os.getpid())
+    if os.path.exists(tmp): os.remove(tmp)
+    try:
+        if keep_src is True: os.link(src, tmp)
+        else: os.rename(src, tmp)
+    except OSError:     # no hard link across file systems
+        shutil.copyfile(src, tmp)
+    os.rename(tmp, dst)
+
+'''
+    written next to model_file when saving it fails, holds the error
+'''
+def failed_marker(model_file):
+
+    return '{}.failed'.format(model_file)
+
+'''
+    write checkpoints in a background thread: the weights are snapshot on CPU at save time,
+    written into a temporary file and renamed, so a checkpoint file is always complete
+'''
+class CheckpointWriter(object):
+
+    def __init__(self):
+
+        self.jobs = Queue.Queue()
+        self.writer = threading.Thread(target=self._write)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def _write(self):
+
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                return
+            state_dict, model_file = job
+            marker = failed_marker(model_file)
+            try:
+                if os.path.exists(marker): os.remove(marker)
+                tmp = '{}.tmp'.format(model_file)
+                tc.save(state_dict, tmp)
+                os.rename(tmp, model_file)
+            except Exception as e:
+                wlog('Failed to save {}: {}'.format(model_file, e))
+                # the evaluation worker waiting for this file gives up on the marker
+                try:
+                    with open(marker, 'w') as f: f.write('{}\n'.format(e))
+                except IOError as e:
+                    wlog('Failed to mark {} as failed: {}'.format(model_file, e))
+            self.jobs.task_done()
+
+    '''
+        inference-only checkpoints (wargs.ckpt_dtype is set) drop the optimizer and keep the
+        weights in half precision
+    '''
+    def save(self, model, optim, eid, bid, model_file):
+
+        dtype = ckpt_dtype(wargs.ckpt_dtype)
+        ema = optim.ema_state_dict(model)
+        state_dict = { 'model': cpu_snapshot(model.state_dict(), dtype), 'epoch': eid, 'batch': bid,
+                      'optim': None if dtype is not None else copy.copy(optim),
+                      'ema': None if ema is None else cpu_snapshot(ema, dtype) }
+        self.jobs.put((state_dict, model_file))
+
+    def wait(self):
+        self.jobs.join()
+
+    def close(self):
+
+        self.jobs.put(None)
+        self.writer.join()
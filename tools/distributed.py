@@ -0,0 +1,133 @@
+from __future__ import division
+
+import torch as tc
+import torch.distributed as dist
+
+import wargs
+from utils import wlog
+
+def init_distributed(rank, world_size):
+
+    wlog('Rank {}/{}: init process group {} by {}'.format(
+        rank, world_size, wargs.dist_backend, wargs.dist_init))
+    dist.init_process_group(backend=wargs.dist_backend, init_method=wargs.dist_init,
+                            world_size=world_size, rank=rank)
+
+'''
+    start from the same weights: broadcast all parameters and buffers of rank 0
+'''
+def sync_params(model):
+
+    for v in model.state_dict().values(): dist.broadcast(v, 0)
+
+'''
+    whether any rank raises the flag
+'''
+def any_rank(flag):
+
+    t = tc.Tensor([1. if flag else 0.])
+    dist.all_reduce(t)
+
+    return t.item() > 0
+
+'''
+    average the gradients over all ranks, the gradients are flattened into preallocated buckets
+    of about bucket_mb MB. Hooks on the gradient accumulators of the parameters launch the
+    asynchronous all-reduce of a bucket as soon as all its gradients are ready in the last
+    backward of an update (armed by prepare), so the communication overlaps with the rest of
+    the backward; __call__ only waits for them and unflattens
+'''
+class GradAllReducer(object):
+
+    def __init__(self, params, bucket_mb=25):
+
+        self.world_size = dist.get_world_size()
+        # the gradients of the last layers are ready first, bucket in reverse order
+        params = [p for p in params if p.requires_grad][::-1]
+        limit = bucket_mb * (1 << 20)
+        self.buckets, bucket, size = [], [], 0
+        for p in params:
+            bucket.append(p)
+            size += p.numel() * p.element_size()
+            if size >= limit:
+                self.buckets.append(bucket)
+                bucket, size = [], 0
+        if len(bucket) > 0: self.buckets.append(bucket)
+        self.buffers = [bucket[0].data.new_zeros(sum(p.numel() for p in bucket))
+                        for bucket in self.buckets]
+        self.bucket_of = dict((id(p), b) for b, bucket in enumerate(self.buckets) for p in bucket)
+        wlog('All-reduce gradients of {} parameters in {} buckets over {} ranks'.format(
+            len(params), len(self.buckets), self.world_size))
+
+        self.armed, self.handles, self.next_bucket = False, [], 0
+        self.pending = [0] * len(self.buckets)
+        # keep the accumulators alive, their hooks are lost if they are freed
+        self.accumulators = []
+        for p in params:
+            acc = p.expand_as(p).grad_fn.next_functions[0][0]
+            acc.register_hook(self._hook(p))
+            self.accumulators.append(acc)
+
+    def _hook(self, p):
+
+        def hook(*unused):
+            if self.armed is False: return
+            b = self.bucket_of[id(p)]
+            self.pending[b] -= 1
+            self._launch_ready()
+        return hook
+
+    def _launch(self, b):
+
+        buf, offset = self.buffers[b], 0
+        for p in self.buckets[b]:
+            n = p.numel()
+            # parameters without gradient on this rank contribute zeros
+            if p.grad is None: buf[offset : offset + n].zero_()
+            else: buf[offset : offset + n].copy_(p.grad.data.view(-1))
+            offset += n
+        self.handles.append(dist.all_reduce(buf, async_op=True))
+
+    def _launch_ready(self):
+
+        # all-reduce calls are issued in the same bucket order on every rank
+        while self.next_bucket < len(self.buckets) and self.pending[self.next_bucket] == 0:
+            self._launch(self.next_bucket)
+            self.next_bucket += 1
+
+    '''
+        arm the hooks before the last backward of an update, roots are the tensors it starts
+        from. Only the parameters reached from them get gradients in this backward, the others
+        are final already (e.g. the classifier of the sharded loss)
+    '''
+    def prepare(self, roots):
+
+        reached, seen = set(), set()
+        stack = [r.grad_fn for r in roots if r.grad_fn is not None]
+        while len(stack) > 0:
+            fn = stack.pop()
+            if fn is None or fn in seen: continue
+            seen.add(fn)
+            if hasattr(fn, 'variable'): reached.add(id(fn.variable))
+            stack.extend(next_fn for next_fn, _ in fn.next_functions)
+        self.pending = [sum(1 for p in bucket if id(p) in reached) for bucket in self.buckets]
+        self.armed, self.handles, self.next_bucket = True, [], 0
+        self._launch_ready()
+
+    def __call__(self):
+
+        # not armed (no prepare) or parameters unused in the backward: launch the rest now
+        self.armed = False
+        for b in range(self.next_bucket, len(self.buckets)): self._launch(b)
+        self.next_bucket = len(self.buckets)
+
+        for handle, bucket, buf in zip(self.handles, self.buckets, self.buffers):
+            handle.wait()
+            buf.div_(self.world_size)
+            offset = 0
+            for p in bucket:
+                n = p.numel()
+                if p.grad is None: p.grad = buf[offset : offset + n].view_as(p).clone()
+                else: p.grad.data.copy_(buf[offset : offset + n].view_as(p))
+                offset += n
+        self.handles, self.next_bucket = [], 0
@@ -0,0 +1,208 @@
+from __future__ import division
+
+import os
+import math
+import torch as tc
+import torch.nn as nn
+
+import wargs
+from utils import wlog, BOS
+
+# keys of the cache of one Transformer decoder layer, flattened in this order for the graphs
+CACHE_KEYS = ('memory_keys', 'memory_values', 'self_keys', 'self_values')
+
+'''
+    tc.jit.trace records the ops of one call into a graph which runs without the Python
+    interpreter, and fuses the elementwise ops (torch >= 1.0)
+'''
+def jit_available():
+
+    return hasattr(tc.jit, 'trace') and hasattr(tc.jit, 'save')
+
+'''
+    target word embedding of y_tm1 (N, ), pos (N, n_embed): position embedding of the step,
+    ignored if trg_emb has no position encoding
+'''
+def embed_step(trg_emb, y_tm1, pos):
+
+    y_emb = trg_emb.we(y_tm1)
+    if trg_emb.position_encoding is True: y_emb = math.sqrt(trg_emb.n_embed) * y_emb + pos
+
+    return y_emb
+
+'''
+    Transformer: encoder output and the encoder-side keys/values of all decoder layers
+'''
+class AttEncode(nn.Module):
+
+    def __init__(self, model):
+
+        super(AttEncode, self).__init__()
+        self.encoder, self.decoder = model.encoder, model.decoder
+
+    def forward(self, src, src_mask):
+
+        enc_output, _ = self.encoder(src, src_mask)
+        memory = []
+        for layer_cache in self.decoder.init_cache(enc_output):
+            memory += [layer_cache['memory_keys'], layer_cache['memory_values']]
+
+        return tuple([enc_output] + memory)
+
+'''
+    Transformer: one decoder step, cache holds the CACHE_KEYS of each layer, returns the costs
+    (N, V), the attention (N, src_L) and the target-side keys/values with the new position
+'''
+class AttDecodeStep(nn.Module):
+
+    def __init__(self, model, noise=None):
+
+        super(AttDecodeStep, self).__init__()
+        self.decoder, self.classifier, self.noise = model.decoder, model.decoder.classifier, noise
+
+    def forward(self, y_tm1, pos, src_mask, *cache):
+
+        x = embed_step(self.decoder.trg_word_emb, y_tm1, pos)[:, None, :]     # (N, 1, d_model)
+        self_kvs = []
+        for layer_idx, dec_layer in enumerate(self.decoder.layer_stack):
+            layer_cache = dict(zip(CACHE_KEYS, cache[4 * layer_idx : 4 * layer_idx + 4]))
+            x, _, alpha = dec_layer(x, None, trg_src_attn_mask=src_mask[:, None, :],
+                                    layer_cache=layer_cache)
+            self_kvs += [layer_cache['self_keys'], layer_cache['self_values']]
+        if self.decoder.decoder_normalize_before is True: x = self.decoder.layer_norm(x)
+        costs = self.classifier(x[:, -1, :], noise=self.noise)
+
+        return tuple([costs, alpha[:, -1, :]] + self_kvs)
+
+'''
+    gru, tgru: encoder output, initial decoder state and the projected keys of the attention
+'''
+class RnnEncode(nn.Module):
+
+    def __init__(self, model):
+
+        super(RnnEncode, self).__init__()
+        self.encoder, self.decoder = model.encoder, model.decoder
+
+    def forward(self, src, src_mask):
+
+        enc_output = self.encoder(src, src_mask)
+        s0, uh = self.decoder.init_state(enc_output, src_mask)
+
+        return enc_output, s0, uh
+
+'''
+    gru, tgru: one decoder step, returns the costs (N, V), the attention (N, src_L) and the new
+    decoder state
+'''
+class RnnDecodeStep(nn.Module):
+
+    def __init__(self, model, noise=None):
+
+        super(RnnDecodeStep, self).__init__()
+        self.decoder, self.classifier, self.noise = model.decoder, model.decoder.classifier, noise
+
+    def forward(self, y_tm1, pos, src_mask, s_tm1, enc_output, uh):
+
+        y_emb = embed_step(self.decoder.trg_word_emb, y_tm1, pos)
+        context, s_t, y_emb, alpha = self.decoder.step(s_tm1, enc_output, uh, y_emb, src_mask)[:4]
+        costs = self.classifier(self.decoder.step_out(y_emb, context, s_t), noise=self.noise)
+
+        return costs, alpha, s_t
+
+'''
+    stable interface of the encoder and the one-step decoder for the beam search:
+        state = encode(src, src_mask)
+        costs, alpha, state = decode_step(state, y_tm1)
+        state = reorder(state, rows)
+    state is a dict of tensors with one row per hypothesis and the index of the next step.
+    With jit, the graphs are traced at their first call: only the ops are recorded, the shapes
+    are free. The tgru encoder loops over the source positions in Python, it runs eagerly
+'''
+class StepModel(object):
+
+    def __init__(self, model, noise=None, jit=False):
+
+        self.trg_emb = model.decoder.trg_word_emb
+        self.att = hasattr(model.decoder, 'init_cache')
+        if self.att is True: self.encode_fn, self.step_fn = AttEncode(model), AttDecodeStep(model, noise)
+        else: self.encode_fn, self.step_fn = RnnEncode(model), RnnDecodeStep(model, noise)
+        if jit is True and not jit_available():
+            wlog('tc.jit.trace is not available in torch {}, decode eagerly'.format(tc.__version__))
+        # gumbel noise is sampled in Python, it can not be traced
+        self.jit = jit is True and noise is None and jit_available()
+        self.trace_encode = self.jit and wargs.encoder_type != 'tgru'
+        self.graphs = {}
+
+    def run(self, name, fn, inputs, trace):
+
+        if trace is True and name not in self.graphs:
+            try: self.graphs[name] = tc.jit.trace(fn, inputs, check_trace=False)
+            except Exception as e:
+                wlog('Tracing {} failed, run it eagerly: {}'.format(name, e))
+                self.graphs[name] = fn
+
+        return self.graphs.get(name, fn)(*inputs)
+
+    def pos_emb(self, y_tm1, step):
+
+        if self.trg_emb.position_encoding is False: return y_tm1.new_zeros(1).float()
+        return self.trg_emb.spe(y_tm1[:, None], timestep=step)[:, 0, :]
+
+    def encode(self, src, src_mask):
+
+        outputs = self.run('encode', self.encode_fn, (src, src_mask), self.trace_encode)
+        if self.att is False:
+            enc_output, s0, uh = outputs
+            return { 'step': 0, 'src_mask': src_mask, 'enc': enc_output, 's': s0, 'uh': uh }
+
+        cache = []
+        for keys, values in zip(outputs[1::2], outputs[2::2]):
+            # no target position yet: [N, n_head, 0, dim_per_head]
+            cache += [keys, values, keys[:, :, :0], values[:, :, :0]]
+
+        # the decoder reads the encoder output only through its keys/values
+        return { 'step': 0, 'src_mask': src_mask, 'cache': cache }
+
+    def decode_step(self, state, y_tm1):
+
+        inputs = (y_tm1, self.pos_emb(y_tm1, state['step']), state['src_mask'])
+        if self.att is False:
+            costs, alpha, s_t = self.run('decode_step', self.step_fn,
+                                         inputs + (state['s'], state['enc'], state['uh']), self.jit)
+            return costs, alpha, dict(state, step=state['step'] + 1, s=s_t)
+
+        outputs = self.run('decode_step', self.step_fn, inputs + tuple(state['cache']), self.jit)
+        cache = list(state['cache'])
+        cache[2::4], cache[3::4] = outputs[2::2], outputs[3::2]
+
+        return outputs[0], outputs[1], dict(state, step=state['step'] + 1, cache=cache)
+
+    '''
+        select the rows of all tensors in state, rows (LongTensor): [new_N]
+    '''
+    def reorder(self, state, rows):
+
+        new_state = {}
+        for k, v in state.items():
+            if isinstance(v, tc.Tensor): v = v.index_select(0, rows)
+            elif isinstance(v, list): v = [t.index_select(0, rows) for t in v]
+            new_state[k] = v
+
+        return new_state
+
+    '''
+        trace both graphs on an example batch and save them into dirname as encode.pt and
+        decode_step.pt, the inputs of decode_step.pt are (y_tm1, pos, src_mask, *state), see
+        decode_step
+    '''
+    def save(self, dirname, src, src_mask):
+
+        assert self.jit is True, 'saving the graphs needs jit'
+        state = self.encode(src, src_mask)
+        self.decode_step(state, src.new_full((src.size(0), ), BOS))
+        for name in ('encode', 'decode_step'):
+            if hasattr(self.graphs.get(name), 'save'):     # not the eager fallback
+                tc.jit.save(self.graphs[name], os.path.join(dirname, '{}.pt'.format(name)))
+                wlog('Save the traced {} into {}/{}.pt'.format(name, dirname, name))
+            else: wlog('{} is not traced, not saved'.format(name))
@@ -1,6 +1,8 @@
 from __future__ import division
 
 import math
+import threading
+import Queue
 import wargs
 import torch as tc
 from utils import *
@@ -26,28 +28,61 @@ class Input(object):
             wlog('Monolingual: batch size {}, Sort in batch? {}'.format(self.batch_size, batch_sort))
 
         self.prefix = prefix    # the prefix of data file, such as 'nist02' or 'nist03'
+        self.on_device = True   # push batches into GPU in __getitem__, False for prefetching
         self._read_pointer = 0
         if batch_type == 'sents':
             self.read_batch_fn = self.sents_batch
             self.n_batches = int(math.ceil(self.n_sent / self.batch_size))
         elif batch_type == 'token':
             self.read_batch_fn = self.token_batch
-            self.n_batches, self._batch_pointer = 0, 0
+            self._batch_pointer = 0
+            self.batch_bounds = self.token_batch_bounds(batch_size)
+            self.batch_order = numpy.arange(len(self.batch_bounds))
+            self.n_batches = len(self.batch_bounds)
+            wlog('Token batching: {} batches, at most {} tokens each'.format(self.n_batches, batch_size))
         self.batch_type = batch_type
 
     def __len__(self):
         return self.n_batches
 
     def eos(self):
+        if self.batch_type == 'token':
+            end = ( self._batch_pointer >= self.n_batches )
+            if end is True: self._batch_pointer = 0
+            return end
         end = ( self._read_pointer >= self.n_sent )
         #print '-----------', self._read_pointer, self.n_sent, end
-        if end is True:
-            self._read_pointer = 0
-            if self.batch_type == 'token':
-                self.n_batches = self._batch_pointer
-                self._batch_pointer = 0
+        if end is True: self._read_pointer = 0
         return end
 
+    def sents_lengths(self):
+
+        # (n_sent, ) max length of source and targets of each sentence
+        def lengths(data):
+            if hasattr(data, 'lens'): return data.lens[data.order, data.files].max(1)
+            return numpy.asarray([max(len(ids) for ids in sent) for sent in data], dtype=numpy.int64)
+        lens = lengths(self.x_list)
+        if self.y_list_files is not None: lens = numpy.maximum(lens, lengths(self.y_list_files))
+        return lens
+
+    '''
+        boundaries of batches over the sentences in the current order, a batch is a run of
+        sentences whose (max length * number of sentences) is not greater than budget
+        Returns: (n_batches, 2) start and end of each batch
+    '''
+    def token_batch_bounds(self, budget):
+
+        lens = self.sents_lengths()
+        bounds, start, max_len = [], 0, 0
+        for idx, l in enumerate(lens.tolist()):
+            max_len = max(max_len, l)
+            if max_len * (idx - start + 1) > budget and idx > start:
+                bounds.append((start, idx))
+                start, max_len = idx, l
+        if start < len(lens): bounds.append((start, len(lens)))
+
+        return numpy.asarray(bounds, dtype=numpy.int64).reshape(-1, 2)
+
     def sents_batch(self, sent_idx, batch_size=80):
 
         x_batch_buffer = self.x_list[sent_idx * batch_size : (sent_idx + 1) * batch_size]
@@ -58,25 +93,12 @@ class Input(object):
 
         return x_batch_buffer, y_batch_buffer
 
-    def token_batch(self, sent_idx, batch_size=4096):
-
-        max_len, n_samples, x_batch_buffer = 0, 0, []
-        y_batch_buffer = None if self.y_list_files is None else []
-        while max_len * n_samples < batch_size:     # may be greater than 4096
-            #print self.n_sent, self._read_pointer
-            if self._read_pointer == self.n_sent: break
-            x = self.x_list[self._read_pointer]     # [[1,2,3,4,...]]
-            x_batch_buffer.append(x)
-            if self.y_list_files is not None:
-                y = self.y_list_files[self._read_pointer]
-                y_batch_buffer.append(y)
-            #print max_len, n_samples, max_len * n_samples, batch_size, x
-            #print y
-            #print '=================='
-            max_len = max(max_len, len(x[0]))
-            n_samples += 1
-            self._read_pointer += 1
-        max_len, n_samples = 0, 0
+    def token_batch(self, batch_idx, batch_size=4096):
+
+        start, end = self.batch_bounds[self.batch_order[batch_idx]].tolist()
+        x_batch_buffer = self.x_list[start : end]     # [[[1,2,3,4,...]], ...]
+        y_batch_buffer = None
+        if self.y_list_files is not None: y_batch_buffer = self.y_list_files[start : end]
         self._batch_pointer += 1
 
         return x_batch_buffer, y_batch_buffer
@@ -160,7 +182,7 @@ class Input(object):
             if x is None: return x
             # (batch_size, max_len)
             if isinstance(x, tuple) or isinstance(x, list): x = tc.tensor(x).long()
-            if wargs.gpu_id is not None: x = x.cuda()    # push into GPU
+            if wargs.gpu_id is not None and self.on_device: x = x.cuda()    # push into GPU
             return x
 
         tsrcs = tuple2Tenser(srcs)
@@ -195,20 +217,135 @@ class Input(object):
             return idxs, tsrcs, lengths, src_mask
 
 
-    def shuffle(self):
+    def shuffle(self, rng=numpy.random):
+
+        if self.batch_type == 'token':
+            # sentences stay in length-sorted batches, only the order of batches changes
+            wlog('shuffling the order of {} batches ... '.format(self.n_batches), False)
+            self.batch_order = rng.permutation(self.n_batches)
+            wlog('done.')
+            return
 
         wlog('shuffling the whole training data bilingually ... ', False)
-        rand_idxs = tc.randperm(self.n_sent).tolist()
-        self.x_list = [self.x_list[k] for k in rand_idxs]
-        self.y_list_files = [self.y_list_files[k] for k in rand_idxs]
+        # rng is shared by all ranks of distributed training
+        rand_idxs = rng.permutation(self.n_sent).tolist()
+        self.x_list = reorder(self.x_list, rand_idxs)
+        self.y_list_files = reorder(self.y_list_files, rand_idxs)
         #data = list(zip(self.x_list, self.y_list_files))
         #x_tuple, y_tuple = zip(*[data[i] for i in tc.randperm(len(data))])
         #self.x_list, self.y_list_files = list(x_tuple), list(y_tuple)
         wlog('done.')
 
-        slens = [len(self.x_list[k]) for k in range(self.n_sent)]
+        if hasattr(self.x_list, 'lengths'): slens = self.x_list.lengths().tolist()
+        else: slens = [len(self.x_list[k][0]) for k in range(self.n_sent)]
         self.x_list, self.y_list_files = sort_batches(self.x_list, self.y_list_files,
                                                       slens, wargs.batch_size,
                                                       wargs.sort_k_batches)
 
+'''
+    Lazy view of a binarized corpus, the tokens are memory-mapped and sliced when one
+    sentence is read, an item is the id lists of the files in files (a slice) of one
+    sentence, i.e. [source ids] or [reference_0 ids, reference_1 ids, ...]
+'''
+class BinCorpus(object):
+
+    def __init__(self, tokens, offsets, lens, files, order=None):
+
+        self.tokens, self.offsets, self.lens, self.files = tokens, offsets, lens, files
+        self.order = numpy.arange(lens.shape[0]) if order is None else order
+
+    def __len__(self):
+        return len(self.order)
+
+    def _item(self, k):
+        return [self.tokens[o : o + l].tolist() for o, l in
+                zip(self.offsets[k, self.files], self.lens[k, self.files])]
+
+    def __getitem__(self, idx):
+
+        if isinstance(idx, slice): return [self._item(k) for k in self.order[idx]]
+        return self._item(self.order[idx])
+
+    def take(self, idxs):
+
+        return BinCorpus(self.tokens, self.offsets, self.lens, self.files,
+                         self.order[numpy.asarray(idxs, dtype=numpy.int64)])
+
+    def lengths(self):
+
+        # lengths of the first file in view, (n_sents, )
+        return self.lens[self.order, self.files.start]
+
+'''
+    Build the batches of one epoch in a background thread, at most n_prefetch batches wait in
+    a bounded queue, they are pinned in memory and pushed into GPU asynchronously, so the
+    training loop does not stall on padding and building tensors
+'''
+class Prefetcher(object):
+
+    def __init__(self, data, n_prefetch=8):
+
+        self.data, self.n_prefetch = data, n_prefetch
+        self.pin = wargs.gpu_id is not None
+        wlog('Prefetch {} batches in background, pin memory? {}'.format(n_prefetch, self.pin))
+
+    def __len__(self):
+        return len(self.data)
+
+    def _map_tensors(self, batch, fn):
+
+        if isinstance(batch, tc.Tensor): return fn(batch)
+        if isinstance(batch, (list, tuple)) and any(isinstance(x, (tc.Tensor, list, tuple))
+                                                   for x in batch):
+            return type(batch)(self._map_tensors(x, fn) for x in batch)
+        return batch
+
+    def _produce(self, order, queue, stop):
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Queue.Full: continue
+            return False
+
+        try:
+            for bidx in order:
+                batch = self.data[bidx]
+                if self.pin: batch = self._map_tensors(batch, lambda x: x.pin_memory())
+                if not put((bidx, batch)): return
+        except Exception as e:
+            put(e)
+            return
+        put(None)
+
+    '''
+        generate (batch index, batch) of one epoch in the order of order, the batch indexes of
+        both sentence and token batching are known before the epoch
+    '''
+    def epoch(self, order):
+
+        if self.n_prefetch <= 0:
+            self.data.on_device = True
+            for bidx in order: yield bidx, self.data[bidx]
+            return
+
+        self.data.on_device = False
+        queue, stop = Queue.Queue(maxsize=self.n_prefetch), threading.Event()
+        worker = threading.Thread(target=self._produce, args=(order, queue, stop))
+        worker.daemon = True
+        worker.start()
+        try:
+            while True:
+                item = queue.get()
+                if item is None: break
+                if isinstance(item, Exception): raise item
+                bidx, batch = item
+                if self.pin: batch = self._map_tensors(batch, lambda x: x.cuda(non_blocking=True))
+                yield bidx, batch
+        finally:
+            stop.set()
+            worker.join()
+            self.data.on_device = True
 
@@ -6,9 +6,12 @@ import io
 import os
 import sys
 import math
+import json
 import numpy
+import hashlib
 import torch as tc
-from collections import defaultdict
+import multiprocessing
+from collections import Counter, defaultdict
 
 import wargs
 from tools.utils import *
@@ -34,34 +37,68 @@ def extract_vocab(data_file, vocab_file, max_vcb_size=30000, max_seq_len=50, cha
 
     return vocab
 
-def count_vocab(data_file, max_vcb_size, max_seq_len=50, char=False):
-
-    assert data_file and os.path.exists(data_file), 'need file to extract vocabulary ...'
-
-    vocab = Vocab()
-    #with open(data_file, 'r') as f:
-    with io.open(data_file, encoding='utf-8') as f:
-        for sent in f.readlines():
-            #sent = sent.strip().encode('utf-8')
-            sent = sent.strip()
+'''
+    count the words of the lines starting in the byte range [start, end) of data_file
+'''
+def count_chunk(args):
+
+    data_file, start, end, max_seq_len, char = args
+    counts = Counter()
+    with open(data_file, 'rb') as f:
+        if start > 0:   # the line across start belongs to the previous chunk
+            f.seek(start - 1)
+            f.readline()
+        pos = f.tell()
+        while pos < end:
+            sent = f.readline()
+            if not sent: break
+            pos += len(sent)
+            sent = sent.decode('utf-8').strip()
             if char is True: words = zh_to_chars(sent)
             else: words = sent.split()
             if len(words) > max_seq_len: continue
-            for word in words: vocab.add(word)
+            counts.update(words)
+
+    return counts
+
+def count_vocab(data_file, max_vcb_size, max_seq_len=50, char=False, n_workers=None):
+
+    assert data_file and os.path.exists(data_file), 'need file to extract vocabulary ...'
+
+    if n_workers is None: n_workers = multiprocessing.cpu_count()
+    file_size = os.path.getsize(data_file)
+    n_chunks = max(1, min(4 * n_workers, file_size // (1 << 20)))
+    bounds = [file_size * i // n_chunks for i in range(n_chunks + 1)]
+    chunks = [(data_file, bounds[i], bounds[i + 1], max_seq_len, char) for i in range(n_chunks)]
+    wlog('Count words of {} in {} chunks with {} workers'.format(data_file, n_chunks, n_workers))
 
-    words_cnt = sum(vocab.freq.itervalues())
-    new_vocab, new_words_cnt = vocab.keep_vocab_size(max_vcb_size)
+    counts = Counter()
+    if n_workers <= 1 or n_chunks == 1:
+        for chunk in chunks: counts.update(count_chunk(chunk))
+    else:
+        pool = multiprocessing.Pool(n_workers)
+        for chunk_counts in pool.imap_unordered(count_chunk, chunks): counts.update(chunk_counts)
+        pool.close()
+        pool.join()
+
+    counts = {str(w): f for w, f in counts.iteritems()}
+    words_cnt = sum(counts.itervalues())
+    new_vocab = Vocab()
+    if len(counts) + new_vocab.size() <= max_vcb_size:
+        wlog('{} <= {} tokens, Bingo!~'.format(len(counts) + new_vocab.size(), max_vcb_size))
+        max_vcb_size = None
+    new_words_cnt = new_vocab.add_counts(counts, max_vcb_size)
     wlog('|Final vocabulary| / |Original vocabulary| = {} / {} = {:4.2f}%'
          .format(new_words_cnt, words_cnt, (new_words_cnt/words_cnt) * 100))
 
-    new_vocab.idx2key = {k: str(v) for k, v in new_vocab.idx2key.items()}
-    new_vocab.key2idx = {str(k): v for k, v in new_vocab.key2idx.items()}
-
     return new_vocab
 
-def wrap_data(data_dir, file_prefix, src_suffix, trg_prefix, src_vocab, trg_vocab,
-              shuffle=True, sort_k_batches=1, max_seq_len=50, char=False):
+def read_corpus(data_dir, file_prefix, src_suffix, trg_prefix, src_vocab, trg_vocab,
+                max_seq_len=50, char=False):
 
+    '''
+        generate [source ids, reference_0 ids, reference_1 ids, ...] of each kept sentence pair
+    '''
     srcF = open(os.path.join(data_dir, '{}.{}'.format(file_prefix, src_suffix)), 'r')
     num = len(srcF.readlines())
     srcF.close()
@@ -77,8 +114,7 @@ def wrap_data(data_dir, file_prefix, src_suffix, trg_prefix, src_vocab, trg_voca
             trgFs.append(open(os.path.join(data_dir, fname), 'r'))
     wlog('NOTE: Target side has {} references.'.format(len(trgFs)))
 
-    idx, ignore, longer = 0, 0, 0
-    srcs, trgs, slens = [], [], []
+    idx, ignore, longer, kept = 0, 0, 0, 0
     while True:
 
         src_sent = srcF.readline().strip()
@@ -106,32 +142,41 @@ def wrap_data(data_dir, file_prefix, src_suffix, trg_prefix, src_vocab, trg_voca
         trg_refs_words = [trg_ref.split() for trg_ref in trg_refs]
         if src_len <= max_seq_len and all([len(tws) <= max_seq_len for tws in trg_refs_words]):
 
-            src_tensor = [ src_vocab.keys2idx(src_words, UNK_WORD) ]
-            trg_refs_tensor = [trg_vocab.keys2idx(trg_ref_words, UNK_WORD,
-                                              bos_word=BOS_WORD, eos_word=EOS_WORD)
-                               for trg_ref_words in trg_refs_words]
-
-            srcs.append(src_tensor)
-            trgs.append(trg_refs_tensor)
-            slens.append(src_len)
+            kept += 1
+            yield [ src_vocab.keys2idx(src_words, UNK_WORD) ] + \
+                    [ trg_vocab.keys2idx(trg_ref_words, UNK_WORD, bos_word=BOS_WORD, eos_word=EOS_WORD)
+                      for trg_ref_words in trg_refs_words ]
         else:
             longer += 1
 
     srcF.close()
     for trgF in trgFs: trgF.close()
 
-    train_size = len(srcs)
-    assert train_size == idx - ignore - longer, 'Wrong .. '
+    assert kept == idx - ignore - longer, 'Wrong .. '
     wlog('Sentence-pairs count: {}(total) - {}(ignore) - {}(longer) = {}'.format(
         idx, ignore, longer, idx - ignore - longer))
 
+def wrap_data(data_dir, file_prefix, src_suffix, trg_prefix, src_vocab, trg_vocab,
+              shuffle=True, sort_k_batches=1, max_seq_len=50, char=False):
+
+    srcs, trgs, slens = [], [], []
+    for sent_files in read_corpus(data_dir, file_prefix, src_suffix, trg_prefix,
+                                  src_vocab, trg_vocab, max_seq_len, char):
+        srcs.append(sent_files[:1])
+        trgs.append(sent_files[1:])
+        slens.append(len(sent_files[0]))
+
+    return shuffle_sort(srcs, trgs, slens, shuffle, sort_k_batches)
+
+def shuffle_sort(srcs, trgs, slens, shuffle=True, sort_k_batches=1):
+
+    train_size = len(srcs)
     if shuffle is True:
 
         #assert len(trgFs) == 1, 'Unsupport to shuffle validation set.'
         wlog('Shuffling the whole dataset ... ', False)
         rand_idxs = tc.randperm(train_size).tolist()
-        srcs = [srcs[k] for k in rand_idxs]
-        trgs = [trgs[k] for k in rand_idxs]
+        srcs, trgs = reorder(srcs, rand_idxs), reorder(trgs, rand_idxs)
         slens = [slens[k] for k in rand_idxs]
         wlog('done.')
 
@@ -139,9 +184,8 @@ def wrap_data(data_dir, file_prefix, src_suffix, trg_prefix, src_vocab, trg_voca
 
     return final_srcs, final_trgs
 
-def wrap_tst_data(src_data, src_vocab, char=False):
+def read_tst_corpus(src_data, src_vocab, char=False):
 
-    srcs, slens = [], []
     srcF = io.open(src_data, mode='r', encoding='utf-8')
     idx = 0
 
@@ -160,16 +204,151 @@ def wrap_tst_data(src_data, src_vocab, char=False):
         src_sent = src_sent.strip()
         if char is True: src_sent = ' '.join(zh_to_chars(src_sent))
         src_words = src_sent.split()
-        src_len = len(src_words)
 
-        src_tensor = [ src_vocab.keys2idx(src_words, UNK_WORD) ]
-
-        srcs.append(src_tensor)
-        slens.append(src_len)
+        yield [ src_vocab.keys2idx(src_words, UNK_WORD) ]
 
     srcF.close()
+
+def wrap_tst_data(src_data, src_vocab, char=False):
+
+    srcs, slens = [], []
+    for sent_files in read_tst_corpus(src_data, src_vocab, char):
+        srcs.append(sent_files)
+        slens.append(len(sent_files[0]))
+
     return srcs, slens
 
+'''
+    Write the ids of sentences into a flat int32 token file bin_prefix.tok, the ids of one
+    sentence in all files (source, reference_0, reference_1, ...) are consecutive,
+    the index file bin_prefix.idx.npz keeps lens and offsets: (n_sents, n_files)
+'''
+def binarize_data(bin_prefix, corpus, flush_every=100000):
+
+    lens, buf, n_sents = [], [], 0
+    with open(bin_prefix + '.tok.tmp', 'wb') as f:
+        for sent_files in corpus:
+            lens.append([len(ids) for ids in sent_files])
+            for ids in sent_files: buf.extend(ids)
+            n_sents += 1
+            if n_sents % flush_every == 0:
+                numpy.asarray(buf, dtype=numpy.int32).tofile(f)
+                buf = []
+        numpy.asarray(buf, dtype=numpy.int32).tofile(f)
+
+    lens = numpy.asarray(lens, dtype=numpy.int32)
+    flat_lens = lens.ravel().astype(numpy.int64)
+    offsets = (numpy.cumsum(flat_lens) - flat_lens).reshape(lens.shape)
+    # through a file object, numpy.savez appends '.npz' to a bare file name
+    with open(bin_prefix + '.idx.npz.tmp', 'wb') as f: numpy.savez(f, lens=lens, offsets=offsets)
+    # index is renamed at last, a broken token file without index is binarized again
+    os.rename(bin_prefix + '.tok.tmp', bin_prefix + '.tok')
+    os.rename(bin_prefix + '.idx.npz.tmp', bin_prefix + '.idx.npz')
+    wlog('Binarize {} sentences ({} tokens) into {}.tok'.format(n_sents, flat_lens.sum(), bin_prefix))
+
+'''
+    what the ids of a binarized file depend on: the input files, the vocabularies and the
+    preprocessing settings
+'''
+def bin_manifest(files, vocabs, char, max_seq_len=None):
+
+    vcb_hashes = []
+    for vocab in vocabs:
+        words = '\n'.join(str(vocab.idx2key[idx]) for idx in range(vocab.size()))
+        vcb_hashes.append(hashlib.md5(words).hexdigest())
+
+    return { 'files': [[os.path.realpath(f), os.path.getsize(f), int(os.path.getmtime(f))] for f in files],
+             'vocabs': vcb_hashes, 'char': char, 'max_seq_len': max_seq_len }
+
+'''
+    binarize the corpus into bin_prefix unless it is binarized already from the same input files
+    with the same vocabularies and settings, manifest is kept in bin_prefix.json
+'''
+def binarize_if_stale(bin_prefix, manifest, corpus_fn):
+
+    manifest_file = bin_prefix + '.json'
+    if os.path.exists(bin_prefix + '.idx.npz') and os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as f:
+            if json.load(f) == manifest: return
+        wlog('The corpus or the vocabularies changed since {}.tok, binarize again'.format(bin_prefix))
+    binarize_data(bin_prefix, corpus_fn())
+    with open(manifest_file + '.tmp', 'w') as f: json.dump(manifest, f, sort_keys=True)
+    os.rename(manifest_file + '.tmp', manifest_file)
+
+def load_bin_data(bin_prefix):
+
+    index = numpy.load(bin_prefix + '.idx.npz')
+    lens, offsets = index['lens'], index['offsets']
+    if lens.shape[0] == 0: tokens = numpy.zeros(0, dtype=numpy.int32)
+    else: tokens = numpy.memmap(bin_prefix + '.tok', dtype=numpy.int32, mode='r')
+    wlog('Memory-map {} sentences ({} files) from {}.tok'.format(lens.shape[0], lens.shape[1],
+                                                                   bin_prefix))
+    return tokens, offsets, lens
+
+def wrap_bin_data(data_dir, file_prefix, src_suffix, trg_prefix, src_vocab, trg_vocab,
+                  shuffle=True, sort_k_batches=1, max_seq_len=50, char=False):
+
+    init_dir(wargs.dir_bin)
+    # ids depend on the vocabularies and the length limit
+    bin_prefix = os.path.join(wargs.dir_bin, '{}.{}-{}.l{}.v{}-{}'.format(file_prefix, src_suffix,
+        trg_prefix, max_seq_len, src_vocab.size(), trg_vocab.size()))
+    # the same files as read_corpus
+    files = [os.path.join(data_dir, '{}.{}'.format(file_prefix, src_suffix))] + \
+            [os.path.join(data_dir, fname) for fname in sorted(os.listdir(data_dir))
+             if fname.startswith('{}.{}'.format(file_prefix, trg_prefix))]
+    binarize_if_stale(bin_prefix, bin_manifest(files, [src_vocab, trg_vocab], char, max_seq_len),
+                      lambda: read_corpus(data_dir, file_prefix, src_suffix, trg_prefix,
+                                          src_vocab, trg_vocab, max_seq_len, char))
+    tokens, offsets, lens = load_bin_data(bin_prefix)
+    srcs = BinCorpus(tokens, offsets, lens, slice(0, 1))
+    trgs = BinCorpus(tokens, offsets, lens, slice(1, lens.shape[1]))
+
+    return shuffle_sort(srcs, trgs, srcs.lengths().tolist(), shuffle, sort_k_batches)
+
+def wrap_bin_tst_data(src_data, src_vocab, char=False):
+
+    init_dir(wargs.dir_bin)
+    # test sets of the same name in different directories do not share the binarized file
+    bin_prefix = os.path.join(wargs.dir_bin, '{}.{}.v{}'.format(os.path.basename(src_data),
+        hashlib.md5(os.path.realpath(src_data)).hexdigest()[:8], src_vocab.size()))
+    binarize_if_stale(bin_prefix, bin_manifest([src_data], [src_vocab], char),
+                      lambda: read_tst_corpus(src_data, src_vocab, char))
+    tokens, offsets, lens = load_bin_data(bin_prefix)
+    srcs = BinCorpus(tokens, offsets, lens, slice(0, 1))
+
+    return srcs, srcs.lengths().tolist()
+
+
+'''
+    the validation set and the test sets of wargs, wrapped by wrap_data_fn and wrap_tst_data_fn
+'''
+def prepare_valid_tests(src_vocab, trg_vocab, wrap_data_fn, wrap_tst_data_fn):
+
+    batch_valid = None
+    if wargs.val_prefix is not None:
+        val_src_file = os.path.join(wargs.val_tst_dir, '{}.{}'.format(wargs.val_prefix, wargs.val_src_suffix))
+        val_trg_file = os.path.join(wargs.val_tst_dir, '{}.{}'.format(wargs.val_prefix, wargs.val_ref_suffix))
+        wlog('\nPreparing validation set from {} and {} ... '.format(val_src_file, val_trg_file))
+        valid_src_tlst, valid_trg_tlst = wrap_data_fn(wargs.val_tst_dir, wargs.val_prefix,
+                                                   wargs.val_src_suffix, wargs.val_ref_suffix,
+                                                   src_vocab, trg_vocab, shuffle=False,
+                                                   max_seq_len=wargs.dev_max_seq_len,
+                                                   char=wargs.src_char)
+        batch_valid = Input(valid_src_tlst, valid_trg_tlst, wargs.test_batch_size, batch_sort=False)
+
+    batch_tests = None
+    if wargs.tests_prefix is not None:
+        assert isinstance(wargs.tests_prefix, list), 'Test files should be list.'
+        init_dir(wargs.dir_tests)
+        batch_tests = {}
+        for prefix in wargs.tests_prefix:
+            init_dir(wargs.dir_tests + '/' + prefix)
+            test_file = '{}{}.{}'.format(wargs.val_tst_dir, prefix, wargs.val_src_suffix)
+            wlog('\nPreparing test set from {} ... '.format(test_file))
+            test_src_tlst, _ = wrap_tst_data_fn(test_file, src_vocab, char=wargs.src_char)
+            batch_tests[prefix] = Input(test_src_tlst, None, wargs.test_batch_size, batch_sort=False)
+
+    return batch_valid, batch_tests
 
 if __name__ == "__main__":
 
@@ -230,15 +409,3 @@ if __name__ == "__main__":
     wlog('Saving data to {} ... '.format(wargs.inputs_data), False)
     tc.save(inputs, wargs.inputs_data)
     wlog('\n## Finish to Prepare Dataset ! ##\n')
-
-
-
-
-
-
-
-
-
-
-
-
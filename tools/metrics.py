@@ -0,0 +1,81 @@
+from __future__ import division
+
+import os
+import json
+import time
+import resource
+import collections
+from contextlib import contextmanager
+import torch as tc
+
+'''
+    wall time of the phases of training steps (fetch, forward, loss, optim, ...) accumulated
+    between two reports, sync: wait for the device at phase boundaries, otherwise asynchronous
+    CUDA kernels are charged to the phase which synchronizes first
+'''
+class PhaseTimer(object):
+
+    def __init__(self, sync=False):
+
+        self.sync = sync and tc.cuda.is_available()
+        self.spends = collections.OrderedDict()
+
+    def add(self, name, spend):
+
+        self.spends[name] = self.spends.get(name, 0.) + spend
+
+    @contextmanager
+    def phase(self, name):
+
+        if self.sync is True: tc.cuda.synchronize()
+        start = time.time()
+        yield
+        if self.sync is True: tc.cuda.synchronize()
+        self.add(name, time.time() - start)
+
+    def reset(self):
+
+        spends, self.spends = self.spends, collections.OrderedDict()
+        return spends
+
+    def __repr__(self):
+        return ' '.join('{} {:.2f}s'.format(k, v) for k, v in self.spends.items())
+
+def peak_rss_mb():
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.  # KB on linux
+
+'''
+    append one json record per line into jsonl_file, and keep the numbers of the last record
+    as gauges in a Prometheus text file (for the node exporter textfile collector)
+'''
+class MetricsLogger(object):
+
+    def __init__(self, jsonl_file, prom_file=None, prefix='wpynmt'):
+
+        self.prom_file, self.prefix = prom_file, prefix
+        self.f = open(jsonl_file, 'a')
+
+    def write(self, record):
+
+        self.f.write(json.dumps(record, sort_keys=True) + '\n')
+        self.f.flush()
+        if self.prom_file is not None: self.write_prom(record)
+
+    def write_prom(self, record):
+
+        def gauges(obj, name):
+            if isinstance(obj, dict):
+                for k, v in sorted(obj.items()):
+                    for g in gauges(v, '{}_{}'.format(name, k)): yield g
+            elif isinstance(obj, (int, long, float)) and not isinstance(obj, bool):
+                yield '{} {}'.format(name, obj)
+
+        tmp = '{}.tmp'.format(self.prom_file)
+        with open(tmp, 'w') as f:
+            for g in gauges(record, self.prefix): f.write(g + '\n')
+        os.rename(tmp, self.prom_file)  # the collector never reads a partial file
+
+    def close(self):
+
+        self.f.close()
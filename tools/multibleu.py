@@ -2,49 +2,19 @@
 # Ander Martinez Sanchez
 
 from __future__ import division, print_function
-from math import exp, log
-from collections import Counter
+from math import exp
 import os
 import sys
 import argparse
+import numpy
+
+from bleu import zh_to_chars, sent_stats, file_stats, bleu_from_stats
 
 def wlog(obj, newline=1):
 
     if newline == 1: sys.stderr.write('{}\n'.format(obj))
     else: sys.stderr.write('{}'.format(obj))
 
-def zh_to_chars(s):
-
-    regex = []
-
-    # Match a whole word:
-    regex += [ur'[A-Za-z]+']
-
-    # Match a single CJK character:
-    regex += [ur'[\u4e00-\ufaff]']
-
-    # Match one of anything else, except for spaces:
-    #regex += [ur'^\s']
-
-    # Match the float
-    regex += [ur'[-+]?\d*\.\d+|\d+']
-
-    # Match chinese float
-    ch_punc = hanzi.punctuation
-    regex += [ur'[{}]'.format(ch_punc)]	# point .
-
-    # Match the punctuation
-    regex += [ur'[.]+']	# point .
-
-    punc = string.punctuation
-    punc = punc.replace('.', '')
-    regex += [ur'[{}]'.format(punc)]
-
-    regex = "|".join(regex)
-    r = re.compile(regex)
-
-    return r.findall(s)
-
 def grab_all_trg_files(filename):
 
     file_names = []
@@ -59,56 +29,6 @@ def grab_all_trg_files(filename):
     wlog('NOTE: Target side has {} references.'.format(len(file_names)))
     return file_names
 
-def ngram_count(words, n):
-    if n <= len(words):
-        return Counter(zip(*[words[i:] for i in range(n)]))
-    return Counter()
-
-
-def max_count(c1, c2):
-    keys = set(list(c1) + list(c2))
-    #keys = c1
-    #for k in keys:
-    #    print(k, max(c1[k], c2[k]))
-    return Counter({k: max(c1[k], c2[k]) for k in keys})
-    #return Counter({k: max(c1[k], c2[k]) for k in c1}) # problem here ...
-
-
-def min_count(c1, c2):
-    #keys = set(list(c1) + list(c2))
-    #return Counter({k: max(c1[k], c2[k]) for k in keys})
-    return Counter({k: min(c1[k], c2[k]) for k in c1})
-
-
-def closest_min_length(candidate, references):
-    l0 = len(candidate)
-    return min((abs(len(r) - l0), len(r)) for r in references)[1]
-
-
-def safe_log(n):
-    if n <= 0:
-        return -9999999999
-        #return 0
-    return log(n)
-
-def precision_n(candidate, references, n):
-    '''
-    print(candidate)
-    print(references)
-    counts = []
-    for ref in references:
-        print('---------------------------------')
-        print(ngram_count(ref, n)['sb'])
-        counts.append(ngram_count(ref, n))
-    ref_max = reduce(max_count, counts)
-    '''
-    ref_max = reduce(max_count, [ngram_count(ref, n) for ref in references])
-    candidate_ngram_count = ngram_count(candidate, n)
-    total = sum(candidate_ngram_count.values())
-    correct = sum(reduce(min_count, (ref_max, candidate_ngram_count)).values())
-    score = (correct / total) if total else 0
-    return score, correct, total
-
 def tokenize(txt, char=False):
     txt = txt.strip()
     if char is True: txt = zh_to_chars(txt.decode('utf-8'))
@@ -121,64 +41,42 @@ def tokenize_lower(txt, char=False):
     else: txt = txt.split()
     return txt
 
-def multi_bleu(candidates, all_references, tokenize_fn=tokenize, ngram=4, char=False):
-    correct = [0] * ngram
-    total = [0] * ngram
-    cand_tot_length = 0
-    ref_closest_length = 0
-
-    for candidate, references in zip(candidates, zip(*all_references)):
-        candidate = tokenize_fn(candidate, char)
-        references = map(tokenize_fn, references, [char for _ in references])
-        cand_tot_length += len(candidate)
-        ref_closest_length += closest_min_length(candidate, references)
-        for n in range(ngram):
-            sc, cor, tot = precision_n(candidate, references, n + 1)
-            correct[n] += cor
-            total[n] += tot
+def multi_bleu_stats(stats, ngram=4):
 
+    stats = stats.sum(0) if stats.ndim == 2 else stats
+    correct, total = stats[:ngram], stats[ngram : 2 * ngram]
+    cand_tot_length, ref_closest_length = int(stats[2 * ngram]), int(stats[2 * ngram + 1])
     precisions = [(correct[n] / total[n]) if correct[n] else 0 for n in range(ngram)]
 
     if cand_tot_length < ref_closest_length:
         brevity_penalty = exp(1 - ref_closest_length / cand_tot_length) if cand_tot_length != 0 else 0
     else:
         brevity_penalty = 1
-    #print(precisions[1])
-    score = 100 * brevity_penalty * exp(
-        sum(safe_log(precisions[n]) for n in range(ngram)) / ngram)
+    score = 100 * float(bleu_from_stats(stats, ngram))
     prec_pc = [100 * p for p in precisions]
-    '''
-    for n in range(ngram):
-        if total[n] == 0:   # back to n-gram BLEU
-            if n == 0:
-                wlog('What ? Null references ... ')
-                bleu, prec_pc = 0., 0.
-                break
-            score = 100 * brevity_penalty * exp(
-                sum(safe_log(precisions[t]) for t in range(n)) / n)
-            prec_pc = [100 * precisions[t] for t in range(n)]
-            break
-    '''
 
     return score, prec_pc, brevity_penalty, cand_tot_length, ref_closest_length
 
-def print_multi_bleu(cand_file, ref_fpaths, cased=False, ngram=4, char=False):
+def multi_bleu(candidates, all_references, tokenize_fn=tokenize, ngram=4, char=False):
+
+    stats = [sent_stats(tokenize_fn(candidate, char), [tokenize_fn(ref, char) for ref in references],
+                        ngram, closest=True)
+             for candidate, references in zip(candidates, zip(*all_references))]
+
+    return multi_bleu_stats(numpy.array(stats), ngram)
+
+def print_multi_bleu(cand_file, ref_fpaths, cased=False, ngram=4, char=False, stats=None):
 
     wlog('\n' + '#' * 30 + ' multi-bleu ' + '#' * 30)
-    tokenize_fn = tokenize if cased is True else tokenize_lower
     wlog('Calculating case-{}sensitive tokenized {}-gram BLEU ...'.format('' if cased else 'in', ngram))
     wlog('\tcandidate file: {}'.format(cand_file))
     wlog('\treferences file:')
     for ref in ref_fpaths: wlog('\t\t{}'.format(ref))
 
-    cand = open(cand_file, 'r')
-    refs = [open(ref_fpath, 'r') for ref_fpath in ref_fpaths]
-
+    # stats: per-sentence statistics already extracted by bleu.file_stats
+    if stats is None: stats, = file_stats(cand_file, ref_fpaths, ngram, cased, char, styles=('multi',))
     score, precisions, brevity_penalty, cand_tot_length, ref_closest_length = \
-        multi_bleu(cand, refs, tokenize_fn, ngram, char=char)
-
-    cand.close()
-    for fd in refs: fd.close()
+        multi_bleu_stats(stats, ngram)
 
     precs_list = []
     for prec in precisions: precs_list.append('{:.1f}'.format(prec))
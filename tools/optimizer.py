@@ -18,6 +18,8 @@ class Optim(object):
 
         self.n_current_steps = 0
         self.warmup_steps = wargs.warmup_steps
+        self.grad_reducer = None    # averages the gradients over ranks in distributed training
+        self.ema, self.ema_pairs = None, None
 
         if wargs.lr_update_way == 'invsqrt':
             self.warmup_end_lr = learning_rate
@@ -40,6 +42,44 @@ class Optim(object):
 
         return rst
 
+    def __getstate__(self):
+
+        # the gradient reducer is bound to the process group, do not save it in checkpoints
+        state = self.__dict__.copy()
+        state['grad_reducer'] = None
+        # the moving average is saved by the checkpoint itself, see ema_state_dict
+        state['ema'], state['ema_pairs'] = None, None
+        # the parameters are in the model and init_optimizer rebuilds the optimizer when resuming
+        state.pop('params', None)
+        state.pop('optimizer', None)
+        return state
+
+    '''
+        keep an exponential moving average (shadow copy) of the trainable weights of model,
+        updated after each step with decay min(ema_decay, (1 + step) / (10 + step))
+        init: state dict to start the average from, the current weights by default
+    '''
+    def init_ema(self, model, ema_decay, init=None):
+
+        self.ema_decay, self.ema, self.ema_pairs = ema_decay, {}, []
+        for name, p in model.named_parameters():
+            if p.requires_grad is False: continue
+            shadow = p.data.clone()
+            if init is not None and name in init: shadow.copy_(init[name])
+            self.ema[name] = shadow
+            self.ema_pairs.append((shadow, p))
+        wlog('Exponential moving average of {} weights, decay {}'.format(len(self.ema), ema_decay))
+
+    '''
+        state dict of model with the trainable weights replaced by their moving average
+    '''
+    def ema_state_dict(self, model):
+
+        if getattr(self, 'ema', None) is None: return None
+        state_dict = model.state_dict()
+        state_dict.update(self.ema)
+        return state_dict
+
     def init_optimizer(self, params):
 
         # careful: params may be a generator
@@ -115,6 +155,9 @@ class Optim(object):
           'weight_decay': 0}]
         '''
 
+        # every rank updates with the same averaged gradients
+        if getattr(self, 'grad_reducer', None) is not None: self.grad_reducer()
+
         # clip by the gradients norm
         if self.max_grad_norm > 0.:
             #wlog('L2 norm Grad clip ... {}'.format(self.max_grad_norm))
@@ -122,4 +165,8 @@ class Optim(object):
 
         self.optimizer.step()
 
+        if getattr(self, 'ema_pairs', None) is not None:
+            decay = min(self.ema_decay, (1. + self.n_current_steps) / (10. + self.n_current_steps))
+            for shadow, p in self.ema_pairs: shadow.mul_(decay).add_(1. - decay, p.data)
+
 
@@ -0,0 +1,105 @@
+from __future__ import division
+
+import torch as tc
+import torch.nn as nn
+import torch.nn.functional as F
+
+from utils import wlog
+
+'''
+    int8 GEMM of fbgemm (dynamic quantization of the activations), torch >= 1.3 on x86 CPUs
+'''
+def int8_gemm_available():
+
+    return hasattr(tc, 'quantize_per_channel') and 'fbgemm' in getattr(
+        getattr(tc.backends, 'quantized', None), 'supported_engines', [])
+
+'''
+    symmetric per output channel: w ~ w_int8 * scale[:, None], w_int8 in [-127, 127]
+'''
+def quantize_per_channel(w):
+
+    scale = w.abs().max(1)[0].clamp(min=1e-8) / 127.
+    w_int8 = (w / scale[:, None]).round().clamp(-127, 127).to(tc.int8)
+
+    return w_int8, scale
+
+'''
+    linear layer for inference with int8 weights, the activations are quantized on the fly by
+    the int8 GEMM when available, otherwise the weights are dequantized once on first use
+'''
+class QuantLinear(nn.Module):
+
+    def __init__(self, weight, bias=None):
+
+        super(QuantLinear, self).__init__()
+        self.out_features, self.in_features = weight.size()
+        w_int8, scale = quantize_per_channel(weight.detach().float())
+        self.register_buffer('weight_int8', w_int8)
+        self.register_buffer('scale', scale)
+        self.register_buffer('bias', None if bias is None else bias.detach().float().clone())
+        self._packed, self._weight, self._prepared_for = None, None, None
+
+    def extra_repr(self):
+        return 'in_features={}, out_features={}, int8'.format(self.in_features, self.out_features)
+
+    def _prepare(self, x):
+
+        w = self.weight_int8.float() * self.scale[:, None]
+        self._packed, self._weight = None, None
+        if int8_gemm_available() and not x.is_cuda:
+            zero_points = tc.zeros(self.out_features, dtype=tc.long)
+            qw = tc.quantize_per_channel(w, self.scale.double(), zero_points, 0, tc.qint8)
+            self._packed = tc.ops.quantized.linear_prepack(qw, self.bias)
+        else: self._weight = w
+
+    def forward(self, x):
+
+        # prepared again after the buffers are loaded or moved
+        version = (self.weight_int8._version, self.scale._version, self.weight_int8.data_ptr())
+        if version != self._prepared_for:
+            self._prepare(x)
+            self._prepared_for = version
+        if self._packed is not None: return tc.ops.quantized.linear_dynamic(x, self._packed)
+
+        return F.linear(x, self._weight, self.bias)
+
+'''
+    replace the nn.Linear layers (Classifier.map_vocab, feed-forward, ...) and the projections of
+    MultiHeadAttention in model by int8 QuantLinear, for inference on CPU
+'''
+def quantize_model(model):
+
+    n_linear, n_att = 0, 0
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if type(child) is nn.Linear:
+                setattr(module, name, QuantLinear(child.weight, child.bias))
+                n_linear += 1
+        if hasattr(module, 'quantize'):
+            module.quantize()
+            n_att += 1
+    wlog('Quantize {} linear layers and {} attention layers into int8, int8 GEMM? {}'.format(
+        n_linear, n_att, int8_gemm_available()))
+
+    return model
+
+'''
+    whether a state dict is saved from a model quantized by quantize_model
+'''
+def is_quantized(model_dict):
+
+    return any(k.endswith('.weight_int8') for k in model_dict)
+
+'''
+    load model_dict into model, the model is quantized before loading a quantized state dict,
+    or after loading a float one if int8
+'''
+def load_weights(model, model_dict, int8=False):
+
+    quantized = is_quantized(model_dict)
+    if quantized is True: quantize_model(model)
+    model.load_state_dict(model_dict)
+    if int8 is True and quantized is False: quantize_model(model)
+
+    return model
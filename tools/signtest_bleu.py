@@ -5,11 +5,37 @@ import math
 import numpy
 import itertools
 
-from bleu import bleu
+from bleu import corpus_stats, bleu_from_stats, read_lines
 
 #sys.path.append('../')
 from utils import debug, wlog
 
+'''
+    BLEU of the baseline with each single sentence swapped for the model translation,
+    each swap only subtracts and adds one statistics vector from the corpus totals
+'''
+def swap_bleus(stats_b, stats_m, n=4):
+
+    fakes = stats_b.sum(0)[None, :] - stats_b + stats_m
+    return bleu_from_stats(fakes, n)
+
+'''
+    paired bootstrap resampling: both systems are scored on the same resampled test sets,
+    a block of samples is drawn at once as multinomial sentence counts
+    return: bleus of the baseline and the model on each sample, [n_samples]
+'''
+def bootstrap_bleus(stats_b, stats_m, n_samples=1000, n=4, block=100, seed=1234):
+
+    rng = numpy.random.RandomState(seed)
+    n_sents = stats_b.shape[0]
+    bleus_b, bleus_m = [], []
+    for start in xrange(0, n_samples, block):
+        counts = rng.multinomial(n_sents, [1. / n_sents] * n_sents, size=min(block, n_samples - start))
+        bleus_b.append(bleu_from_stats(counts.dot(stats_b), n))
+        bleus_m.append(bleu_from_stats(counts.dot(stats_m), n))
+
+    return numpy.concatenate(bleus_b), numpy.concatenate(bleus_m)
+
 # usage: signtest_bleu.py -b <hypo_base> -m <hypo_model> -r <ref_0 ref_1 ...>
 if __name__ == "__main__":
 
@@ -21,42 +47,30 @@ if __name__ == "__main__":
     parser.add_argument('-r', '--references', dest='r', required=True, nargs='+', help='Reads the reference_[0, 1, ...]')
     parser.add_argument('-lc', help='Lowercase', action='store_true')
     parser.add_argument('-v', help='print log', action='store_true')
+    parser.add_argument('-n', '--n-samples', dest='n', type=int, default=1000,
+                        help='samples of paired bootstrap resampling, 0 to skip')
+    parser.add_argument('-s', '--seed', dest='s', type=int, default=1234, help='seed of resampling')
 
     args = parser.parse_args()
 
-    hypo_b = open(args.b, 'r').read().strip()
-    hypo_m = open(args.m, 'r').read().strip()
-    refs = [open(ref_fpath, 'r').read().strip() for ref_fpath in args.r]
+    list_hypo_b, list_hypo_m = read_lines(args.b), read_lines(args.m)
+    refs = [read_lines(ref_fpath) for ref_fpath in args.r]
+    assert len(list_hypo_b) == len(list_hypo_m), 'Length mismatch ... '
 
     cased = ( not args.lc )
-    bleu_b = bleu(hypo_b, refs, 4, cased=cased)
-    bleu_m = bleu(hypo_m, refs, 4, cased=cased)
+    # per-sentence statistics are extracted once for both systems
+    stats_b, = corpus_stats(list_hypo_b, refs, 4, cased=cased)
+    stats_m, = corpus_stats(list_hypo_m, refs, 4, cased=cased)
+    bleu_b, bleu_m = float(bleu_from_stats(stats_b.sum(0))), float(bleu_from_stats(stats_m.sum(0)))
     wlog('Baseline BLEU: {:4.2f}'.format(bleu_b))
     wlog('Model BLEU   : {:4.2f}'.format(bleu_m))
 
-    list_hypo_b, list_hypo_m = hypo_b.split('\n'), hypo_m.split('\n')
-    better = worse = 0
-    fake = list_hypo_b[:]
-    assert len(list_hypo_b) == len(list_hypo_m), 'Length mismatch ... '
-
-    num = len(list_hypo_b)
-    point_every, number_every = int(math.ceil(num/100)), int(math.ceil(num/10))
-
-    for i in xrange(len(fake)):
-
-        fake[i] = list_hypo_m[i]
-        fake_score = bleu('\n'.join(fake), refs, 4, logfun=debug, cased=cased)
-
-        if fake_score > bleu_b: better += 1
-        elif fake_score < bleu_b: worse += 1
-
-        if args.v is True:
+    fake_scores = swap_bleus(stats_b, stats_m)
+    better, worse = int((fake_scores > bleu_b).sum()), int((fake_scores < bleu_b).sum())
+    if args.v is True:
+        for i, fake_score in enumerate(fake_scores):
             wlog('sentence {} {} {}'.format(i, bleu_b, fake_score))
 
-        fake[i] = list_hypo_b[i]
-        if numpy.mod(i + 1, point_every) == 0: wlog('.', False)
-        if numpy.mod(i + 1, number_every) == 0: wlog('{}'.format(idx + 1), False)
-
     wlog('Model better on {} sentences, worse on {} sentences'.format(better, worse))
 
     n = better + worse
@@ -81,5 +95,12 @@ if __name__ == "__main__":
     else:
          wlog('No significant difference')
 
-
-
+    if args.n > 0:
+        wlog('Paired bootstrap resampling with {} samples ...'.format(args.n))
+        bleus_b, bleus_m = bootstrap_bleus(stats_b, stats_m, args.n, seed=args.s)
+        for name, bleus in (('Baseline', bleus_b), ('Model   ', bleus_m)):
+            left, right = numpy.percentile(bleus, [2.5, 97.5])
+            wlog('{} BLEU 95% confidence interval: {:4.2f} ({:4.2f}, {:4.2f})'.format(
+                name, 100 * bleus.mean(), 100 * left, 100 * right))
+        wins = (bleus_m > bleus_b).mean()
+        wlog('Model better on {:.1f}% of the samples, p = {:.4f}'.format(100 * wins, 1. - wins))
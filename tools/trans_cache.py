@@ -0,0 +1,93 @@
+from __future__ import division
+
+import os
+import hashlib
+import sqlite3
+import cPickle
+import threading
+import collections
+
+from utils import wlog
+
+'''
+    hash of all the weights of model, translations cached for other weights are never reused
+'''
+def model_fingerprint(model):
+
+    md5 = hashlib.md5()
+    for name, v in sorted(model.state_dict().items()):
+        md5.update(name)
+        md5.update(v.cpu().contiguous().numpy().tobytes())
+
+    return md5.hexdigest()
+
+'''
+    LRU cache of translations with at most capacity entries in memory (unbounded if None),
+    db_file: an optional sqlite file keeping all the entries across runs
+'''
+class TransCache(object):
+
+    def __init__(self, capacity=None, db_file=None, commit_every=1000):
+
+        self.capacity, self.commit_every = capacity, commit_every
+        self.mem = collections.OrderedDict()
+        self.hits, self.disk_hits, self.misses, self.n_uncommitted = 0, 0, 0, 0
+        self.db, self.lock = None, threading.Lock()
+        if db_file is not None:
+            wlog('Translation cache on disk: {}'.format(os.path.realpath(db_file)))
+            self.db = sqlite3.connect(db_file, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS trans (key TEXT PRIMARY KEY, value BLOB)')
+
+    def _put_mem(self, key, value):
+
+        self.mem[key] = value
+        if self.capacity is not None and len(self.mem) > self.capacity: self.mem.popitem(last=False)
+
+    def get(self, key):
+
+        with self.lock:
+            value = self.mem.pop(key, None)
+            if value is not None:
+                self.mem[key] = value   # most recently used at the end
+                self.hits += 1
+                return value
+            if self.db is not None:
+                row = self.db.execute('SELECT value FROM trans WHERE key = ?',
+                                      (hashlib.sha1(repr(key)).hexdigest(), )).fetchone()
+                if row is not None:
+                    value = cPickle.loads(str(row[0]))
+                    self._put_mem(key, value)
+                    self.disk_hits += 1
+                    return value
+            self.misses += 1
+
+    def put(self, key, value):
+
+        with self.lock:
+            self._put_mem(key, value)
+            if self.db is not None:
+                self.db.execute('INSERT OR REPLACE INTO trans VALUES (?, ?)',
+                                (hashlib.sha1(repr(key)).hexdigest(),
+                                 sqlite3.Binary(cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))))
+                self.n_uncommitted += 1
+                if self.n_uncommitted >= self.commit_every: self.commit()
+
+    def commit(self):
+
+        if self.db is not None and self.n_uncommitted > 0:
+            self.db.commit()
+            self.n_uncommitted = 0
+
+    def close(self):
+
+        with self.lock:
+            self.commit()
+            if self.db is not None: self.db.close()
+            self.db = None
+
+    def __repr__(self):
+
+        n = self.hits + self.disk_hits + self.misses
+        return 'hits {} (disk {}), misses {}, hit rate {:.2f}%, {} in memory'.format(
+            self.hits + self.disk_hits, self.disk_hits, self.misses,
+            100. * (self.hits + self.disk_hits) / n if n > 0 else 0., len(self.mem))
@@ -40,15 +40,22 @@ UNK = RESERVED_TOKENS.index(UNK_WORD)  # 1
 BOS = RESERVED_TOKENS.index(BOS_WORD)  # 2
 EOS = RESERVED_TOKENS.index(EOS_WORD)  # 3
 
-def load_model(model_path):
+'''
+    ema: load the exponential moving average of the weights instead of the weights
+    with_ema: append the moving average (None if there is not) to the returned tuple
+'''
+def load_model(model_path, ema=False, with_ema=False):
     wlog('Loading pre-trained model ... from {} '.format(model_path), 0)
     state_dict = tc.load(model_path, map_location=lambda storage, loc: storage)
-    if len(state_dict) == 4:
-        model_dict, eid, bid, optim = state_dict['model'], state_dict['epoch'], state_dict['batch'], state_dict['optim']
+    model_dict, eid, bid, optim = state_dict['model'], state_dict['epoch'], state_dict['batch'], state_dict['optim']
+    if ema is True:
+        assert state_dict.get('ema') is not None, 'no moving average of weights in {}'.format(model_path)
+        model_dict = state_dict['ema']
+    if 'class' in state_dict:
+        rst = ( model_dict, state_dict['class'], eid, bid, optim )
+    else:
         rst = ( model_dict, eid, bid, optim )
-    elif len(state_dict) == 5:
-        model_dict, class_dict, eid, bid, optim = state_dict['model'], state_dict['class'], state_dict['epoch'], state_dict['batch'], state_dict['optim']
-        rst = ( model_dict, class_dict, eid, bid, optim )
+    if with_ema is True: rst = rst + ( state_dict.get('ema'), )
     wlog('at epoch {} and batch {}'.format(eid, bid))
     wlog(optim)
     return rst
@@ -234,14 +241,16 @@ def part_sort(vec, num):
     return k_rank_ids_invec
 
 # beam search
-def init_beam(beam, s0=None, cnt=50, score_0=0.0, loss_0=0.0, dyn_dec_tup=None, cp=False, transformer=False):
+def init_beam(beam, s0=None, cnt=50, score_0=0.0, loss_0=0.0, dyn_dec_tup=None, cp=False,
+              transformer=False, n_sents=1):
     del beam[:]
     for i in range(cnt + 1):
         ibeam = []  # one beam [] for one char besides start beam
         beam.append(ibeam)
 
     if cp is True:
-        beam[0] = [ [ (loss_0, None, s0, 0, BOS, 0) ] ]
+        # one start beam for each sentence in batch
+        beam[0] = [ [ (loss_0, None, s0, 0, BOS, 0) ] for _ in range(n_sents) ]
         return
     # indicator for the first target word (<b>)
     if dyn_dec_tup is not None:
@@ -284,6 +293,224 @@ def back_tracking(beam, bidx, best_sample_endswith_eos, attent_probs=None):
     # att (---, a0, a1, a2, a3, a4 ) 
     return seq[::-1], best_loss, attent_matrix # reverse
 
+'''
+    Compact history of beam search, preallocated for all steps and indexed by the true sentence id:
+        words, bps (IntTensor):     [maxL + 1, n_sents, k], word and back pointer of each slot
+        scores (FloatTensor):       [maxL + 1, n_sents, k], accumulated cost of each slot
+        attends (FloatTensor):      [maxL + 1, n_sents, k, src_len], attention of each slot (optional)
+    step 0 keeps <b> in the first slot of each sentence, final hypotheses are gathered along the
+    back pointers for all queried paths together
+'''
+class BeamHistory(object):
+
+    def __init__(self, maxL, n_sents, k, src_len=None, device=None):
+
+        self.maxL, self.k = maxL, k
+        self.words = tc.zeros(maxL + 1, n_sents, k, dtype=tc.int32, device=device)
+        self.words[0] = BOS
+        self.bps = tc.zeros(maxL + 1, n_sents, k, dtype=tc.int32, device=device)
+        self.scores = tc.zeros(maxL + 1, n_sents, k, device=device).fill_(float('+inf'))
+        self.scores[0, :, 0] = 0.
+        self.attends = None if src_len is None else \
+                tc.zeros(maxL + 1, n_sents, k, src_len, device=device)
+
+    '''
+        sent_ids (LongTensor):  [n], true ids of the recorded sentences
+        words, bps:             [n, k'] (k' <= k), the slots after k' are not touched
+        scores:                 [n, k'], attends: [n, k', src_len]
+    '''
+    def record(self, step, sent_ids, words, bps, scores=None, attends=None):
+
+        kk = words.size(1)
+        self.words[step, :, :kk].index_copy_(0, sent_ids, words.int())
+        self.bps[step, :, :kk].index_copy_(0, sent_ids, bps.int())
+        if scores is not None:
+            self.scores[step, :, :kk].index_copy_(0, sent_ids, scores.float())
+        if attends is not None and self.attends is not None:
+            self.attends[step, :, :kk].index_copy_(0, sent_ids, attends)
+
+    '''
+        gather the paths ending at step ends[j] in slot slots[j] of sentence sent_ids[j]
+        Returns: words [n, T] of steps 1 ... T (PAD after the end of each path),
+                 attends [n, T, src_len] if with_att and attention is recorded, else None
+    '''
+    def walk(self, sent_ids, ends, slots, with_att=False):
+
+        T = max(ends.tolist()) if ends.numel() > 0 else 0
+        ys = self.words.new(ends.size(0), T).fill_(PAD)
+        atts = [None] * T if with_att is True and self.attends is not None else None
+        pos = slots
+        for t in range(T, 0, -1):
+            on = ends >= t
+            ys[:, t - 1] = tc.where(on, self.words[t][sent_ids, pos], ys[:, t - 1])
+            if atts is not None: atts[t - 1] = self.attends[t][sent_ids, pos]
+            pos = tc.where(on, self.bps[t][sent_ids, pos].long(), pos)
+        if atts is not None:
+            atts = tc.stack(atts, dim=1) if T > 0 else self.attends.new(ends.size(0), 0, 0)
+
+        return ys, atts
+
+    '''
+        back track the hypotheses of one sentence
+        hyps: [(score, end step, slot at the end step)]
+        Returns: [(trans with <b> and w/o <e>, score, attention matrix (trgL, srcL))]
+    '''
+    def back_tracking(self, sent_id, hyps, with_att=False):
+
+        device = self.words.device
+        ends = tc.tensor([hyp[1] for hyp in hyps]).long().to(device)
+        slots = tc.tensor([hyp[2] for hyp in hyps]).long().to(device)
+        sent_ids = slots.new(len(hyps)).fill_(sent_id)
+        ys, atts = self.walk(sent_ids, ends, slots, with_att=with_att)
+        ys = ys.tolist()
+        if atts is not None: atts = atts.cpu().data.numpy()
+
+        cands = []
+        for j, (score, end, _) in enumerate(hyps):
+            att = None
+            if atts is not None: att = atts[j][:end] if end > 0 else []
+            cands.append(([BOS] + ys[j][:end], score, att))
+
+        return cands
+
+'''
+    batched beam search over the one-step decoder step_model (tools/inference.py), the beams of
+    all alive sentences are kept on device, k slots for each sentence:
+        scores (n, k):  accumulated costs, +inf for empty or dead slots
+        ys (n * k, ):   the newest target word of each slot
+        n_hyps (n, ):   number of hypotheses ending with EOS of each sentence
+    words, back pointers, scores and attentions of each step are kept in a BeamHistory for back
+    tracking, indexed by the true sentence id
+        state:          encoded batch of B sentences, step_model.encode
+        sents_maxL:     [B], max target length of each sentence
+        sample:         <e> is banned before sents_maxL of each sentence and forced at it
+        nobos_steps:    steps at which <b> can not be generated
+        C:              [4] counters of the average location of back pointers and the steps
+    Returns: [[(trans with <b> and w/o <e>, score, attention matrix (trgL, srcL))] sorted, of
+              each sentence]
+'''
+def batch_beam_search(step_model, state, k, sents_maxL, src_len=None, print_att=False,
+                      sample=False, nobos_steps=(), C=None):
+
+    B, K, INF = len(sents_maxL), k, float('+inf')
+    maxL, C = max(sents_maxL), [0] * 4 if C is None else C
+    alive, slots = tc.arange(B).long(), tc.arange(K).long()
+    scores = tc.zeros(B, K).fill_(INF)
+    scores[:, 0] = 0.   # only one start hypothesis with <b> for each sentence
+    ys, n_hyps = tc.zeros(B * K).long().fill_(BOS), tc.zeros(B).long()
+    sents_maxL = tc.tensor(sents_maxL).long()
+    if wargs.gpu_id is not None:
+        alive, slots, scores, ys, n_hyps, sents_maxL = alive.cuda(), slots.cuda(), \
+                scores.cuda(), ys.cuda(), n_hyps.cuda(), sents_maxL.cuda()
+    # attention accumulated along the previous steps for the coverage penalty
+    with_cover = wargs.len_norm == 2 and wargs.beta_cover_penalty > 0.
+    cover = None
+    true_bidx, hyps, batch_tran_cands = list(range(B)), [[] for _ in range(B)], [[] for _ in range(B)]
+    history = BeamHistory(maxL, B, K, src_len=src_len if print_att is True else None,
+                          device=scores.device)
+
+    '''
+        back track all hypotheses of one sentence together by gathering the history
+        hyp: (score, accum, end step, slot at the end step)
+    '''
+    def back_track_hyps(true_id):
+
+        sorted_hyps = sorted(hyps[true_id], key=lambda tup: tup[0])
+        for hyp in sorted_hyps: debug('{}'.format(hyp))
+        debug('Sent {}: Best hyp length (w/o EOS)[{}]'.format(true_id, sorted_hyps[0][2]))
+        batch_tran_cands[true_id] = history.back_tracking(true_id,
+            [(hyp[0], hyp[2], hyp[3]) for hyp in sorted_hyps], with_att=print_att)
+
+    # the encoder output and the decoder state of each slot
+    state = step_model.reorder(state, alive[:, None].expand(B, K).contiguous().view(-1))
+
+    for i in range(1, maxL + 1):
+
+        debug('\n{} Step-{} {}'.format('#'*20, i, '#'*20))
+        n, x_mask = alive.size(0), state['src_mask']
+
+        # next_ces: (n * k, voc_size), alpha_ij: (n * k, x_len)
+        next_ces, alpha_ij, state = step_model.decode_step(state, ys)
+        C[2] += 1
+        C[3] += 1
+        if i in nobos_steps:
+            '''here we make the score of <s> so large to avoid null translation'''
+            next_ces[:, BOS] = INF
+        voc_size = next_ces.size(1)
+        cand_scores = (scores.view(-1, 1) + next_ces).view(n, K * voc_size)
+        select_scores = cand_scores
+        if sample is True:
+            '''<e> can not be selected before the last position of the target, and must be there'''
+            ends = (sents_maxL[alive] == i)[:, None].expand(n, K).contiguous().view(-1)
+            eos_scores = cand_scores.view(-1, voc_size)[:, EOS].masked_fill(ends.eq(0), INF)
+            eos_scores = eos_scores.masked_fill(ends & (scores.view(-1) < INF), -INF)
+            select_scores = cand_scores.view(-1, voc_size).clone()
+            select_scores[:, EOS] = eos_scores
+            select_scores = select_scores.view(n, K * voc_size)
+        # sorted k-min candidates of each sentence
+        costs, ranks = select_scores.topk(K, dim=1, largest=False)
+        if sample is True: costs = cand_scores.gather(1, ranks)
+        prevb_id, word_indices = ranks // voc_size, ranks % voc_size   # (n, k)
+        # only k - len(hyps) candidates are expanded for each sentence
+        valid = (slots[None, :] < (K - n_hyps)[:, None]) & (costs < INF)
+        is_eos = valid & (word_indices == EOS)
+        is_live = valid & (word_indices != EOS)
+        if i >= 2:
+            C[0] += (scores < INF).sum().item()
+            C[1] += ((prevb_id + 1) * valid.long()).sum().item()
+
+        # row index of the previous slot in (n * k) rows
+        prev_rows = (tc.arange(n).long().to(ranks.device) * K)[:, None] + prevb_id
+        if wargs.len_norm == 0: norm_costs = costs
+        elif wargs.len_norm == 1: norm_costs = costs / i
+        elif wargs.len_norm == 2:   # alpha length normal
+            lp, cp = batch_lp_cp(i, cover, x_mask)
+            if with_cover and cover is not None: cp = cp[prev_rows]
+            norm_costs = costs / lp + cp
+
+        if is_eos.any():
+            eos_sents, eos_slots = is_eos.nonzero().t()
+            for s_idx, score, cost, bp in zip(eos_sents.tolist(), norm_costs[is_eos].tolist(),
+                                              costs[is_eos].tolist(), prevb_id[is_eos].tolist()):
+                true_id = true_bidx[s_idx]
+                # <eos> is generated at step i, the words of the path end at step i - 1
+                hyps[true_id].append((score, None if wargs.len_norm == 0 else cost, i - 1, bp))
+                debug('Sent {}, gen hypo {}'.format(true_id, hyps[true_id][-1]))
+            n_hyps = n_hyps + is_eos.long().sum(1)
+
+        scores = costs.masked_fill(is_live.eq(0), INF)
+        # -- History of this step, indexed by the true sentence id -- #
+        history.record(i, alive, word_indices, prevb_id, scores,
+            alpha_ij[prev_rows.view(-1)].view(n, K, -1) if print_att is True else None)
+        done = (n_hyps == K) | (sents_maxL[alive] == i)
+        for s_idx in done.nonzero().view(-1).tolist():
+            true_id = true_bidx[s_idx]
+            if len(hyps[true_id]) == 0:
+                # no early stop, no hyp with EOS, select all the live ones in current beam
+                debug('Sent {}, no hyp with EOS, select k hyps length {}'.format(true_id, i))
+                for slot in is_live[s_idx].nonzero().view(-1).tolist():
+                    hyps[true_id].append((norm_costs[s_idx, slot].item(),
+                        None if wargs.len_norm == 0 else costs[s_idx, slot].item(), i, slot))
+            back_track_hyps(true_id)
+
+        remains = done.eq(0).nonzero().view(-1)
+        if remains.size(0) == 0:
+            debug('Early stop~ Normal beam search or sampling in this batch finished.')
+            break
+
+        # -- Compact the batch, keep the live slots of alive sentences -- #
+        prev_rows = prev_rows.index_select(0, remains).view(-1)
+        state = step_model.reorder(state, prev_rows)
+        if with_cover:
+            cover = alpha_ij[prev_rows] if cover is None else cover[prev_rows] + alpha_ij[prev_rows]
+        scores, n_hyps = scores.index_select(0, remains), n_hyps.index_select(0, remains)
+        ys = word_indices.index_select(0, remains).view(-1)
+        alive = alive.index_select(0, remains)
+        true_bidx = alive.tolist()
+        del x_mask, next_ces, cand_scores, select_scores     # free the tensor
+
+    return batch_tran_cands
+
 def filter_reidx(best_trans, tV_i2w=None, attent_matrix=None, ifmv=False, ptv=None):
 
     if ifmv and ptv is not None:
@@ -502,6 +729,24 @@ def lp_cp(bp, beam_idx, bidx, beam):
 
     return lp, cp
 
+'''
+    vectorized lp_cp for all hypotheses at one step
+        cover (FloatTensor):    [n_rows, src_len] attention accumulated along the previous steps,
+                                None if there is no previous step
+        x_mask (FloatTensor):   [n_rows, src_len] the padding positions are not penalized
+    Returns: length penalty (float), coverage penalty [n_rows] (or 0.)
+'''
+def batch_lp_cp(beam_idx, cover=None, x_mask=None):
+    cp = 0.
+    if wargs.beta_cover_penalty > 0.:
+        if cover is None: return 1.0, 0.0
+        if x_mask is not None: cover = cover.masked_fill(x_mask == 0, 1.0)
+        penalty = cover.clamp(max=1.0).log().sum(-1)
+        cp = wargs.beta_cover_penalty * penalty
+    lp = ( ( 5 + beam_idx + 1 ) ** wargs.alpha_len_norm ) / ( (5 + 1) ** wargs.alpha_len_norm )
+
+    return lp, cp
+
 '''
     a: add previous input tensor
     n: apply normalization
@@ -669,33 +914,27 @@ def grab_all_trg_files(filename):
     wlog('NOTE: Target side has {} references.'.format(len(file_names)))
     return file_names
 
+def reorder(seq, idxs):
+
+    # lazy corpus views (BinCorpus) are reordered without reading the sentences
+    if hasattr(seq, 'take'): return seq.take(idxs)
+    return [seq[k] for k in idxs]
+
 def sort_batches(srcs, trgs, slens, batch_size, k=1):
 
     #assert len(trgFs) == 1, 'Unsupport to sort validation set in k batches.'
-    final_srcs, final_trgs, train_size = [], [], len(srcs)
+    if k != 0 and k <= 1: return srcs, trgs
+    slens = numpy.asarray(slens, dtype=numpy.int64)
     if k == 0:
         wlog('sorting the whole dataset by ascending order of source length ... ', False)
         # sort the whole training data by ascending order of source length
-        #_, sorted_idx = tc.sort(tc.IntTensor(slens))
-        sorted_idx = sorted(range(train_size), key=lambda k: slens[k])
-        final_srcs = [srcs[k] for k in sorted_idx]
-        final_trgs = [trgs[k] for k in sorted_idx]
-        wlog('done.')
-    elif k > 1:
+        sorted_idx = numpy.argsort(slens, kind='mergesort')
+    else:
         wlog('sorting for each {} batches ... '.format(k), False)
-        k_batch = batch_size * k
-        number = int(math.ceil(train_size / k_batch))
-        for start in range(number + 1):
-            bsrcs = srcs[start * k_batch : (start + 1) * k_batch]
-            btrgs = trgs[start * k_batch : (start + 1) * k_batch]
-            bslens = slens[start * k_batch : (start + 1) * k_batch]
-            #_, sorted_idx = tc.sort(tc.IntTensor(bslens))
-            sorted_idx = sorted(range(len(bslens)), key=lambda k: bslens[k])
-            final_srcs += [bsrcs[k] for k in sorted_idx]
-            final_trgs += [btrgs[k] for k in sorted_idx]
-        wlog('done.')
-    if len(final_srcs) == 0 and len(final_trgs) == 0: return srcs, trgs
-    else: return final_srcs, final_trgs
-
+        # sort by (window, length) in one stable argsort
+        windows = numpy.arange(len(slens)) // (batch_size * k)
+        sorted_idx = numpy.lexsort((slens, windows))
+    wlog('done.')
 
+    return reorder(srcs, sorted_idx), reorder(trgs, sorted_idx)
 
@@ -1,4 +1,6 @@
 # -*- coding:utf-8 -*-
+import numpy
+import zipfile
 import torch as tc
 from utils import *
 
@@ -12,7 +14,7 @@ class Vocab(object):
         self.freq = {}
 
         if filename is not None:
-            self.load_from_file(data)
+            self.load_from_file(filename)
         else:
             self.idx2key[PAD] = PAD_WORD
             self.idx2key[UNK] = UNK_WORD
@@ -58,40 +60,63 @@ class Vocab(object):
             wlog('{} <= {} tokens, Bingo!~'.format(self.size(), vocab_size))
             return self, sum(self.freq.itervalues())
 
-        idx_freq = [k for k in self.freq.iterkeys()]
-        _, idx = tc.sort(tc.Tensor(
-            [self.freq[k] for k in idx_freq]),
-            dim=0,
-            descending=True)
         keep_vocab = Vocab()
-        keep_word_cnt = 0
-        for i in idx[:vocab_size]:
-            keep_vocab.add(self.idx2key[idx_freq[i]])
-            keep_word_cnt += self.freq[idx_freq[i]]
+        keep_word_cnt = keep_vocab.add_counts(
+            {self.idx2key[idx]: f for idx, f in self.freq.iteritems()}, vocab_size)
 
         return keep_vocab, keep_word_cnt
 
+    '''
+        add the vocab_size most frequent words of counts (word -> frequency), ties are
+        broken by the word itself so the vocabulary does not depend on the counting order
+        return the number of kept tokens
+    '''
+    def add_counts(self, counts, vocab_size=None):
+
+        words = sorted(counts.iteritems(), key=lambda (w, f): (-f, w))
+        if vocab_size is not None: words = words[:vocab_size]
+        keep_word_cnt = 0
+        for w, f in words:
+            if w in self.key2idx: continue
+            idx = len(self.key2idx)
+            self.key2idx[w], self.idx2key[idx], self.freq[idx] = idx, w, f
+            keep_word_cnt += f
+
+        return keep_word_cnt
+
+    '''
+        compact format: a numpy archive holding the words ordered by index and their
+        frequencies, old torch-pickled idx2key files are still loaded
+    '''
     def load_from_file(self, filename):
 
-        idx2key = tc.load(filename)
-        for idx, key in idx2key.iteritems():
-            self.add(key, idx)
+        # torch >= 1.6 also saves zip archives, a numpy archive is the one holding words.npy
+        is_npz = False
+        if zipfile.is_zipfile(filename):
+            with zipfile.ZipFile(filename) as f: is_npz = 'words.npy' in f.namelist()
+        if is_npz is False:
+            idx2key = tc.load(filename)
+            for idx, key in idx2key.iteritems():
+                self.add(key, idx)
+            return
+
+        data = numpy.load(filename)
+        words, freq = data['words'].tolist(), data['freq']
+        self.idx2key = dict(enumerate(words))
+        self.key2idx = {w: idx for idx, w in enumerate(words)}
+        self.freq = {idx: int(f) for idx, f in enumerate(freq) if f > 0}
 
     def write_into_file(self, filename):
 
-        content = ''
-        for idx in range(self.size()):
-            key = self.idx2key[idx]
-            content += '{} {}\n'.format(key, idx)
-
-        tc.save(self.idx2key, filename)
+        words = [str(self.idx2key[idx]) for idx in range(self.size())]
+        freq = numpy.array([self.freq.get(idx, 0) for idx in range(self.size())], dtype=numpy.int64)
+        # write through a file object, numpy.savez appends '.npz' to a bare file name
+        with open(filename, 'wb') as f:
+            numpy.savez(f, words=numpy.array(words, dtype=numpy.string_), freq=freq)
 
         if self.real:
-            txt_vocab_file = filename + '.txt'
-            file = open(txt_vocab_file, 'w')
-            file.write(content)
-
-        file.close()
+            with open(filename + '.txt', 'w') as f:
+                for idx, w in enumerate(words): f.write('{} {}\n'.format(w, idx))
 
     def keys2idx(self, list_words, unk_word, bos_word=None, eos_word=None):
 
@@ -1,12 +1,16 @@
+import os
 # Maximal sequence length in training data
 max_seq_len = 128
 worse_counter = 0
-# 'toy', 'zhen', 'ende', 'deen', 'uyzh'
-dataset, model_config = 'toy', 't2t_tiny'
+# 'toy', 'zhen', 'ende', 'deen', 'uyzh', the model config can be overridden by WPYNMT_CONFIG (bench/)
+dataset, model_config = 'toy', os.environ.get('WPYNMT_CONFIG', 't2t_tiny')
 batch_type = 'token'    # 'sents' or 'tokens', sents is default, tokens will do dynamic batching
 batch_size = 40 if batch_type == 'sents' else 4096
 gpu_id = [0]
 #gpu_id = None
+''' distributed data-parallel training on CPU workers (gpu_id = None), 1 for a single process '''
+dist_world_size, dist_rank = 1, 0
+dist_backend, dist_init, dist_bucket_mb = 'gloo', 'tcp://127.0.0.1:23456', 25
 n_co_models = 1
 s_step_decay = 300 * n_co_models
 e_step_decay = 3000 * n_co_models
@@ -18,6 +22,7 @@ train_prefix, train_src_suffix, train_trg_suffix = 'train', 'src', 'trg'
 ''' vocabulary '''
 n_src_vcb_plan, n_trg_vcb_plan = 30000, 30000
 src_vcb, trg_vcb = dir_data + 'src.vcb', dir_data + 'trg.vcb'
+binarize, dir_bin = True, dir_data + 'bin/'    # memory-map the corpus tokenized only once
 small, epoch_eval, src_char, char_bleu, eval_small = False, False, False, False, False
 cased, with_bpe, with_postproc, use_multi_bleu = False, False, False, True
 opt_mode = 'adam'       # 'adadelta', 'adam' or 'sgd'
@@ -138,15 +143,26 @@ inputs_data = dir_data + 'inputs.pt'
 ''' training '''
 epoch_shuffle_train, epoch_shuffle_batch = True, False
 sort_k_batches = 100      # 0 for all sort, 1 for no sort
+n_prefetch = 8          # batches built ahead in a background thread, 0 for building in the loop
 save_one_model = True
+async_eval = True        # decode and score the validation set in a background process
+async_eval_timeout = 3600   # seconds the worker waits for a checkpoint before reporting an error
 start_epoch = 1
 trg_bow, emb_loss, bow_loss = True, False, False
 trunc_size = 0          # truncated bptt
 grad_accum_count = 1    # accumulate gradient for batch_size * accum_count batches (Transformer)
 loss_norm = 'tokens'    # 'sents' or 'tokens', normalization method of the gradient
 label_smoothing = 0.1
+# fused projection and cross entropy in chunks of rows and vocabulary, [n, V] is never built,
+# checked against the unfused loss by bench/check_xent.py
+chunk_xent, xent_row_chunk, xent_vocab_chunk = False, 1024, 8192
 model_prefix = dir_model + '/model'
+ckpt_dtype = None        # None, 'fp16' or 'bf16': inference-only checkpoints, weights in half precision without optimizer
+ema_decay = None        # None or 0.9999, keep an exponential moving average of weights in checkpoints
 best_model = dir_valid + '/best.model.pt' if dir_valid else 'best.model.pt'
+''' per-phase training metrics at display steps: jsonl (None to disable), Prometheus text file '''
+metrics_jsonl, metrics_prom = dir_model + '/metrics.jsonl', None
+metrics_sync = False     # synchronize CUDA at phase boundaries for exact phase times
 
 ''' whether use pretrained model '''
 pre_train = None
@@ -162,6 +178,14 @@ len_norm = 2    # 0: no noraml, 1: length normal, 2: alpha-beta
 with_mv, avg_att, m_threshold, ngram = 0, 0, 100., 3
 merge_way = 'Y'
 beam_size, alpha_len_norm, beta_cover_penalty = 8, 0.6, 0.
+test_batch_size = 1     # number of sentences translated together in beam search (Transformer)
+jit_trace = False       # decode by the traced encoder and one-step decoder graphs (torch >= 1.0), tools/inference.py
+''' translation server (bin/server.py) '''
+server_port, server_max_batch, server_max_wait_ms = 8088, 32, 10.
+''' translation cache of bin/wtrans.py and bin/server.py, 0 disables it, db: None or a sqlite file '''
+trans_cache_size, trans_cache_db = 100000, None
+''' multi-process translation (bin/mtrans.py): workers (0: one per 4 cores), lines per task, per shard '''
+mtrans_workers, mtrans_chunk, mtrans_shard = 0, 32, 2000
 print_att = True
 
 copy_attn, segments = False, False